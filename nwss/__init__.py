@@ -55,6 +55,8 @@ class Config(object):
                   'serverport',
                   'tmpdir',
                   'longvaluesize',
+                  'mmapcachesize',
+                  'iothreads',
 
                   # web settings
                   'webport',
@@ -77,6 +79,8 @@ class Config(object):
         self.serverport    = cfg.nwsServerPort
         self.tmpdir        = cfg.nwsTmpDir
         self.longvaluesize = cfg.nwsLongValueSize
+        self.mmapcachesize = cfg.nwsMmapCacheSize
+        self.iothreads     = cfg.nwsIoThreads
 
         self.webport       = cfg.nwsWebPort
         self.webserveddir  = cfg.nwsWebServedDir
@@ -120,6 +124,10 @@ class Config(object):
         self.longvaluesize = _cp_int(parser,
                                      'longValueSize',
                                      self.longvaluesize)
+        self.mmapcachesize = _cp_int(parser,
+                                     'mmapCacheSize',
+                                     self.mmapcachesize)
+        self.iothreads     = _cp_int(parser, 'ioThreads', self.iothreads)
 
         self.webport       = _cp_int(parser, 'webPort', self.webport)
         self.webserveddir  = _cp_str(parser,
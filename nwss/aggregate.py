@@ -0,0 +1,208 @@
+#
+# Copyright (c) 2005-2009, REvolution Computing, Inc.
+#
+# NetWorkSpaces is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307
+# USA
+#
+
+"""
+Core NetWorkSpaces server - reductions for aggregate variables.
+
+Vectors stored into an aggregate variable are buffered, and folded into the
+running aggregate a batch at a time.  If NumPy is available, each batch is
+reduced with a single vectorized operation; otherwise, the vectors in the
+batch are folded one at a time.
+"""
+
+import sys
+import random
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    #pylint: disable-msg=C0103
+
+__all__ = ['Accumulator', 'AGGREGATES', 'pack_vector']
+
+AGGREGATES = ('sum', 'min', 'max', 'mean', 'count', 'quantile')
+
+# number of pending vectors at which they are folded into the aggregate
+_BATCH_SIZE = 1024
+
+# number of vectors sampled to estimate quantiles
+_SAMPLE_SIZE = 1024
+
+def pack_vector(values):
+    """Pack a sequence of floats as little-endian float64s."""
+    packed = array('d', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tostring()
+
+def _unpack_vector(data):
+    """Unpack little-endian float64s into an array of floats."""
+    unpacked = array('d', data)
+    if sys.byteorder == 'big':
+        unpacked.byteswap()
+    return unpacked
+
+class Accumulator(object):
+    """Running aggregate of a series of equal-length vectors of float64s.
+    Vectors are added in packed form, as produced by pack_vector.
+    """
+
+    def __init__(self, aggregate='sum', quantile=0.5):
+        """Initialize an accumulator.
+
+          Arguments:
+            aggregate       - one of the names in AGGREGATES
+            quantile        - the quantile to estimate, for 'quantile'
+        """
+        assert aggregate in AGGREGATES, 'unknown aggregate ' + aggregate
+        self.__aggregate = aggregate
+        self.__quantile = quantile
+        self.__width = None     # number of elements in each vector
+        self.__count = 0        # number of vectors folded
+        self.__state = None     # elementwise running sum, min or max
+        self.__sample = []      # reservoir sample of vectors, for quantiles
+        self.__pending = []     # vectors not yet folded
+
+    def __get_count(self):
+        """Get the number of vectors which have been added."""
+        return self.__count + len(self.__pending)
+    count = property(__get_count)
+
+    def __get_aggregate(self):
+        """Get the name of the aggregate computed."""
+        return self.__aggregate
+    aggregate = property(__get_aggregate)
+
+    def __get_quantile(self):
+        """Get the quantile estimated, for the 'quantile' aggregate."""
+        return self.__quantile
+    quantile = property(__get_quantile)
+
+    def check(self, length):
+        """Check that a packed vector of the given length in bytes can be
+        added, raising ValueError if not."""
+        if length == 0 or length % 8 != 0:
+            raise ValueError('vector of %d bytes is not a whole number of '
+                             'float64 values' % length)
+        if self.__width is not None and length != 8 * self.__width:
+            raise ValueError('vector of %d values does not match earlier '
+                             'vectors of %d values' %
+                             (length / 8, self.__width))
+
+    def reserve(self, length):
+        """Check that a packed vector of the given length in bytes can be
+        added, raising ValueError if not, and require every later vector to
+        have the same length.  This is used for a vector whose data is not
+        available yet."""
+        self.check(length)
+        self.__width = length / 8
+
+    def add(self, data):
+        """Add a packed vector."""
+        self.check(len(data))
+        self.__width = len(data) / 8
+        self.__pending.append(data)
+        if len(self.__pending) >= _BATCH_SIZE:
+            self.__fold()
+
+    def result(self):
+        """Get the aggregate as a list of floats, or, for 'count', as a
+        single integer.  Returns None if no vectors have been added, except
+        for 'count'."""
+        self.__fold()
+        if self.__aggregate == 'count':
+            return self.__count
+        if self.__count == 0:
+            return None
+        if self.__aggregate == 'mean':
+            return [total / self.__count for total in self.__state]
+        if self.__aggregate == 'quantile':
+            return self.__estimate_quantile()
+        return list(self.__state)
+
+    def __fold(self):
+        """Fold the pending vectors into the aggregate."""
+        pending = self.__pending
+        if not pending:
+            return
+        self.__pending = []
+
+        aggregate = self.__aggregate
+        if aggregate == 'quantile':
+            self.__add_to_sample(pending)
+        elif aggregate != 'count':
+            if numpy is not None:
+                self.__fold_numpy(pending)
+            else:
+                self.__fold_python(pending)
+        self.__count += len(pending)
+
+    def __fold_numpy(self, pending):
+        """Fold a batch of vectors using a vectorized NumPy reduction."""
+        rows = numpy.frombuffer(''.join(pending), dtype='<f8')
+        rows = rows.reshape((len(pending), self.__width))
+        if self.__aggregate == 'min':
+            batch = rows.min(axis=0)
+            if self.__state is not None:
+                batch = numpy.minimum(batch, self.__state)
+        elif self.__aggregate == 'max':
+            batch = rows.max(axis=0)
+            if self.__state is not None:
+                batch = numpy.maximum(batch, self.__state)
+        else:
+            batch = rows.sum(axis=0)
+            if self.__state is not None:
+                batch += self.__state
+        self.__state = batch.tolist()
+
+    def __fold_python(self, pending):
+        """Fold a batch of vectors one at a time."""
+        state = self.__state
+        aggregate = self.__aggregate
+        for data in pending:
+            row = _unpack_vector(data)
+            if state is None:
+                state = list(row)
+            elif aggregate == 'min':
+                state = map(min, state, row)
+            elif aggregate == 'max':
+                state = map(max, state, row)
+            else:
+                state = map(float.__add__, state, row)
+        self.__state = state
+
+    def __add_to_sample(self, pending):
+        """Add a batch of vectors to the reservoir sample."""
+        sample = self.__sample
+        seen = self.__count
+        for data in pending:
+            if seen < _SAMPLE_SIZE:
+                sample.append(data)
+            else:
+                slot = random.randint(0, seen)
+                if slot < _SAMPLE_SIZE:
+                    sample[slot] = data
+            seen += 1
+
+    def __estimate_quantile(self):
+        """Estimate the quantile of each element from the sample."""
+        columns = zip(*[_unpack_vector(data) for data in self.__sample])
+        rank = int(round(self.__quantile * (len(self.__sample) - 1)))
+        return [sorted(column)[rank] for column in columns]
@@ -24,9 +24,24 @@ Core NetWorkSpaces server - common bits.
 import os, mmap, traceback
 
 from twisted.python import log
+from nwss.diskio import IoQueue
+import nwss
+
+try:
+    from hashlib import sha1 as new_digest
+except ImportError:
+    from sha import new as new_digest   #pylint: disable-msg=W0402
 
 # bit codings for the descriptor.
 DIRECT_STRING = 1
+PACKED_FLOAT64 = 0x100      # vector of little-endian IEEE doubles
+PACKED_INT64 = 0x200        # vector of little-endian 64-bit integers
+
+# status codes for replies which are not plain success/failure.
+NO_SUCH_CONTENT = 3001
+VARIABLE_FULL = 3002
+CONDITION_FAILED = 3003
+NOT_READY = 3004
 
 class ServerException(Exception):
     """Base class for all exceptions raised by this module."""
@@ -56,39 +71,229 @@ class BadModeException(ServerException):
 class NoSuchVariableException(ServerException):
     """No variable by specified name."""
 
+# Metadata map shared by every value stored without metadata.  It must never be
+# modified.
+EMPTY_METADATA = {}
+
 class Response(object):
     #pylint: disable-msg=R0903
     """Response from the server to the client."""
 
+    __slots__ = ('status', 'metadata', 'value', 'iterstate', 'encoded')
+
     def __init__(self, metadata=None, value=None):
         self.status    = 0
         if metadata is None:
-            metadata = {}
+            metadata = EMPTY_METADATA
         self.metadata  = metadata
         self.value     = value
         self.iterstate = None
+        self.encoded   = None   # cache of encoded reply headers
+
+def _remove_file(filename):
+    """Remove a long data file.  Run on an I/O thread."""
+    try:
+        os.remove(filename)
+    except OSError:
+        log.msg('error removing file %s' % filename)
+        traceback.print_exc()
+
+class LongData(object):
+    """Backing file for long values.  The file is shared by every value bound
+    to the same content, and is removed when the last of them is closed.
+
+    Disk operations on the file are done through its I/O queue, so the file
+    may still be being written when the object is created.  Readers must wait
+    for it using when_ready.
+    """
+
+    def __init__(self, filename, length, digest=None):
+        """Initialize a long data object.
+
+          Arguments:
+            filename        - name of the file holding the data
+            length          - length of the data in bytes
+            digest          - hex SHA-1 digest of the data, if known
+        """
+        self.filename = filename
+        self.length = length
+        self.digest = digest
+        self.failed = False         # set if the file couldn't be written
+        self.__refs = 0
+        self.__removed = False
+        self.queue = IoQueue()
+
+        # shared memory map, managed by MAPPING_CACHE
+        self.mapping = None
+        self.readers = 0
+
+    def __get_refs(self):
+        """Get the number of values bound to this file."""
+        return self.__refs
+    refs = property(__get_refs)
+
+    def __get_removed(self):
+        """Check if this file has been removed."""
+        return self.__removed
+    removed = property(__get_removed)
+
+    def acquire(self):
+        """Add a reference to this file."""
+        self.__refs += 1
+
+    def release(self):
+        """Drop a reference to this file, removing it if it was the last."""
+        self.__refs -= 1
+        if self.__refs > 0:
+            return
+        self.__removed = True
+        CONTENT_INDEX.discard(self)
+        MAPPING_CACHE.discard(self)
+        self.queue.submit(_remove_file, (self.filename,))
+
+    def when_ready(self, callback):
+        """Call a function once all pending writes to this file are done."""
+        self.queue.when_idle(callback)
+
+class ContentIndex(object):
+    """Index of the long data held by the server, keyed by content digest and
+    length.  This allows a client to bind a value by reference to content it
+    has already uploaded rather than sending it again.
+    """
+
+    def __init__(self):
+        self.__files = {}           # (digest, length) -> LongData
+
+    def __len__(self):
+        return len(self.__files)
+
+    def add(self, data):
+        """Add a long data file to the index, if its digest is known."""
+        if data.digest is not None and not data.removed:
+            self.__files.setdefault((data.digest, data.length), data)
+
+    def discard(self, data):
+        """Remove a long data file from the index."""
+        key = (data.digest, data.length)
+        if self.__files.get(key) is data:
+            del self.__files[key]
+
+    def lookup(self, digest, length):
+        """Find the long data with the given digest and length, or None."""
+        return self.__files.get((digest.lower(), length))
+
+CONTENT_INDEX = ContentIndex()
+
+def _advise(mapping):
+    """Tell the OS that a mapping will be read sequentially and soon, where the
+    platform supports it."""
+    if not hasattr(mapping, 'madvise'):
+        return
+    for name in ('MADV_SEQUENTIAL', 'MADV_WILLNEED'):
+        advice = getattr(mmap, name, None)
+        if advice is not None:
+            try:
+                mapping.madvise(advice)
+            except (OSError, ValueError):
+                pass
+
+class MappingCache(object):
+    """Cache of read-only memory maps of long data files.  All concurrent
+    readers of a long value share a single mapping, and mappings with no
+    readers are kept open for reuse, up to nwss.config.mmapcachesize of
+    them, least recently used first out.
+    """
+
+    def __init__(self):
+        self.__idle = []            # LongData, least recently used first
+
+    def __len__(self):
+        return len(self.__idle)
+
+    def acquire(self, data):
+        """Get the mapping for a long data file, adding a reader."""
+        if data.mapping is None:
+            datafile = open(data.filename, 'rb')
+            try:
+                data.mapping = mmap.mmap(datafile.fileno(), data.length,
+                                         access=mmap.ACCESS_READ)
+            finally:
+                datafile.close()
+            _advise(data.mapping)
+        elif data.readers == 0:
+            self.__idle.remove(data)
+        data.readers += 1
+        return data.mapping
+
+    def release(self, data):
+        """Drop a reader from the mapping for a long data file."""
+        data.readers -= 1
+        if data.readers > 0:
+            return
+        if data.refs == 0:
+            # the file is gone; no point keeping it mapped
+            self.__close(data)
+            return
+        self.__idle.append(data)
+        while len(self.__idle) > max(nwss.config.mmapcachesize, 0):
+            self.__close(self.__idle.pop(0))
+
+    def discard(self, data):
+        """Forget a long data file which is about to be removed.  If it still
+        has readers, its mapping is closed when the last of them is done."""
+        if data.mapping is not None and data.readers == 0:
+            self.__idle.remove(data)
+            self.__close(data)
+
+    def __close(self, data):
+        """Close the mapping for a long data file."""
+        mapping, data.mapping = data.mapping, None
+        try:
+            mapping.close()
+        except (OSError, ValueError):
+            pass
+
+MAPPING_CACHE = MappingCache()
 
 class Value(object):
     """Value wrapper class handling out-of-band transmission of long data."""
 
+    __slots__ = ('__type_descriptor', '_val', '_long', '_length', '_consumed',
+                 '_closed')
+
     def __init__(self, desc, val):
         """Initialize a value object.
 
           Arguments:
             desc            - type descriptor for object
-            val             - either a string or a (filename, length) tuple
+            val             - either a string, a LongData, or a
+                              (filename, length[, digest]) tuple
         """
         self.__type_descriptor = desc
-        self._val = val
         self._consumed = False
+        self._closed = False
 
         if isinstance(val, str):
+            self._val = val
             self._long = False
             self._length = len(val)
         else:
-            # if it's not a string, assume it's a tuple: (filename, length)
+            if not isinstance(val, LongData):
+                # if it's not a string, assume it's a tuple:
+                #   (filename, length[, digest])
+                val = LongData(*val)
+                CONTENT_INDEX.add(val)
+            val.acquire()
+            self._val = val
             self._long = True
-            self._length = val[1]
+            self._length = val.length
+
+    def share(self):
+        """Create a new value holding the same content as this one.  Long data
+        is shared rather than copied, and survives until both values have been
+        closed.
+        """
+        return Value(self.__type_descriptor, self._val)
 
     def consumed(self):
         """Flag this value as consumed.
@@ -104,28 +309,52 @@ class Value(object):
 
     def close(self):
         """Deallocate any resources associated with this value."""
+        if self._long and not self._closed:
+            self._closed = True
+            self._val.release()
+
+    def digest(self):
+        """Get the hex SHA-1 digest of the contents of this value.  The digest
+        of a long value is computed as its data is uploaded, so it is None
+        until the value is ready, or if its data couldn't be written."""
         if self._long:
-            try:
-                os.remove(self._val[0])
-            except OSError:
-                log.msg('error removing file %s' % self._val[0])
-                traceback.print_exc()
+            if self._val.failed:
+                return None
+            return self._val.digest
+        return new_digest(self._val).hexdigest()
+
+    def when_ready(self, callback):
+        """Call a function once this value's data may be read.  For a long
+        value, this waits for its file to be completely written."""
+        if self._long:
+            self._val.when_ready(callback)
+        else:
+            callback()
 
     def get_file(self):
-        """Memory map the file associated with this long value.  If this is not
-        a long value, this method will fail.
+        """Get a read-only memory map of the file associated with this long
+        value.  The map is shared with other readers, so it must be read by
+        slicing rather than by seeking, and must be handed back using
+        release_file rather than closed.  If this is not a long value, this
+        method will fail.
         """
         assert self._long, 'get_file illegally called on string value'
-        datafile = open(self._val[0], 'rb')
-        memory = mmap.mmap(datafile.fileno(), self._length,
-                           access=mmap.ACCESS_READ)
-        datafile.close()
-        return memory
+        return MAPPING_CACHE.acquire(self._val)
+
+    def release_file(self):
+        """Release a memory map obtained from get_file."""
+        assert self._long, 'release_file illegally called on string value'
+        MAPPING_CACHE.release(self._val)
 
     def is_large(self):
         """Is this a large value?"""
         return self._long
 
+    def is_failed(self):
+        """Could the data of this long value not be completely written?  This
+        is only known once the value is ready."""
+        return self._long and self._val.failed
+
     def __get_type_descriptor(self):
         """Get the type descriptor for this value."""
         return self.__type_descriptor
@@ -149,4 +378,107 @@ class Value(object):
         """Get the length of this value in bytes."""
         return self._length
 
+class CompositeValue(Value):
+    """Long value made up of a sequence of strings and values, which is sent
+    to a client as if it were a single file, streaming the data of each long
+    value from its own file in turn.  The values are owned by the composite
+    value, and are closed with it.
+    """
+
+    __slots__ = ('_parts', '_ends', '_files')
+
+    def __init__(self, desc, parts):
+        """Initialize a composite value.
+
+          Arguments:
+            desc            - type descriptor for the whole value
+            parts           - list of strings and values
+        """
+        Value.__init__(self, desc, '')
+        self._parts = parts
+        self._ends = []             # offset of the end of each part
+        self._files = None          # the data of each part, while mapped
+        length = 0
+        for part in parts:
+            if isinstance(part, Value):
+                length += part.length()
+            else:
+                length += len(part)
+            self._ends.append(length)
+        self._length = length
+
+    def is_large(self):
+        """A composite value is always sent as a long value."""
+        return True
+
+    def is_failed(self):
+        """Could the data of any of the parts not be completely written?"""
+        for part in self._parts:
+            if isinstance(part, Value) and part.is_failed():
+                return True
+        return False
+
+    def when_ready(self, callback):
+        """Call a function once the data of every part may be read."""
+        values = [part for part in self._parts if isinstance(part, Value)]
+        pending = [len(values) + 1]
+
+        def ready():
+            """Count down the parts which are not ready yet."""
+            pending[0] -= 1
+            if pending[0] == 0:
+                callback()
+
+        for value in values:
+            value.when_ready(ready)
+        ready()
+
+    def get_file(self):
+        """Get the data of the whole value, as an object which can be read by
+        slicing, mapping the files of the long parts.  It must be handed back
+        using release_file."""
+        files = []
+        for part in self._parts:
+            if not isinstance(part, Value):
+                files.append(part)
+            elif part.is_large():
+                files.append(part.get_file())
+            else:
+                files.append(part.val())
+        self._files = files
+        return self
+
+    def release_file(self):
+        """Release the files mapped by get_file."""
+        for part in self._parts:
+            if isinstance(part, Value) and part.is_large():
+                part.release_file()
+        self._files = None
+
+    def __getitem__(self, key):
+        """Read a slice of the data mapped by get_file."""
+        start, stop, _ = key.indices(self._length)
+        chunks = []
+        for pos, end in enumerate(self._ends):
+            begin = end - self._parts_length(pos)
+            if end <= start or begin >= stop:
+                continue
+            chunks.append(self._files[pos][max(start - begin, 0):
+                                            min(stop, end) - begin])
+        return ''.join(chunks)
+
+    def _parts_length(self, pos):
+        """Get the length of a part."""
+        if pos == 0:
+            return self._ends[0]
+        return self._ends[pos] - self._ends[pos - 1]
+
+    def close(self):
+        """Close the values which make up this value."""
+        if not self._closed:
+            self._closed = True
+            for part in self._parts:
+                if isinstance(part, Value):
+                    part.close()
+
 ERROR_VALUE = Value(0, '')
@@ -27,6 +27,8 @@ nwsWebPort = 8766
 nwsWebServedDir = 'clientCode'
 nwsTmpDir = tempfile.gettempdir()
 nwsLongValueSize = 16 * 1024 * 1024
+nwsMmapCacheSize = 32
+nwsIoThreads = 4
 nwsServerSslCert = None
 nwsServerSslKey  = None
 nwsPluginDirs = ['./plugins']
@@ -0,0 +1,155 @@
+#
+# Copyright (c) 2005-2009, REvolution Computing, Inc.
+#
+# NetWorkSpaces is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307
+# USA
+#
+
+"""
+Core NetWorkSpaces server - disk I/O for long values.
+
+Writing, closing and removing long value files can stall for a long time, so
+these operations are run on a bounded pool of worker threads rather than on
+the reactor thread.  Operations on the same file are run in the order in which
+they were submitted, and their completions are delivered on the reactor thread.
+"""
+
+import traceback
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+
+from nwss.pyutils import new_list, remove_first
+import nwss
+
+__all__ = ['IoQueue']
+
+_POOL = None
+
+def _get_pool():
+    """Get the I/O thread pool, starting it if necessary.  Returns None if disk
+    I/O should be done directly on the calling thread, either because the pool
+    has been configured away or because the reactor is not running."""
+    global _POOL    #pylint: disable-msg=W0603
+    if nwss.config.iothreads <= 0 or not reactor.running:
+        return None
+    if _POOL is None:
+        _POOL = ThreadPool(1, nwss.config.iothreads)
+        _POOL.start()
+        #pylint: disable-msg=E1101
+        reactor.addSystemEventTrigger('during', 'shutdown', _stop_pool)
+    return _POOL
+
+def _stop_pool():
+    """Stop the I/O thread pool when the reactor shuts down."""
+    global _POOL    #pylint: disable-msg=W0603
+    pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.stop()
+
+class IoQueue(object):
+    """Ordered queue of disk operations on a single file.  Operations are run
+    one at a time, in submission order, on the I/O thread pool.
+    """
+
+    def __init__(self):
+        self.__ops = new_list()     # (func, args, callback)
+        self.__busy = False
+        self.__pending_bytes = 0
+
+    def __get_idle(self):
+        """Check if there are no operations queued or in progress."""
+        return not self.__busy and not self.__ops
+    idle = property(__get_idle)
+
+    def __get_pending_bytes(self):
+        """Get the number of bytes of queued writes which have not yet been
+        completed."""
+        return self.__pending_bytes
+    pending_bytes = property(__get_pending_bytes)
+
+    def submit(self, func, args=(), callback=None, nbytes=0):
+        """Queue an operation on this file.
+
+          Arguments:
+            func            - function to run on a worker thread
+            args            - arguments to the function
+            callback        - function to call on the reactor thread with the
+                              result of the operation, if any
+            nbytes          - number of bytes written by the operation
+        """
+        self.__pending_bytes += nbytes
+        self.__ops.append((func, args, callback, nbytes))
+        if not self.__busy:
+            self.__run_next()
+
+    def when_idle(self, callback):
+        """Call a function on the reactor thread once all of the operations
+        queued so far have completed."""
+        if self.idle:
+            callback()
+        else:
+            self.submit(_nothing, (), lambda ignored: callback())
+
+    def __run_next(self):
+        """Start the next queued operation."""
+        while self.__ops:
+            operation = remove_first(self.__ops)
+            pool = _get_pool()
+            if pool is None:
+                self.__finish(operation, _run(operation[0], operation[1]))
+            else:
+                self.__busy = True
+                pool.callInThread(self.__work, operation)
+                return
+
+    def __work(self, operation):
+        """Run an operation on a worker thread."""
+        result = _run(operation[0], operation[1])
+        reactor.callFromThread(self.__done, operation, result)
+
+    def __done(self, operation, result):
+        """Completion of an operation, back on the reactor thread."""
+        self.__busy = False
+        self.__finish(operation, result)
+        self.__run_next()
+
+    def __finish(self, operation, result):
+        """Account for a completed operation and deliver its result."""
+        _, _, callback, nbytes = operation
+        self.__pending_bytes -= nbytes
+        if callback is not None:
+            try:
+                callback(result)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception:               #pylint: disable-msg=W0703
+                log.msg('error in disk I/O completion')
+                traceback.print_exc()
+
+def _nothing():
+    """Empty operation, used to wait for a queue to drain."""
+    return None
+
+def _run(func, args):
+    """Run a disk operation, logging and swallowing any error."""
+    try:
+        return func(*args)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception:                       #pylint: disable-msg=W0703
+        log.msg('error in disk I/O operation')
+        traceback.print_exc()
+        return None
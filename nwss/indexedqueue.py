@@ -0,0 +1,435 @@
+#
+# Copyright (c) 2005-2009, REvolution Computing, Inc.
+#
+# NetWorkSpaces is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307
+# USA
+#
+
+"""
+Core NetWorkSpaces server - indexable queue used to hold variable values.
+"""
+
+from __future__ import generators
+import sys
+from array import array
+
+from nwss.base import Value, EMPTY_METADATA
+
+__all__ = ['IndexedQueue', 'PackedQueue']
+
+# don't bother compacting the queue until this many entries have been popped
+_COMPACT_MIN = 1024
+
+# string values no longer than this are packed into slabs
+_MAX_PACKED = 1024
+
+# size past which a slab is full and a new one is started
+_SLAB_SIZE = 256 * 1024
+
+class IndexedQueue(object):
+    """Queue of (value, metadata) entries, each addressed by an absolute
+    index.  Entries are numbered consecutively as they are appended, and
+    popping entries from the head does not renumber the rest, so an index
+    remains valid for as long as its entry is in the queue.
+
+    Appending, popping from the head and looking up an entry by index are all
+    O(1) (amortized, in the case of popping).
+    """
+
+    def __init__(self, first_index=0):
+        """Initialize an empty queue.
+
+          Arguments:
+            first_index     - absolute index of the first entry appended
+        """
+        self.__entries = []         # popped slots are set to None
+        self.__head = 0             # position of the first entry
+        self.__first = first_index  # absolute index of the first entry
+
+    def __len__(self):
+        return len(self.__entries) - self.__head
+
+    def __iter__(self):
+        """Iterate over the values in the queue, from head to tail."""
+        return self.values()
+
+    def __get_first_index(self):
+        """Get the absolute index of the entry at the head of the queue."""
+        return self.__first
+    first_index = property(__get_first_index)
+
+    def __get_end_index(self):
+        """Get the absolute index which the next appended entry will get."""
+        return self.__first + len(self)
+    end_index = property(__get_end_index)
+
+    def append(self, value, metadata):
+        """Add an entry at the tail of the queue."""
+        self.__entries.append((value, metadata))
+
+    def skip(self):
+        """Use up an index without storing an entry.  This is used when a
+        value is handed straight to a waiting client, and is only allowed when
+        the queue is empty."""
+        assert len(self) == 0, 'skip illegally called on non-empty queue'
+        self.__first += 1
+
+    def popleft(self):
+        """Remove and return the entry at the head of the queue."""
+        entries = self.__entries
+        head = self.__head
+        if head >= len(entries):
+            raise IndexError('pop from an empty queue')
+        entry = entries[head]
+        entries[head] = None
+        head += 1
+        self.__first += 1
+
+        # Compact once at least half of the list is popped slots
+        if head >= _COMPACT_MIN and head * 2 >= len(entries):
+            del entries[:head]
+            head = 0
+        self.__head = head
+        return entry
+
+    def get(self, index):
+        """Get the entry with the given absolute index."""
+        pos = index - self.__first
+        if pos < 0:
+            raise IndexError('queue index has been popped')
+        return self.__entries[self.__head + pos]
+
+    def values(self):
+        """Generate the values in the queue, from head to tail."""
+        entries = self.__entries
+        for pos in xrange(self.__head, len(entries)):
+            yield entries[pos][0]
+
+class PackedQueue(object):
+    """Queue with the same interface as IndexedQueue, but which stores short
+    string values compactly.  The data of each short value is packed into a
+    shared slab, and only its slab, offset, length and type descriptor are
+    kept, in arrays.  A Value object is only created again when an entry is
+    read.  Long values are kept as they are, as is any non-empty metadata.
+
+    Entries can also be popped from the tail, so the queue can be used as a
+    stack, or removed from the middle by index.  A removed entry leaves a
+    tombstone, which is skipped over, and is freed once it reaches the head.
+    """
+
+    def __init__(self):
+        self.__slab = array('l')    # absolute slab number of each entry
+        self.__offset = array('i')  # offset of each entry in its slab
+        self.__length = array('i')  # length of each entry, or -1 if unpacked
+        self.__desc = array('l')    # type descriptor of each entry
+        self.__objects = {}         # unpacked values, by absolute index
+        self.__metadata = {}        # non-empty metadata, by absolute index
+        self.__removed = {}         # tombstones, by absolute index
+        self.__slabs = [bytearray()]
+        self.__first_slab = 0       # absolute slab number of __slabs[0]
+        self.__head = 0             # position of the first entry
+        self.__first = 0            # absolute index of the first entry
+
+    def __len__(self):
+        return len(self.__length) - self.__head - len(self.__removed)
+
+    def __iter__(self):
+        """Iterate over the values in the queue, from head to tail."""
+        return self.values()
+
+    def __contains__(self, index):
+        """Check if the queue holds an entry with the given absolute index."""
+        return self.__first <= index < self.end_index and \
+                index not in self.__removed
+
+    def __get_first_index(self):
+        """Get the absolute index of the entry at the head of the queue."""
+        return self.__first
+    first_index = property(__get_first_index)
+
+    def __get_end_index(self):
+        """Get the absolute index which the next appended entry will get."""
+        return self.__first + len(self.__length) - self.__head
+    end_index = property(__get_end_index)
+
+    def append(self, value, metadata):
+        """Add an entry at the tail of the queue."""
+        index = self.end_index
+        if isinstance(value, Value) and not value.is_large() and \
+                value.length() <= _MAX_PACKED and \
+                0 <= value.type_descriptor <= sys.maxint:
+            slab = self.__slabs[-1]
+            if len(slab) + value.length() > _SLAB_SIZE:
+                slab = bytearray()
+                self.__slabs.append(slab)
+            self.__offset.append(len(slab))
+            self.__length.append(value.length())
+            self.__desc.append(value.type_descriptor)
+            slab += value.val()
+        else:
+            self.__objects[index] = value
+            self.__offset.append(0)
+            self.__length.append(-1)
+            self.__desc.append(0)
+        self.__slab.append(self.__first_slab + len(self.__slabs) - 1)
+        if metadata:
+            self.__metadata[index] = metadata
+
+    def skip(self):
+        """Use up an index without storing an entry.  This is used when a
+        value is handed straight to a waiting client.  If the queue isn't
+        empty, as when a selective fetcher takes a value which other queued
+        values don't match, the index is left as a tombstone at the tail."""
+        if len(self.__length) == self.__head:
+            self.__first += 1
+            return
+        self.__removed[self.end_index] = True
+        self.__slab.append(self.__first_slab + len(self.__slabs) - 1)
+        self.__offset.append(0)
+        self.__length.append(-1)
+        self.__desc.append(0)
+
+    def popleft(self):
+        """Remove and return the entry at the head of the queue."""
+        head = self.__head
+        if head >= len(self.__length):
+            raise IndexError('pop from an empty queue')
+        index = self.__first
+        entry = self.__take(head, index)
+        head += 1
+        self.__first += 1
+
+        # Free any tombstones which have reached the head
+        removed = self.__removed
+        while removed and self.__first in removed:
+            del removed[self.__first]
+            head += 1
+            self.__first += 1
+
+        if head == len(self.__length):
+            self.__reset()
+            return entry
+
+        # Drop any slabs which no longer hold entries, and compact the arrays
+        # once at least half of them are popped slots
+        unused = self.__slab[head] - self.__first_slab
+        if unused > 0:
+            del self.__slabs[:unused]
+            self.__first_slab += unused
+        if head >= _COMPACT_MIN and head * 2 >= len(self.__length):
+            for entries in (self.__slab, self.__offset, self.__length,
+                            self.__desc):
+                del entries[:head]
+            head = 0
+        self.__head = head
+        return entry
+
+    def pop(self):
+        """Remove and return the entry at the tail of the queue."""
+        if not len(self):
+            raise IndexError('pop from an empty queue')
+        while True:
+            index = self.end_index - 1
+            entry = self.__pop_tail()
+            if self.__removed.pop(index, None) is None:
+                return entry
+
+    def remove(self, index):
+        """Remove and return the entry with the given absolute index, which
+        may be anywhere in the queue."""
+        if index == self.__first:
+            return self.popleft()
+        if index not in self:
+            raise IndexError('queue index out of range')
+        entry = self.__take(self.__head + index - self.__first, index)
+        self.__removed[index] = True
+        return entry
+
+    def index_of(self, value):
+        """Get the absolute index of an entry holding the given unpacked
+        value object, such as a long value, or None if there is none."""
+        for index, obj in self.__objects.iteritems():
+            if obj is value:
+                return index
+        return None
+
+    def next_index(self, index):
+        """Get the first index, from the given one on, which is not that of a
+        removed entry."""
+        while index in self.__removed:
+            index += 1
+        return index
+
+    def prev_index(self, index):
+        """Get the last index, from the given one back, which is not that of
+        a removed entry."""
+        while index in self.__removed:
+            index -= 1
+        return index
+
+    def metadata_items(self):
+        """Get a list of the (index, metadata) pairs of the entries which have
+        non-empty metadata, in index order."""
+        indexes = self.__metadata.keys()
+        indexes.sort()
+        return [(index, self.__metadata[index]) for index in indexes]
+
+    def __pop_tail(self):
+        """Remove the last entry, which may be a tombstone, and return it, or
+        None for a tombstone."""
+        pos = len(self.__length) - 1
+        index = self.end_index - 1
+        entry = None
+        if index not in self.__removed:
+            entry = self.__take(pos, index)
+        length = self.__length.pop()
+        offset = self.__offset.pop()
+        slab = self.__slab.pop() - self.__first_slab
+        self.__desc.pop()
+
+        if pos == self.__head:
+            self.__reset()
+        elif length >= 0 and slab == len(self.__slabs) - 1:
+            # the data of the tail entry is always at the end of its slab
+            del self.__slabs[slab][offset:]
+            if self.__slab[-1] - self.__first_slab < slab:
+                self.__slabs.pop()
+        return entry
+
+    def get(self, index):
+        """Get the entry with the given absolute index."""
+        pos = index - self.__first
+        if pos < 0:
+            raise IndexError('queue index has been popped')
+        pos += self.__head
+        if pos >= len(self.__length):
+            raise IndexError('queue index out of range')
+        if index in self.__removed:
+            raise IndexError('queue index has been removed')
+        return self.__entry(pos, index)
+
+    def values(self):
+        """Generate the values in the queue, from head to tail."""
+        index = self.__first
+        for pos in xrange(self.__head, len(self.__length)):
+            if index not in self.__removed:
+                yield self.__entry(pos, index)[0]
+            index += 1
+
+    def __entry(self, pos, index):
+        """Build the (value, metadata) entry at the given position."""
+        length = self.__length[pos]
+        if length < 0:
+            value = self.__objects[index]
+        else:
+            slab = self.__slabs[self.__slab[pos] - self.__first_slab]
+            offset = self.__offset[pos]
+            value = Value(self.__desc[pos], str(slab[offset:offset + length]))
+        return value, self.__metadata.get(index, EMPTY_METADATA)
+
+    def __take(self, pos, index):
+        """Build the entry at the given position, and forget its unpacked
+        value and metadata."""
+        entry = self.__entry(pos, index)
+        self.__objects.pop(index, None)
+        self.__metadata.pop(index, None)
+        return entry
+
+    def __reset(self):
+        """Release all of the storage of a queue which has become empty."""
+        for entries in (self.__slab, self.__offset, self.__length,
+                        self.__desc):
+            del entries[:]
+        self.__removed = {}
+        self.__slabs = [bytearray()]
+        self.__first_slab = 0
+        self.__head = 0
+
+if __name__ == '__main__':
+    def _bench(argv):
+        """Benchmark iterated finds (a scan of every index, as done by a
+        client walking a variable with ifind) on a deque with separate
+        metadata, as the FIFO used to be, on an IndexedQueue, and on a
+        PackedQueue, and the time to fill and drain each of the queues."""
+        import time
+        from collections import deque
+
+        sizes = [int(arg) for arg in argv[1:]] or [10000, 50000, 100000]
+        for size in sizes:
+            values, metadata = deque(), deque()
+            queues = [IndexedQueue(), PackedQueue()]
+            for i in xrange(size):
+                values.append(Value(1, str(i)))
+                metadata.append({})
+                for queue in queues:
+                    queue.append(Value(1, str(i)), {})
+
+            start = time.time()
+            for i in xrange(size):
+                _ = metadata[i], values[i]
+            times = [time.time() - start]
+
+            for queue in queues:
+                start = time.time()
+                for i in xrange(size):
+                    _ = queue.get(i)
+                times.append(time.time() - start)
+
+            print 'ifind scan of %8d values: deque %8.3fs  ' \
+                    'IndexedQueue %8.3fs  PackedQueue %8.3fs' % \
+                    ((size,) + tuple(times))
+
+            times = []
+            for queue in [IndexedQueue(), PackedQueue()]:
+                start = time.time()
+                for i in xrange(size):
+                    queue.append(Value(1, str(i)), {})
+                while queue:
+                    queue.popleft()
+                times.append(time.time() - start)
+
+            print 'fill and drain %8d values:    ' \
+                    'IndexedQueue %8.3fs  PackedQueue %8.3fs' % \
+                    ((size,) + tuple(times))
+
+            print 'memory for     %8d values:    ' \
+                    'IndexedQueue %8dKB PackedQueue %8dKB' % \
+                    (size, _growth(IndexedQueue, size),
+                     _growth(PackedQueue, size))
+
+    def _growth(queue_class, size):
+        """Measure the growth in peak memory use, in KB, from filling a queue
+        with short values in a child process."""
+        import os
+        import resource
+
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            queue = queue_class()
+            for i in xrange(size):
+                queue.append(Value(1, str(i)), {})
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(wfd, str(after - before))
+            os._exit(0)     #pylint: disable-msg=W0212
+        os.close(wfd)
+        growth = int(os.read(rfd, 64))
+        os.close(rfd)
+        os.waitpid(pid, 0)
+        return growth
+
+    _bench(sys.argv)
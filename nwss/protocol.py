@@ -31,7 +31,7 @@ from twisted.python import log
 from twisted.internet import reactor
 from nwss.base import Value, DIRECT_STRING, Response, ERROR_VALUE
 from nwss.protoutils import DictReceiver, ArgTupleReceiver, FileProducer
-from nwss.protoutils import map_proto_generator
+from nwss.protoutils import encode_dictionary
 import nwss
 
 try:
@@ -220,7 +220,7 @@ class NwsProtocol(object, stateful.StatefulProtocol):
         self.__metadata_receive = False
         self.__metadata_send = False
         self.__deadman = False
-        self.__reply_long_preamble = self.__reply_long_preamble_nocookie
+        self.__cookie_protocol = False
 
         # Session statistics
         self.__statistics = WsSessionStats()
@@ -363,10 +363,7 @@ class NwsProtocol(object, stateful.StatefulProtocol):
     def __send_dictionary(self, dictionary):
         """Marshal and write the contents of a dictionary to the transport in
         the canonical form, as interpreted by the DictReceiver utility."""
-        maplen = len(dictionary)
-        self.transport.write('%04d' % maplen)
-        #pylint: disable-msg=W0141
-        map(self.transport.write, map_proto_generator(dictionary))
+        self.transport.write(encode_dictionary(dictionary))
 
     #######################################################
     # Handshake protocol machinery
@@ -380,13 +377,13 @@ class NwsProtocol(object, stateful.StatefulProtocol):
 
         # New-style handshake
         if data.startswith('X'):
-            self.__reply_long_preamble = self.__reply_long_preamble_cookie
+            self.__cookie_protocol = True
             self.__send_options_advertise(self.DEFAULT_OPTIONS)
             return (self.__receive_options_request, 4)
 
         # Old-style handshake
         if data not in ['0000', '1111']:
-            self.__reply_long_preamble = self.__reply_long_preamble_cookie
+            self.__cookie_protocol = True
         self.transport.write('2223')
 
         # Beginning of the protocol proper.
@@ -504,22 +501,45 @@ class NwsProtocol(object, stateful.StatefulProtocol):
         self.__statistics.mark_operation(args[0])
         return self.__get_command_state()
 
-    def __reply_long_preamble_cookie(self, response):
-        """Send the "cookie protocol" version of a long reply preamble."""
-        self.transport.write('%s%020d%-20.20s%020d%020d' %
-            (response.status,
-             response.value.type_descriptor,
-             response.iterstate[0],
-             response.iterstate[1],
-             response.value.length()))
-
-    def __reply_long_preamble_nocookie(self, response):
-        #pylint: disable-msg=W0613
-        """Send the no-"cookie protocol" version of a long reply preamble."""
-        self.transport.write('%s%020d%020d' %
-              (response.status,
-               response.value.type_descriptor,
-               response.value.length()))
+    def __encode_long_reply_header(self, response):
+        """Get the encoded metadata and preamble of a long reply, as this
+        connection expects them.  The encoding is cached on the response, so
+        that a response delivered to many clients is only formatted once for
+        each combination of connection options."""
+        key = (self.__cookie_protocol, self.__metadata_send)
+        if response.encoded is None:
+            response.encoded = {}
+        else:
+            try:
+                return response.encoded[key]
+            except KeyError:
+                pass
+
+        # Coerce the status to a 4-digit string
+        response.status = coerce_status(response.status)
+
+        # The metadata
+        if self.__metadata_send:
+            header = encode_dictionary(response.metadata)
+        else:
+            header = ''
+
+        # The preamble
+        if self.__cookie_protocol:
+            header += '%s%020d%-20.20s%020d%020d' % \
+                    (response.status,
+                     response.value.type_descriptor,
+                     response.iterstate[0],
+                     response.iterstate[1],
+                     response.value.length())
+        else:
+            header += '%s%020d%020d' % \
+                    (response.status,
+                     response.value.type_descriptor,
+                     response.value.length())
+
+        response.encoded[key] = header
+        return header
 
     def send_error(self, reason, status=1, long_reply=False):
         """Utility to send an error reply."""
@@ -569,19 +589,24 @@ class NwsProtocol(object, stateful.StatefulProtocol):
         if isinstance(response.value, str):
             response.value = Value(DIRECT_STRING, response.value)
 
-        # Coerce the status to a 4-digit string
-        response.status = coerce_status(response.status)
-
-        # Send the metadata
-        if self.__metadata_send:
-            self.__send_dictionary(response.metadata)
-
-        # Send the reply itself
-        self.__reply_long_preamble(response)
+        # Send the metadata and preamble, then the value itself.  The data of
+        # a long value may still be being written, so nothing is sent until
+        # it is ready, in case it fails and an error must be sent instead.
         if response.value.is_large():
-            if _DEBUG:
-                log.msg("using long value protocol")
-            producer = FileProducer(response.value, self.transport)
-            self.transport.registerProducer(producer, None)
+            response.value.when_ready(
+                    lambda: self.__send_long_value(response))
         else:
+            self.transport.write(self.__encode_long_reply_header(response))
             self.transport.write(response.value.val())
+
+    def __send_long_value(self, response):
+        """Send a long response whose value's data is ready."""
+        if response.value.is_failed():
+            response.value.access_complete()
+            self.send_error('Value data could not be written.',
+                            long_reply=True)
+            return
+        self.transport.write(self.__encode_long_reply_header(response))
+        if _DEBUG:
+            log.msg("using long value protocol")
+        FileProducer(response.value, self.transport).start()
@@ -20,11 +20,13 @@
 """Miscellaneous utilities and building blocks for the NWS protocol."""
 
 from twisted.python import log
+from nwss.base import new_digest, LongData, CONTENT_INDEX, Response
 import nwss
-import os
 
 _MIN_LONG_VALUE_SIZE = 64
 _BUFFER_SIZE = 16 * 1024
+_LONG_BUFFER_SIZE = 1024 * 1024
+_MAX_PENDING_BYTES = 8 * _LONG_BUFFER_SIZE
 _DEBUG = nwss.config.is_debug_enabled('NWS:protoutils')
 
 try:
@@ -94,6 +96,131 @@ class WsTracker(object):
         """Clear all workspaces from our list."""
         self.__owned_workspaces.clear()
 
+class LeaseTracker(object):
+    """Leases held by a client connection on the values of task queue
+    variables and the permits of semaphores, so that they can be given up if
+    the connection is lost."""
+
+    def __init__(self):
+        """Create a new, empty lease list."""
+        self.__leases = set()       # (variable, lease)
+
+    def __len__(self):
+        return len(self.__leases)
+
+    def add(self, var, lease):
+        """Record a lease held on a value of a variable."""
+        self.__leases.add((var, lease))
+
+    def remove(self, var, lease):
+        """Forget a lease which has ended."""
+        self.__leases.discard((var, lease))
+
+    def release_all(self):
+        """Give up every lease, so that their values are requeued."""
+        for var, lease in list(self.__leases):
+            var.release(lease)
+        self.__leases.clear()
+
+class WaiterGroup(object):
+    """Group of waiters standing in for one client which is blocked on several
+    variables at once.  Each member of the group is entered into the waiter
+    list of one variable.  The first member to be given a reply withdraws the
+    others from their waiter lists and passes the reply on to the client.
+
+    The group serves as the client's own waiter list, so that if the client's
+    connection is lost, every member of the group is withdrawn.
+    """
+
+    def __init__(self, client):
+        """Create a new waiter group.
+
+          Arguments:
+            client      - client connection for whom the members wait
+        """
+        self.__client = client
+        self.__members = []
+        self.__fired = False
+
+    def __get_fired(self):
+        """Has a member of the group been given a reply?"""
+        return self.__fired
+    fired = property(__get_fired)
+
+    def member(self, ext_name, var_name):
+        """Create a member of the group to wait on a variable.
+
+          Arguments:
+            ext_name    - user-visible name of the workspace
+            var_name    - name of the variable
+        """
+        member = _GroupMember(self, self.__client, ext_name, var_name)
+        self.__members.append(member)
+        return member
+
+    def cancel(self, keep=None):
+        """Withdraw every member of the group, except for keep, from its
+        waiter list."""
+        for member in self.__members:
+            if member is not keep:
+                member.withdraw()
+        self.__members = []
+
+    def fire(self, member):
+        """Note that a member of the group has been given a reply, and
+        withdraw the others."""
+        self.__fired = True
+        self.cancel(member)
+
+    def remove(self, client):
+        #pylint: disable-msg=W0613
+        """Withdraw the whole group.  This is called when the client's
+        connection is lost."""
+        self.cancel()
+
+class _GroupMember(object):
+    """Member of a WaiterGroup, waiting on a single variable.  Implements the
+    parts of the protocol object interface used by the variables."""
+
+    def __init__(self, group, client, ext_name, var_name):
+        self.__group = group
+        self.__client = client
+        self.__names = (ext_name, var_name)
+        self.__waiter_list = None
+        self.transport = client.transport
+        self.leases = getattr(client, 'leases', None)
+
+    def set_blocking_var(self, var, waiter_list):
+        #pylint: disable-msg=W0613
+        """Record the waiter list into which this member has been entered."""
+        self.__waiter_list = waiter_list
+
+    def withdraw(self):
+        """Remove this member from its waiter list, if it is in one."""
+        if self.__waiter_list is not None:
+            try:
+                self.__waiter_list.remove(self)
+            except ValueError:
+                pass
+            self.__waiter_list = None
+
+    def send_long_response(self, response):
+        """Pass a reply on to the client, marking it with the workspace and
+        variable from which it came."""
+        self.__waiter_list = None
+        self.__group.fire(self)
+        metadata = dict(response.metadata)
+        metadata['nwsWorkspace'], metadata['nwsVariable'] = self.__names
+        reply = Response(metadata, response.value)
+        reply.status = response.status
+        reply.iterstate = response.iterstate
+        self.__client.send_long_response(reply)
+
+    def send_error(self, reason, status=1, long_reply=False):
+        """Pass an error on to the client."""
+        self.__waiter_list = None
+        self.__group.fire(self)
+        self.__client.send_error(reason, status, long_reply)
 
 class CountedReceiver(object):
     """Protocol helper class for protocol atoms which consist of a fixed-length
@@ -147,7 +274,11 @@ class CountedReceiverLong(CountedReceiver):
     important difference is that this atom supports saving large data directly
     to a file.  As a result, the 'target' must support an optional boolean
     argument 'long_data'.  If True, the data passed to the target will be a
-    filename, rather than the data itself.
+    LongData object, rather than the data itself.
+
+    The file is written on the I/O thread pool, so the target is called before
+    the writes have completed.  If the writes fall too far behind, the
+    connection is paused until they catch up.
 
     Generally, this class is used from a protocol object as:
 
@@ -165,7 +296,10 @@ class CountedReceiverLong(CountedReceiver):
         self.__target = target
         self.__conn = conn
         self.__file = None
-        self.__filename = None
+        self.__data = None
+        self.__digest = None
+        self.__paused = False
+        self.__failed = False
         self.__remain_length = 0
 
     def start(self, data):
@@ -184,14 +318,16 @@ class CountedReceiverLong(CountedReceiver):
 
             # Set up the streaming transfer
             self.__remain_length = length
+            self.__digest = new_digest()
             tmpfile = self.__conn.new_long_arg_file()
             if tmpfile == None:
                 # Failed to create the file, but still need to ride out the
                 # transfer.
                 self.__file = None
             else:
-                self.__file, self.__filename = tmpfile
-            return self.long_data, min(_BUFFER_SIZE, length)
+                self.__file, filename = tmpfile
+                self.__data = LongData(filename, length)
+            return self.long_data, min(_LONG_BUFFER_SIZE, length)
         else:
             return base_next
 
@@ -202,17 +338,62 @@ class CountedReceiverLong(CountedReceiver):
         """
         self.__remain_length -= len(data)
         if self.__file != None:
-            self.__file.write(data)
+            queue = self.__data.queue
+            queue.submit(self.__write, (data,), self.__written, len(data))
+            if queue.pending_bytes > _MAX_PENDING_BYTES and not self.__paused:
+                self.__paused = True
+                self.__conn.transport.pauseProducing()
             if self.__remain_length <= 0:
-                self.__file.close()
-                return self.__target(self.__filename, long_data=True)
+                queue.submit(self.__close, (), self.__closed)
+                return self.__target(self.__data, long_data=True)
         else:
             if self.__remain_length <= 0:
                 self.__conn.send_error('Failed to read long data from the ' +
                                        'filesystem.')
                 self.__conn.transport.loseConnection()
                 return None
-        return self.long_data, min(_BUFFER_SIZE, self.__remain_length)
+        return self.long_data, min(_LONG_BUFFER_SIZE, self.__remain_length)
+
+    def __write(self, data):
+        """Write a chunk of long data.  Run on an I/O thread."""
+        if self.__failed:
+            return
+        try:
+            self.__file.write(data)
+            self.__digest.update(data)
+        except (IOError, OSError), exc:
+            log.msg('error writing long data: ' + str(exc))
+            self.__failed = True
+
+    def __written(self, ignored):
+        """Completion of a chunk write.  Resume reading if we had paused to
+        let the writes catch up."""
+        #pylint: disable-msg=W0613
+        if self.__paused and \
+                self.__data.queue.pending_bytes <= _MAX_PENDING_BYTES / 2:
+            self.__paused = False
+            self.__conn.transport.resumeProducing()
+
+    def __close(self):
+        """Finish writing long data.  Run on an I/O thread."""
+        try:
+            self.__file.close()
+        except (IOError, OSError), exc:
+            log.msg('error closing long data: ' + str(exc))
+            self.__failed = True
+        return self.__digest.hexdigest()
+
+    def __closed(self, digest):
+        """Completion of a long data upload.  Make the data available to be
+        stored by reference, unless it has already been discarded.  If it
+        couldn't be written, it is marked as failed instead, before anything
+        waiting for it to be ready is run."""
+        if self.__failed:
+            log.msg('long data file %s is incomplete' % self.__data.filename)
+            self.__data.failed = True
+            return
+        self.__data.digest = digest
+        CONTENT_INDEX.add(self.__data)
 
 class NameValueReceiver(object):
     """Specialized protocol helper class for protocol elements consisting of
@@ -372,7 +553,7 @@ class ArgTupleReceiver(ListReceiver):
 
     A callback function will receive a list of all arguments once they have all
     been read in.  The elements of the list will be strings and, for "long"
-    items, tuples of filename and content length.
+    items, LongData objects.
 
     Generally, this class is used from a protocol object as:
 
@@ -403,10 +584,8 @@ class ArgTupleReceiver(ListReceiver):
 
     def next_arg(self, data, long_data=False):
         """Callback to receive each argument.  If long_data is True, the data
-        contains a filename rather than directly containing the data."""
-        if long_data:
-            dlen = os.stat(data).st_size
-            data = (data, dlen)
+        is a LongData object rather than directly containing the data."""
+        #pylint: disable-msg=W0613
         self.__args.append(data)
 
     def finished(self):
@@ -425,11 +604,21 @@ class FileProducer(object):
                transport    - consumer of data
         """
         self.__value = value
-        self.__file = value.get_file()
+        self.__file = None
+        self.__offset = 0
         self.__buffer_size = _BUFFER_SIZE
         self.__transport = transport
         self.__finished = False
 
+    def start(self):
+        """Start sending the value to the consumer, once its data is ready."""
+        self.__value.when_ready(self.__begin)
+
+    def __begin(self):
+        """Map the value's data and register with the consumer."""
+        self.__file = self.__value.get_file()
+        self.__transport.registerProducer(self, None)
+
     def stopProducing(self):
         #pylint: disable-msg=C0103
         """Implementation of IPushProducer.stopProducing method from Twisted.
@@ -439,12 +628,7 @@ class FileProducer(object):
         if not self.__finished:
             if _DEBUG:
                 log.msg('stopProducing unregistering producer')
-            try:
-                self.__file.close()
-            except (KeyboardInterrupt, SystemExit):
-                raise
-            except Exception:               #pylint: disable-msg=W0703
-                pass
+            self.__value.release_file()
             self.__transport.unregisterProducer()
             self.__finished = True
             self.__value.access_complete()
@@ -462,17 +646,14 @@ class FileProducer(object):
         if not self.__finished:
             if _DEBUG:
                 log.msg('resumeProducing reading file')
-            data = self.__file.read(self.__buffer_size)
+            start = self.__offset
+            self.__offset += self.__buffer_size
+            data = self.__file[start:self.__offset]
 
             if not data:
                 if _DEBUG:
                     log.msg('resumeProducing unregistering producer')
-                try:
-                    self.__file.close()
-                except (KeyboardInterrupt, SystemExit):
-                    raise
-                except Exception:           #pylint: disable-msg=W0703
-                    pass
+                self.__value.release_file()
                 self.__transport.unregisterProducer()
                 self.__finished = True
                 self.__value.access_complete()
@@ -497,3 +678,8 @@ def map_proto_generator(data):
     correct protocol form for metadata maps."""
     return [('%04d%s%04d%s' % (len(k), k, len(v), v)) for k, v in data.items()]
 
+def encode_dictionary(data):
+    """Utility which encodes a map in the canonical protocol form, as
+    interpreted by the DictReceiver utility."""
+    return '%04d' % len(data) + ''.join(map_proto_generator(data))
+
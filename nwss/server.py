@@ -26,11 +26,12 @@ Core NetWorkSpaces server.
 import os, traceback
 
 from tempfile import mkstemp
-from twisted.internet import protocol
+from twisted.internet import protocol, reactor
 from twisted.python import log
 
 from nwss.protocol import NwsProtocol
-from nwss.protoutils import WsTracker, WsNameMap
+from nwss.protoutils import WsTracker, WsNameMap, WaiterGroup, LeaseTracker
+from nwss.pyutils import new_list, remove_first
 try:
     from nwss.web import NwsWeb
 except ImportError:
@@ -40,8 +41,9 @@ except ImportError:
 from nwss.base import BadModeException
 from nwss.base import NoSuchVariableException
 from nwss.base import WorkspaceFailure
-from nwss.base import Value
+from nwss.base import Value, CompositeValue, DIRECT_STRING
 from nwss.base import Response
+from nwss.base import CONTENT_INDEX, NO_SUCH_CONTENT
 from nwss.workspace import WorkSpace
 import nwss
 
@@ -71,6 +73,48 @@ def get_int_ws_name(client, ext_name, long_reply):
                           2001, long_reply)
     return int_name
 
+def send_transaction_reply(client, results):
+    """Send the results of a transaction to a client as a single long reply.
+    The value of the reply holds one record for each operation, in order,
+    framed like the preamble of a long reply: a 4-digit status, a 20-digit
+    type descriptor and a 20-digit length, followed by the data of the value
+    found or fetched by the operation, if any.  The values of the results are
+    owned by the reply, and long values are streamed from their files once
+    they are completely written.
+
+      Arguments:
+        client     - the client to whom to reply
+        results    - list of the responses to the operations, or None for
+                     operations which do not return a value
+    """
+    parts = []
+    for result in results:
+        if result is None:
+            parts.append('%04d%020d%020d' % (0, 0, 0))
+            continue
+        value = result.value
+        parts.append('%04d%020d%020d' % (0, value.type_descriptor,
+                                         value.length()))
+        if value.is_large():
+            parts.append(value)
+        else:
+            parts.append(value.val())
+            value.close()
+    if [part for part in parts if isinstance(part, Value)]:
+        # the reply owns the parts, so close them once it has been sent
+        value = CompositeValue(DIRECT_STRING, parts)
+        value.consumed()
+        client.send_long_response(Response(value=value))
+    else:
+        client.send_long_response(Response(value=''.join(parts)))
+
+def close_operation_values(operations):
+    """Close the values to be stored by the operations of a transaction which
+    is not performed."""
+    for _, _, value in operations:
+        if value is not None:
+            value.close()
+
 def plugin_score_function(plug):
     """Plugins are ordered by their PRIORITY class fields, with an omitted
     priority counting as a 0."""
@@ -164,6 +208,83 @@ def create_space(ext_name, metadata):
     return space
 
 
+class WorkspaceReaper(object):
+    """Reclaims the contents of deleted workspaces in bounded slices across
+    reactor iterations, so that deleting a workspace holding millions of
+    values doesn't stall every other client.
+    """
+
+    # number of values to close per reactor iteration
+    SLICE_SIZE = 1000
+
+    def __init__(self):
+        self.__pending = new_list()     # iterators from WorkSpace._detach
+        self.__scheduled = False
+        self.__values_reclaimed = 0
+        self.__workspaces_reclaimed = 0
+
+    def __get_workspaces_pending(self):
+        """Get the number of workspaces whose contents are being reclaimed."""
+        return len(self.__pending)
+    workspaces_pending = property(__get_workspaces_pending)
+
+    def __get_workspaces_reclaimed(self):
+        """Get the number of workspaces fully reclaimed since startup."""
+        return self.__workspaces_reclaimed
+    workspaces_reclaimed = property(__get_workspaces_reclaimed)
+
+    def __get_values_reclaimed(self):
+        """Get the number of values reclaimed since startup."""
+        return self.__values_reclaimed
+    values_reclaimed = property(__get_values_reclaimed)
+
+    def reclaim(self, work):
+        """Queue the contents of a detached workspace for reclamation.
+
+          Arguments:
+            work            - iterator which closes a value per step
+        """
+        self.__pending.append(work)
+        if not self.__scheduled:
+            self.__scheduled = True
+            #pylint: disable-msg=E1101
+            reactor.callLater(0, self.__run_slice)
+
+    def finish(self):
+        """Reclaim everything outstanding right away."""
+        while self.__pending:
+            self.__run(None)
+
+    def __run_slice(self):
+        """Reclaim one slice of values, rescheduling if there's more to do."""
+        self.__scheduled = False
+        self.__run(self.SLICE_SIZE)
+        if self.__pending and not self.__scheduled:
+            self.__scheduled = True
+            #pylint: disable-msg=E1101
+            reactor.callLater(0, self.__run_slice)
+
+    def __run(self, budget):
+        """Reclaim up to 'budget' values (or all of them, if None)."""
+        while self.__pending and (budget is None or budget > 0):
+            work = self.__pending[0]
+            try:
+                while budget is None or budget > 0:
+                    work.next()
+                    self.__values_reclaimed += 1
+                    if budget is not None:
+                        budget -= 1
+                continue
+            except StopIteration:
+                self.__workspaces_reclaimed += 1
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception:
+                #pylint: disable-msg=W0703
+                log.msg('error while reclaiming workspace contents')
+                traceback.print_exc()
+            remove_first(self.__pending)
+
 class NwsService(protocol.ServerFactory):
     #pylint: disable-msg=W0212
     """The NWS Service itself, in suitable form to attach to a Twisted server.
@@ -195,6 +316,8 @@ class NwsService(protocol.ServerFactory):
 
         self.__ws_counter = 1
 
+        self.reaper = WorkspaceReaper()
+
     ####################################################
     # Twisted interface
     ####################################################
@@ -221,6 +344,7 @@ class NwsService(protocol.ServerFactory):
 
         proto.owned_workspaces = WsTracker()
         proto.workspace_names  = WsNameMap()
+        proto.leases           = LeaseTracker()
 
         return proto
 
@@ -256,6 +380,7 @@ class NwsService(protocol.ServerFactory):
 
         # purge all WorkSpace objects, which will remove the temp files
         # currently in use
+        self.reaper.finish()
         for int_name, space in self.spaces.items():
             try:
                 space.purge()
@@ -333,6 +458,18 @@ class NwsService(protocol.ServerFactory):
         client.workspace_names.set(ext_name, int_name)
         return space
 
+    def __retire_space(self, space, metadata):
+        """Shut down a workspace which has been removed from the name maps.
+        Clients waiting on its variables fail at once, but its values are
+        reclaimed incrementally.
+
+          Arguments:
+            space           - the workspace
+            metadata        - metadata passed in from the client
+        """
+        self.reaper.reclaim(space._detach(metadata))
+        space._stopped()
+
     def goodbye(self, client):
         """Signal the closure of a given client connection.
 
@@ -353,6 +490,7 @@ class NwsService(protocol.ServerFactory):
         self.__purge_workspaces_for_client(client)
         if client.blocking:
             client.remove_from_waiter_list()
+        client.leases.release_all()
         try:
             del client.factory.protocols[client.protokey]
             if _DEBUG:
@@ -377,8 +515,7 @@ class NwsService(protocol.ServerFactory):
             try:
                 if not self.spaces[int_name].persistent:
                     space = self.spaces.pop(int_name)
-                    space.purge({})
-                    space._stopped()
+                    self.__retire_space(space, {})
                     try:
                         self.__ext_to_int_ws_name.pop(int_name[0])
                     except KeyError:
@@ -436,6 +573,134 @@ class NwsService(protocol.ServerFactory):
             log.msg('protocol arguments: ' + str(args))
             traceback.print_exc()
 
+    ####### Command handler: "ack"
+    def cmd_ack(self, client, op_name, ext_name, var_name, lease,
+                metadata=None):
+        #pylint: disable-msg=W0613,R0913
+        """NWS Command handler: Acknowledge the completion of a task fetched
+        from a task queue variable, so that it is not requeued.
+
+          Arguments:
+            client          - client connection
+            op_name         - operation name (unused)
+            ext_name        - the workspace name
+            var_name        - the variable name
+            lease           - the lease given with the task
+        """
+        # convert null metadata to empty metadata
+        if metadata is None:
+            metadata = {}
+
+        # find the workspace
+        workspace = self.__find_workspace(client, ext_name)
+        if workspace is None:
+            return
+
+        # acknowledge the task
+        try:
+            workspace._ack_var(var_name, client, lease, metadata)
+            client.send_short_response()
+        except WorkspaceFailure, fail:
+            client.send_error(fail.args[0], fail.status)
+        except Exception, exc:
+            client.send_error('Internal error: "%s".' % str(exc), 2000)
+            raise
+
+    ####### Command handler: "add"
+    def cmd_add(self, client, op_name, ext_name, var_name, delta,
+                metadata=None):
+        #pylint: disable-msg=W0613,R0913
+        """NWS Command handler: Atomically add to a counter variable, replying
+        with the new count.
+
+          Arguments:
+            client          - client connection
+            op_name         - operation name (unused)
+            ext_name        - the workspace name
+            var_name        - the variable name
+            delta           - amount to add (in string form)
+        """
+        # convert null metadata to empty metadata
+        if metadata is None:
+            metadata = {}
+
+        # find the workspace
+        workspace = self.__find_workspace(client, ext_name, long_reply=True)
+        if workspace is None:
+            return
+
+        try:
+            delta = int(delta)
+        except ValueError:
+            client.send_error('Invalid increment "%s".' % delta,
+                              long_reply=True)
+            return
+
+        # perform the add
+        try:
+            response = workspace._add_var(var_name, client, delta, metadata)
+            client.send_long_response(response)
+        except WorkspaceFailure, fail:
+            client.send_error(fail.args[0], fail.status, long_reply=True)
+        except Exception, exc:
+            client.send_error('Internal error: "%s".' % str(exc), 2000,
+                              long_reply=True)
+            raise
+
+    ####### Command handler: "copy var", "move var"
+    def cmd_copy_var(self, client, op_name, ext_name, var_name,
+                     target_ext_name, target_var_name, which='head',
+                     metadata=None):
+        #pylint: disable-msg=R0913
+        """NWS Command handler: Copy or move the head value, or all of the
+        values, of a variable into another variable, which may be in another
+        workspace, replying with the number of values copied or moved.  The
+        values are handled entirely by the server, and long values are shared
+        rather than written again.  Metadata of the operation selects the
+        values to copy as it would for a find.
+
+          Arguments:
+            client          - client connection
+            op_name         - operation name (copy var or move var)
+            ext_name        - the workspace name
+            var_name        - the variable name
+            target_ext_name - the name of the workspace to copy to
+            target_var_name - the name of the variable to copy to
+            which           - 'head' or 'all'
+        """
+        # convert null metadata to empty metadata
+        if metadata is None:
+            metadata = {}
+
+        if which not in ('head', 'all'):
+            client.send_error('Invalid value selection "%s".' % which,
+                              long_reply=True)
+            return
+
+        # find the workspaces
+        workspace = self.__find_workspace(client, ext_name, long_reply=True)
+        if workspace is None:
+            return
+        target = self.__find_workspace(client, target_ext_name,
+                                       long_reply=True)
+        if target is None:
+            return
+
+        # copy the values
+        try:
+            count = workspace._copy_var(var_name, client, target,
+                                        target_var_name,
+                                        op_name == 'move var',
+                                        which == 'all', metadata)
+            client.send_long_response(
+                    Response(value=Value(DIRECT_STRING, str(count))))
+        except WorkspaceFailure, fail:
+            client.send_error(fail.args[0], fail.status, long_reply=True)
+        except Exception, exc:
+            client.send_error('Internal error: "%s".' % str(exc), 2000,
+                              long_reply=True)
+            raise
+
     ####### Command handler: "declare var"
     def cmd_declare_var(self, client, op_name, ext_name, var_name, mode,
                         metadata=None):
@@ -465,6 +730,8 @@ class NwsService(protocol.ServerFactory):
             client.send_short_response()
         except BadModeException:
             client.send_error('Cannot change variable mode to "%s".' % mode)
+        except WorkspaceFailure, fail:
+            client.send_error(fail.args[0], fail.status)
         except Exception, exc:
             client.send_error('Internal error: "%s".' % str(exc), 2000)
             raise
@@ -487,8 +754,7 @@ class NwsService(protocol.ServerFactory):
         try:
             int_name = self.__ext_to_int_ws_name.pop(ext_name)
             space = self.spaces.pop(int_name)
-            space.purge(metadata)
-            space._stopped()
+            self.__retire_space(space, metadata)
             client.workspace_names.remove(ext_name)
             client.owned_workspaces.remove(int_name)
             client.send_short_response()
@@ -545,6 +811,84 @@ class NwsService(protocol.ServerFactory):
         'ifindTry':  (False,  False,  True),
     }
 
+    ####### Command handler: "fetchAny", "fetchAnyTry"
+    def cmd_fetch_any(self, client, op_name, *names, **kwargs):
+        """NWS Command handler: Fetch a value from whichever of several
+        variables, possibly in several workspaces, first has one.  A fetchAny
+        blocks on all of the variables at once, and a fetchAnyTry fails if
+        none of them has a value.  The reply metadata names the workspace and
+        variable from which the value was fetched, as 'nwsWorkspace' and
+        'nwsVariable'.
+
+          Arguments:
+            client          - client connection
+            op_name         - operation name (fetchAny or fetchAnyTry)
+            names           - workspace name and variable name of each
+                              variable, in turn
+        """
+        # convert null metadata to empty metadata
+        metadata = kwargs.get('metadata')
+        if metadata is None:
+            metadata = {}
+
+        pairs = zip(names[0::2], names[1::2])
+        if not pairs or len(names) % 2 != 0:
+            client.send_error('%s requires workspace and variable names.' %
+                              op_name, long_reply=True)
+            return
+        if len(dict.fromkeys(pairs)) != len(pairs):
+            client.send_error('Variable named more than once.',
+                              long_reply=True)
+            return
+
+        # find the workspaces
+        spaces = []
+        for ext_name, _ in pairs:
+            workspace = self.__find_workspace(client, ext_name,
+                                              long_reply=True)
+            if workspace is None:
+                return
+            spaces.append(workspace)
+
+        # Wait on each variable in turn, until one of them has a value.  A
+        # member may also be given a value as it is entered, by a blocked
+        # storer, in which case the group has already replied.  A fetchAnyTry
+        # tries each variable without blocking, passing over those which
+        # have no value.
+        is_blocking = op_name != 'fetchAnyTry'
+        group = WaiterGroup(client)
+        try:
+            for workspace, (ext_name, var_name) in zip(spaces, pairs):
+                member = group.member(ext_name, var_name)
+                try:
+                    response = workspace._fetch_var(var_name, member,
+                                                    is_blocking, ('', -1),
+                                                    metadata)
+                except WorkspaceFailure:
+                    if is_blocking:
+                        raise
+                    continue
+                if group.fired:
+                    return
+                if response is not None:
+                    member.send_long_response(response)
+                    return
+        except WorkspaceFailure, exc:
+            group.cancel()
+            client.send_error(exc.args[0], exc.status, long_reply=True)
+            return
+        except Exception, exc:
+            group.cancel()
+            client.send_error('Internal error: "%s".' % str(exc), 2000,
+                              long_reply=True)
+            raise
+
+        if not is_blocking:
+            group.cancel()
+            client.send_error('no value available', long_reply=True)
+        else:
+            client.set_blocking_var(', '.join(names[1::2]), group)
+
     ####### Command handler: "fetch", "fetchTry", "find", "findTry"
     ####### Command handler: "ifetch", "ifetchTry", "ifind", "ifindTry"
     def cmd_get(self, client, op_name, ext_name, var_name, var_id='',
@@ -804,15 +1148,17 @@ class NwsService(protocol.ServerFactory):
             # HACK: return failure value to be used by web ui
             return -1
 
-    ####### Command handler: "store"
+    ####### Command handler: "store", "storeTry"
     def cmd_store(self, client, op_name, ext_name, var_name, type_desc, data,
                   metadata=None):
-        #pylint: disable-msg=W0613,R0913
+        #pylint: disable-msg=R0913
         """NWS Command handler: Perform a store operation on a given variable.
+        If the variable is full, a store blocks until there is room, and a
+        storeTry fails.
 
           Arguments:
             client          - client connection
-            op_name         - operation name (unused)
+            op_name         - operation name (store or storeTry)
             ext_name        - workspace name
             var_name        - variable name
             type_desc       - value type descriptor (in string form)
@@ -830,14 +1176,138 @@ class NwsService(protocol.ServerFactory):
         # store the value
         try:
             value = Value(int(type_desc), data)
-            workspace._set_var(var_name, client, value, metadata)
-            client.send_short_response()
+            blocked = workspace._set_var(var_name, client, value, metadata,
+                                         op_name != 'storeTry')
+            if not blocked:
+                client.send_short_response()
         except WorkspaceFailure, fail:
             client.send_error(fail.args[0], fail.status)
         except Exception, exc:
             client.send_error('Internal error: "%s".' % str(exc), 2000)
             raise
 
+    ####### Command handler: "storeRef"
+    def cmd_store_ref(self, client, op_name, ext_name, var_name, type_desc,
+                      digest, length, metadata=None):
+        #pylint: disable-msg=W0613,R0913
+        """NWS Command handler: Store a value by reference to content which
+        the server already holds, identified by its SHA-1 digest and length.
+        If the server does not hold the content, the reply has status
+        NO_SUCH_CONTENT, and the client should fall back to a normal store.
+        Only long values are held by reference.
+
+          Arguments:
+            client          - client connection
+            op_name         - operation name (unused)
+            ext_name        - workspace name
+            var_name        - variable name
+            type_desc       - value type descriptor (in string form)
+            digest          - hex SHA-1 digest of the content
+            length          - length of the content (in string form)
+        """
+        # convert null metadata to empty metadata
+        if metadata is None:
+            metadata = {}
+
+        # find the workspace
+        workspace = self.__find_workspace(client, ext_name)
+        if workspace is None:
+            return
+
+        # look up the content
+        try:
+            data = CONTENT_INDEX.lookup(digest, int(length))
+        except ValueError:
+            client.send_error('Invalid content length "%s".' % length)
+            return
+        if data is None:
+            client.send_error('Content is not held by the server.',
+                              NO_SUCH_CONTENT)
+            return
+
+        # store the value
+        try:
+            value = Value(int(type_desc), data)
+            blocked = workspace._set_var(var_name, client, value, metadata)
+            if not blocked:
+                client.send_short_response()
+        except WorkspaceFailure, fail:
+            client.send_error(fail.args[0], fail.status)
+        except Exception, exc:
+            client.send_error('Internal error: "%s".' % str(exc), 2000)
+            raise
+
+    # number of arguments following the variable name of each operation in a
+    # transaction
+    TRANSACTION_OP_ARGS = {
+        'store':        2,      # type descriptor, data
+        'fetchTry':     0,
+        'findTry':      0,
+        'delete var':   0,
+    }
+
+    ####### Command handler: "transaction"
+    def cmd_transaction(self, client, op_name, ext_name, *args, **kwargs):
+        """NWS Command handler: Perform several operations on the variables of
+        a workspace as a single atomic step.  Each operation is given by its
+        name ('store', 'fetchTry', 'findTry' or 'delete var') and a variable
+        name, followed, for a store, by a type descriptor and the data to
+        store.  If any operation would fail, none of them is performed, and
+        the reply is an error naming the operation.  Otherwise, the reply
+        holds the result of every operation (see send_transaction_reply).
+
+          Arguments:
+            client          - client connection
+            op_name         - operation name (unused)
+            ext_name        - workspace name
+            args            - the operations and their arguments, in turn
+        """
+        #pylint: disable-msg=W0613
+        # convert null metadata to empty metadata
+        metadata = kwargs.get('metadata')
+        if metadata is None:
+            metadata = {}
+
+        # parse the operations
+        operations = []
+        pos = 0
+        while pos < len(args):
+            count = self.TRANSACTION_OP_ARGS.get(args[pos])
+            value = None
+            try:
+                if count is None or pos + 2 + count > len(args):
+                    raise WorkspaceFailure('Invalid transaction operation '
+                                           '"%s".' % args[pos])
+                if args[pos] == 'store':
+                    try:
+                        value = Value(int(args[pos + 2]), args[pos + 3])
+                    except ValueError:
+                        raise WorkspaceFailure('Invalid type descriptor '
+                                               '"%s".' % args[pos + 2])
+            except WorkspaceFailure, fail:
+                close_operation_values(operations)
+                client.send_error(fail.args[0], long_reply=True)
+                return
+            operations.append((args[pos], args[pos + 1], value))
+            pos += 2 + count
+
+        # find the workspace
+        workspace = self.__find_workspace(client, ext_name, long_reply=True)
+        if workspace is None:
+            close_operation_values(operations)
+            return
+
+        # perform the operations
+        try:
+            results = workspace._transact(client, operations, metadata)
+            send_transaction_reply(client, results)
+        except WorkspaceFailure, fail:
+            client.send_error(fail.args[0], fail.status, long_reply=True)
+        except Exception, exc:
+            client.send_error('Internal error: "%s".' % str(exc), 2000,
+                              long_reply=True)
+            raise
+
     ####### Command handler: "deadman"
     def cmd_deadman(self, client, op_name, metadata=None):
         #pylint: disable-msg=W0613,R0201
@@ -855,11 +1325,16 @@ class NwsService(protocol.ServerFactory):
 
     ####### Command dispatch map
     OPERATIONS = {
+            'ack':              cmd_ack,
+            'add':              cmd_add,
+            'copy var':         cmd_copy_var,
             'declare var':      cmd_declare_var,
             'delete ws':        cmd_delete_workspace,
             'delete var':       cmd_delete_var,
             'fetch':            cmd_get,
             'fetchTry':         cmd_get,
+            'fetchAny':         cmd_fetch_any,
+            'fetchAnyTry':      cmd_fetch_any,
             'find':             cmd_get,
             'findTry':          cmd_get,
             'ifetch':           cmd_get,
@@ -869,8 +1344,12 @@ class NwsService(protocol.ServerFactory):
             'list vars':        cmd_list_vars,
             'list wss':         cmd_list_workspaces,
             'mktemp ws':        cmd_make_temp_workspace,
+            'move var':         cmd_copy_var,
             'open ws':          cmd_open_workspace,
             'store':            cmd_store,
+            'storeTry':         cmd_store,
+            'storeRef':         cmd_store_ref,
+            'transaction':      cmd_transaction,
             'use ws':           cmd_open_workspace,
             'deadman':          cmd_deadman,
         }
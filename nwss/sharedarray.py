@@ -0,0 +1,180 @@
+#
+# Copyright (c) 2005-2009, REvolution Computing, Inc.
+#
+# NetWorkSpaces is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307
+# USA
+#
+
+"""
+Core NetWorkSpaces server - shared numeric arrays.
+
+A shared array is a fixed-length vector of little-endian float64 or int64
+elements, held in a memory-mapped file in the NWS temporary directory, so
+that a slice can be read or updated without touching the rest of it.  If
+NumPy is available, an elementwise add is applied in place with a single
+vectorized operation; otherwise, it is applied one element at a time.
+"""
+
+import os, mmap, struct
+from tempfile import mkstemp
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    #pylint: disable-msg=C0103
+
+import nwss
+
+__all__ = ['SharedArray', 'DTYPES']
+
+# struct format character of each supported element type
+DTYPES = {'float64': 'd', 'int64': 'q'}
+
+# size in bytes of each element
+_ITEM_SIZE = 8
+
+# number of elements added at a time, without NumPy
+_CHUNK_SIZE = 4096
+
+def _wrap_int64(number):
+    """Wrap an integer to the range of an int64, as NumPy addition does."""
+    return (number + 2 ** 63) % 2 ** 64 - 2 ** 63
+
+class SharedArray(object):
+    """Fixed-length numeric array backed by a memory-mapped temporary file.
+    Elements are initially zero.  Slices are given as an element offset and
+    a packed vector of elements, as read or written by the clients.
+    """
+
+    def __init__(self, dtype, length):
+        """Create a shared array.
+
+          Arguments:
+            dtype           - one of the names in DTYPES
+            length          - number of elements, at least one
+        """
+        assert dtype in DTYPES, 'unknown element type ' + dtype
+        assert length > 0, 'array length must be positive'
+        self.__dtype = dtype
+        self.__length = length
+        filedesc, self.__filename = mkstemp(prefix='__nwss', suffix='.arr',
+                                            dir=nwss.config.tmpdir)
+        try:
+            os.ftruncate(filedesc, length * _ITEM_SIZE)
+            self.__mapping = mmap.mmap(filedesc, length * _ITEM_SIZE)
+        except:
+            os.close(filedesc)
+            os.remove(self.__filename)
+            raise
+        os.close(filedesc)
+
+    def __get_dtype(self):
+        """Get the name of the element type."""
+        return self.__dtype
+    dtype = property(__get_dtype)
+
+    def __len__(self):
+        return self.__length
+
+    def check(self, start, count):
+        """Check that a slice lies within the array, raising ValueError if
+        not.
+
+          Arguments:
+            start           - offset of the first element
+            count           - number of elements
+        """
+        if start < 0 or count < 0 or start + count > self.__length:
+            raise ValueError('elements %d to %d are outside an array of %d '
+                             'elements' % (start, start + count, self.__length))
+
+    def __check_data(self, start, data):
+        """Check that packed data can be written at an offset, returning the
+        number of elements it holds."""
+        if len(data) % _ITEM_SIZE != 0:
+            raise ValueError('vector of %d bytes is not a whole number of '
+                             '%s values' % (len(data), self.__dtype))
+        count = len(data) / _ITEM_SIZE
+        self.check(start, count)
+        return count
+
+    def read(self, start, count):
+        """Read a slice of the array, as packed data.
+
+          Arguments:
+            start           - offset of the first element
+            count           - number of elements
+        """
+        self.check(start, count)
+        return self.__mapping[start * _ITEM_SIZE:(start + count) * _ITEM_SIZE]
+
+    def write(self, start, data):
+        """Overwrite a slice of the array with packed data.
+
+          Arguments:
+            start           - offset of the first element
+            data            - packed elements to write
+        """
+        count = self.__check_data(start, data)
+        self.__mapping[start * _ITEM_SIZE:(start + count) * _ITEM_SIZE] = data
+
+    def add(self, start, data):
+        """Add packed data to a slice of the array, elementwise.
+
+          Arguments:
+            start           - offset of the first element
+            data            - packed elements to add
+        """
+        count = self.__check_data(start, data)
+        if numpy is not None:
+            self.__add_numpy(start, count, data)
+        else:
+            self.__add_python(start, count, data)
+
+    def __add_numpy(self, start, count, data):
+        """Add to a slice in place using a vectorized NumPy operation."""
+        dtype = '<' + self.__dtype[0] + '8'
+        target = numpy.ndarray((count,), dtype=dtype, buffer=self.__mapping,
+                               offset=start * _ITEM_SIZE)
+        target += numpy.frombuffer(data, dtype=dtype)
+
+    def __add_python(self, start, count, data):
+        """Add to a slice a chunk of elements at a time."""
+        code = DTYPES[self.__dtype]
+        mapping = self.__mapping
+        for first in xrange(0, count, _CHUNK_SIZE):
+            num = min(_CHUNK_SIZE, count - first)
+            layout = '<%d%s' % (num, code)
+            lower = (start + first) * _ITEM_SIZE
+            upper = lower + num * _ITEM_SIZE
+            offset = first * _ITEM_SIZE
+            totals = map(lambda x, y: x + y,
+                         struct.unpack(layout, mapping[lower:upper]),
+                         struct.unpack(layout,
+                                       data[offset:offset + num * _ITEM_SIZE]))
+            if code == 'q':
+                totals = map(_wrap_int64, totals)
+            mapping[lower:upper] = struct.pack(layout, *totals)
+
+    def close(self):
+        """Unmap the array and remove its file."""
+        if self.__mapping is None:
+            return
+        self.__mapping.close()
+        self.__mapping = None
+        try:
+            os.remove(self.__filename)
+        except OSError:
+            pass
@@ -23,21 +23,214 @@ Core NetWorkSpaces server - variables implementation.
 
 from __future__ import generators
 import time
+from collections import deque
+from heapq import heappush, heappop
+from twisted.internet import reactor
 from twisted.python import log
 
-from nwss.pyutils import new_list, remove_first, clear_list
+from nwss.indexedqueue import IndexedQueue, PackedQueue
 from nwss.base import BadModeException
-from nwss.base import WorkspaceFailure
-from nwss.base import Response, Value
+from nwss.base import WorkspaceFailure, VARIABLE_FULL, CONDITION_FAILED
+from nwss.base import NOT_READY
+from nwss.base import Response, Value, DIRECT_STRING, PACKED_FLOAT64
+from nwss.base import PACKED_INT64
+from nwss.aggregate import Accumulator, AGGREGATES, pack_vector
+from nwss.sharedarray import SharedArray, DTYPES
 import nwss
 
 _DEBUG = nwss.config.is_debug_enabled('NWS:stdvars')
 
+# prefix of the metadata keys of a fetch or find which select the values it
+# may return by their metadata
+MATCH_PREFIX = 'nwsMatch:'
+
+# number of stale entries allowed in the metadata indexes of a FIFO, beyond
+# one per value held, before they are discarded to be rebuilt
+_INDEX_SLACK = 1024
+
+def get_match(metadata):
+    """Get the metadata which a selective fetch or find requires of the value
+    it returns, or None if the operation is not selective.
+
+      Arguments:
+        metadata -- metadata of the fetch or find
+    """
+    match = None
+    for key, wanted in metadata.items():
+        if key.startswith(MATCH_PREFIX):
+            if match is None:
+                match = {}
+            match[key[len(MATCH_PREFIX):]] = wanted
+    return match
+
+def matches(metadata, match):
+    """Check if the metadata of a value has all of the required entries.
+
+      Arguments:
+        metadata -- metadata stored with the value
+        match -- metadata required, as returned by get_match
+    """
+    for key, wanted in match.items():
+        if metadata.get(key) != wanted:
+            return False
+    return True
+
+def get_visible_time(metadata):
+    """Get the time at which a delayed store makes its value visible, from
+    its 'nwsDelay' or 'nwsVisibleAt' metadata, or None if it isn't delayed.
+
+      Arguments:
+        metadata -- metadata of the store
+    """
+    delay = metadata.get('nwsDelay')
+    visible_at = metadata.get('nwsVisibleAt')
+    if delay is None and visible_at is None:
+        return None
+    if delay is not None and visible_at is not None:
+        raise WorkspaceFailure('A store may not have both nwsDelay and '
+                               'nwsVisibleAt.')
+    try:
+        if delay is not None:
+            seconds = float(delay)
+            if not seconds >= 0:
+                raise ValueError(delay)
+            return time.time() + seconds
+        return float(visible_at)
+    except ValueError:
+        raise WorkspaceFailure('Invalid store delay: %s.' %
+                               (delay if visible_at is None else visible_at))
+
+class StorerList(object):
+    """Waiter list of clients whose stores are blocked because a variable is
+    full, along with the value and metadata each of them is storing.
+    """
+
+    def __init__(self):
+        self.__clients = []
+        self.__stores = {}          # client -> (value, metadata)
+
+    def __len__(self):
+        return len(self.__clients)
+
+    def __iter__(self):
+        return iter(self.__clients)
+
+    def append(self, client, value, metadata):
+        """Add a client to the end of the list."""
+        self.__clients.append(client)
+        self.__stores[client] = (value, metadata)
+
+    def pop(self):
+        """Remove the first client from the list, returning a (client, value,
+        metadata) tuple."""
+        client = self.__clients.pop(0)
+        value, metadata = self.__stores.pop(client)
+        return client, value, metadata
+
+    def pop_all(self):
+        """Remove every client from the list, returning a list of (client,
+        value, metadata) tuples."""
+        return [self.pop() for _ in xrange(len(self.__clients))]
+
+    def pop_match(self, match):
+        """Remove the first client storing a value whose metadata has all of
+        the required entries, returning a (client, value, metadata) tuple, or
+        None if there is none."""
+        for pos, client in enumerate(self.__clients):
+            value, metadata = self.__stores[client]
+            if matches(metadata, match):
+                del self.__clients[pos]
+                del self.__stores[client]
+                return client, value, metadata
+        return None
+
+    def remove(self, client):
+        """Remove a client from the list, discarding its store.  This is
+        called when the client's connection is lost."""
+        self.__clients.remove(client)
+        value, _ = self.__stores.pop(client)
+        value.close()
+
+class MatchWaiterList(object):
+    """Waiter list of clients blocked in a selective fetch or find, along with
+    the metadata each of them requires.
+    """
+
+    def __init__(self):
+        self.__clients = []
+        self.__matches = {}         # client -> required metadata
+
+    def __len__(self):
+        return len(self.__clients)
+
+    def __iter__(self):
+        return iter(self.__clients)
+
+    def append(self, client, match):
+        """Add a client to the end of the list."""
+        self.__clients.append(client)
+        self.__matches[client] = match
+
+    def accepts(self, metadata):
+        """Check if any client would accept a value with the given
+        metadata."""
+        for client in self.__clients:
+            if matches(metadata, self.__matches[client]):
+                return True
+        return False
+
+    def count_accepting(self, metadata):
+        """Count the clients which would accept a value with the given
+        metadata."""
+        count = 0
+        for client in self.__clients:
+            if matches(metadata, self.__matches[client]):
+                count += 1
+        return count
+
+    def pop_first(self, metadata):
+        """Remove and return the first client which would accept a value with
+        the given metadata, or None if there is none."""
+        for pos, client in enumerate(self.__clients):
+            if matches(metadata, self.__matches[client]):
+                del self.__clients[pos]
+                del self.__matches[client]
+                return client
+        return None
+
+    def pop_all(self, metadata=None):
+        """Remove and return every client which would accept a value with the
+        given metadata, or every client if no metadata is given."""
+        if metadata is None:
+            found = self.__clients
+            self.__clients = []
+            self.__matches = {}
+            return found
+        found = []
+        for client in self.__clients[:]:
+            if matches(metadata, self.__matches[client]):
+                self.__clients.remove(client)
+                del self.__matches[client]
+                found.append(client)
+        return found
+
+    def remove(self, client):
+        """Remove a client from the list.  This is called when the client's
+        connection is lost."""
+        self.__clients.remove(client)
+        del self.__matches[client]
+
 class BaseVar(object):
     """Base class for variables to simplify implementation of different
     variable types.
+
+    Values stored with a delay are held in a heap ordered by the time at
+    which they become visible, and are then stored as usual, through store.
     """
 
+    # may stores to this variable be delayed?
+    delayable = True
+
     def __init__(self, name):
         """Constructor for BaseVar objects.
 
@@ -48,6 +241,10 @@ class BaseVar(object):
         self.vid = None
         self.fetchers = []
         self.finders = []
+        self.storers = StorerList()
+        self._delayed = []          # (time, sequence, value, metadata)
+        self._delay_sequence = 0
+        self._delay_timer = None
 
     def __get_name(self):
         """Get the name of this container."""
@@ -64,6 +261,59 @@ class BaseVar(object):
         return len(self.finders)
     num_finders = property(__get_num_finders)
 
+    def __get_num_storers(self):
+        """Accessor for storer count property."""
+        return len(self.storers)
+    num_storers = property(__get_num_storers)
+
+    def configure(self, metadata):
+        """Apply the metadata passed when this variable is declared.  Container
+        types which take declaration-time settings should override this.
+
+          Arguments:
+            metadata -- metadata for declare operation
+        """
+        pass
+
+    def waiters_adopted(self):
+        """Called when a variable is declared, once the waiters blocked on it
+        while it was of unknown mode have been moved to this container.
+        Container types which can answer some of them at once should override
+        this."""
+        pass
+
+    def is_full(self, metadata=None):
+        #pylint: disable-msg=R0201,W0613
+        """Check if a store to this variable would be blocked.
+
+          Arguments:
+            metadata -- metadata of the store, if known
+        """
+        return False
+
+    def check_store(self, value, metadata):
+        #pylint: disable-msg=R0201,W0613
+        """Check that a value could be stored into this variable, raising
+        WorkspaceFailure if not.  This is used to reject a delayed store when
+        it is made, rather than when it comes due.  Container types whose
+        stores can be invalid should override this.
+
+          Arguments:
+            value -- the value to store
+            metadata -- metadata of the store
+        """
+        pass
+
+    def num_takers(self, metadata):
+        #pylint: disable-msg=W0613
+        """Get the number of blocked fetchers which would take a value stored
+        with the given metadata.
+
+          Arguments:
+            metadata -- metadata of the store
+        """
+        return len(self.fetchers)
+
     def add_fetcher(self, fetcher):
         """Add a fetcher to this variable.
 
@@ -82,6 +332,88 @@ class BaseVar(object):
         self.finders.append(finder)
         finder.set_blocking_var(self.__name, self.finders)
 
+    def add_storer(self, storer, value, metadata):
+        """Add a storer to this variable, to wait until it has room for the
+        value.
+
+          Arguments:
+            storer -- the storer to add
+            value -- the value being stored
+            metadata -- metadata stored with value
+        """
+        self.storers.append(storer, value, metadata)
+        storer.set_blocking_var(self.__name, self.storers)
+
+    def admit_storers(self):
+        """Complete the stores of blocked storers, for as long as this variable
+        has room for them."""
+        while self.storers and not self.is_full():
+            client, value, metadata = self.storers.pop()
+            if _DEBUG:
+                log.msg('admitting storer session %d' %
+                        client.transport.sessionno)
+            self.store(client, value, metadata)
+            client.send_short_response()
+        if self._delayed and self._delay_timer is None:
+            self.__release_delayed()
+
+    def __get_num_delayed(self):
+        """Get the number of delayed values which are not yet visible."""
+        return len(self._delayed)
+    num_delayed = property(__get_num_delayed)
+
+    def store_later(self, when, value, metadata):
+        """Store a value once a given time has come.
+
+          Arguments:
+            when -- the time at which to store the value
+            value -- the value to store
+            metadata -- metadata stored with value
+        """
+        heappush(self._delayed, (when, self._delay_sequence, value, metadata))
+        self._delay_sequence += 1
+        if self._delayed[0][1] == self._delay_sequence - 1:
+            self.__schedule_delayed()
+
+    def __schedule_delayed(self):
+        """Arrange to store the earliest delayed value when it is due."""
+        if self._delay_timer is not None and self._delay_timer.active():
+            self._delay_timer.cancel()
+        self._delay_timer = None
+        if self._delayed:
+            delay = max(self._delayed[0][0] - time.time(), 0)
+            #pylint: disable-msg=E1101
+            self._delay_timer = reactor.callLater(delay,
+                                                  self.__release_delayed)
+
+    def __release_delayed(self):
+        """Store the delayed values which are due, for as long as this
+        variable has room for them.  Any left over because it is full are
+        stored as fetches make room."""
+        self._delay_timer = None
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            if self.is_full():
+                return
+            _, _, value, metadata = heappop(self._delayed)
+            try:
+                self.store(None, value, metadata)
+            except WorkspaceFailure, fail:
+                log.msg('discarding delayed value for %s: %s' %
+                        (self.__name, fail.args[0]))
+                value.close()
+        self.__schedule_delayed()
+
+    def detach_delayed(self):
+        """Forget the delayed values which are not yet visible, returning
+        them so that they can be closed."""
+        if self._delay_timer is not None and self._delay_timer.active():
+            self._delay_timer.cancel()
+        self._delay_timer = None
+        values = [entry[2] for entry in self._delayed]
+        self._delayed = []
+        return values
+
     def new_value(self, val_index, val, metadata):
         """Announce the appearance of a new value.
 
@@ -95,10 +427,15 @@ class BaseVar(object):
             metadata    - metadata stored with value
         """
 
+        # Nothing to do unless someone is waiting
+        if not self.finders and not self.fetchers:
+            return False
+
         # Not consumed unless there was a fetcher
         consumed = False
 
-        # Build response
+        # Build response.  The same response is sent to every recipient, so
+        # that its encoding is shared between them.
         resp = Response(metadata, val)
         resp.iterstate = (self.vid, val_index)
 
@@ -118,6 +455,8 @@ class BaseVar(object):
             if _DEBUG:
                 log.msg('calling fetcher session %d with val_index %d' %
                         (client.transport.sessionno, val_index))
+            if isinstance(val, Value):
+                val.consumed()
             client.send_long_response(resp)
             consumed = True
 
@@ -138,11 +477,41 @@ class BaseVar(object):
                              client.transport.sessionno)
             client.send_error(reason, long_reply=True)
 
+        for client, value, _ in self.storers.pop_all():
+            if _DEBUG:
+                log.msg('sending error to storer session %d' %
+                             client.transport.sessionno)
+            value.close()
+            client.send_error(reason)
+
         del self.fetchers[:]
         del self.finders[:]
 
+    def detach(self):
+        """Detach the contents of this variable so that they can be reclaimed
+        incrementally, causing all waiters to fail at once.  Returns an
+        iterable of the values which must still be closed.
+
+        Container types which don't hold values can simply rely on this
+        default, which purges the variable.
+        """
+        self.purge()
+        return ()
+
 class Fifo(BaseVar):
-    """Variable class for FIFO-type variables."""
+    """Variable class for FIFO-type variables.
+
+    A fetch or find with 'nwsMatch:<key>' metadata is selective: it only
+    returns a value stored with the given value for each such key, the first
+    of them in the queue.  A selective fetch removes its value from wherever
+    it is in the queue.  The values are found through a hash index of the
+    queue on each key, built the first time it is needed, and kept up to
+    date as values are stored.  Blocked selective fetchers are given a
+    matching value in preference to those which will take any value.
+    """
+
+    # selective fetches and finds are supported
+    selective = True
 
     def __init__(self, name):
         """Constructor for FIFO-type variables.
@@ -152,298 +521,2386 @@ class Fifo(BaseVar):
         """
         BaseVar.__init__(self, name)
 
-        self._contents = new_list()
-        self._metadata = new_list()
+        # values and metadata, addressed by absolute index
+        self._contents = PackedQueue()
+
+        # maximum number of values held, or None if unbounded
+        self._capacity = None
+
+        # indexes of the values by metadata, used by selective operations:
+        # key -> metadata value -> deque of absolute indexes, in order.  The
+        # indexes of values which have since been removed are only dropped
+        # when they are seen.
+        self._indexes = {}
+        self._index_entries = 0
 
-        self._index = 0
+        # blocked selective fetchers and finders
+        self._match_fetchers = MatchWaiterList()
+        self._match_finders = MatchWaiterList()
 
     def __len__(self):
         return len(self._contents)
 
+    def __get_num_fetchers(self):
+        """Accessor for fetcher count property."""
+        return len(self.fetchers) + len(self._match_fetchers)
+    num_fetchers = property(__get_num_fetchers)
+
+    def __get_num_finders(self):
+        """Accessor for finder count property."""
+        return len(self.finders) + len(self._match_finders)
+    num_finders = property(__get_num_finders)
+
+    def num_takers(self, metadata):
+        """Get the number of blocked fetchers which would take a value stored
+        with the given metadata: the plain fetchers, and the selective ones
+        which accept it.
+
+          Arguments:
+            metadata -- metadata of the store
+        """
+        return len(self.fetchers) + \
+                self._match_fetchers.count_accepting(metadata)
+
     def __iter__(self):
         return iter(self._contents)
 
+    def __get_capacity(self):
+        """Get the maximum number of values held, or None if unbounded."""
+        return self._capacity
+    capacity = property(__get_capacity)
+
+    def configure(self, metadata):
+        """Apply the metadata passed when this variable is declared.  The
+        'nwsCapacity' metadata sets the maximum number of values held.
+
+          Arguments:
+            metadata -- metadata for declare operation
+        """
+        capacity = metadata.get('nwsCapacity')
+        if capacity is None:
+            return
+        try:
+            capacity = int(capacity)
+        except ValueError:
+            capacity = 0
+        if capacity <= 0:
+            raise WorkspaceFailure('Invalid capacity "%s".' %
+                                   metadata['nwsCapacity'])
+        self._capacity = capacity
+        self.admit_storers()
+
+    def is_full(self, metadata=None):
+        """Check if a store to this variable would be blocked.  A store to a
+        full queue isn't blocked if a waiting selective fetcher would take the
+        value at once.
+
+          Arguments:
+            metadata -- metadata of the store, if known
+        """
+        if self._capacity is None or len(self._contents) < self._capacity:
+            return False
+        return metadata is None or not self._match_fetchers.accepts(metadata)
+
     def store(self, client, value, metadata):
         #pylint: disable-msg=W0613
         """Handle a store request on this variable.
 
         For a FIFO variable, this adds a value to the tail of the values queue.
+        If the queue is full, the store is blocked until a value is fetched.
 
           Arguments:
             client -- client for whom to perform store
             value  -- value to store in FIFO
         """
+        if self.is_full(metadata):
+            self.add_storer(client, value, metadata)
+            return True
+
         # compute the index of this incoming value in case we
         # need to give it to any waiting clients.
         # it isn't used for anything else
-        val_index = self._index + len(self._contents)
+        val_index = self._contents.end_index
 
         if self.new_value(val_index, value, metadata):
-            # value was consumed, so increment index
-            self._index += 1
+            # value was consumed, so use up its index
+            self._contents.skip()
         else:
             # value wasn't consumed, so save it
-            self._contents.append(value)
-            self._metadata.append(metadata)
+            self._contents.append(value, metadata)
+            self.__index_value(val_index, metadata)
+
+    def new_value(self, val_index, val, metadata):
+        """Announce the appearance of a new value.  Blocked selective finders
+        which would accept the value are given it, and the first blocked
+        selective fetcher which would accept it consumes it.  Otherwise, it is
+        announced to the other waiters as usual.
+
+          Arguments:
+            val_index   - index of value being stored
+            val         - newly stored value
+            metadata    - metadata stored with value
+        """
+        if self._match_finders or self._match_fetchers:
+            resp = Response(metadata, val)
+            resp.iterstate = (self.vid, val_index)
+            for client in self._match_finders.pop_all(metadata):
+                client.send_long_response(resp)
+            client = self._match_fetchers.pop_first(metadata)
+            if client is not None:
+                for finder in self.finders:
+                    finder.send_long_response(resp)
+                del self.finders[:]
+                val.consumed()
+                client.send_long_response(resp)
+                return True
+        return BaseVar.new_value(self, val_index, val, metadata)
+
+    def __index_value(self, index, metadata):
+        """Add a newly saved value to the metadata indexes."""
+        if not self._indexes or not metadata:
+            return
+        for key, index_map in self._indexes.items():
+            if key in metadata:
+                bucket = index_map.get(metadata[key])
+                if bucket is None:
+                    bucket = index_map[metadata[key]] = deque()
+                bucket.append(index)
+                self._index_entries += 1
+        if self._index_entries > 2 * len(self._contents) + _INDEX_SLACK:
+            # too many of the entries are stale; rebuild when next needed
+            self._indexes = {}
+            self._index_entries = 0
+
+    def __get_index(self, key):
+        """Get the metadata index on a key, building it if necessary."""
+        index_map = self._indexes.get(key)
+        if index_map is None:
+            index_map = self._indexes[key] = {}
+            for index, metadata in self._contents.metadata_items():
+                if key in metadata:
+                    bucket = index_map.get(metadata[key])
+                    if bucket is None:
+                        bucket = index_map[metadata[key]] = deque()
+                    bucket.append(index)
+                    self._index_entries += 1
+        return index_map
+
+    def __find_match(self, match):
+        """Find the first value in the queue with the required metadata,
+        returning its index, or None if there is none."""
+        best = None
+        for key, wanted in match.items():
+            index_map = self.__get_index(key)
+            bucket = index_map.get(wanted)
+            while bucket and bucket[0] not in self._contents:
+                bucket.popleft()
+                self._index_entries -= 1
+            if not bucket:
+                index_map.pop(wanted, None)
+                return None
+            if best is None or len(bucket) < len(best):
+                best = bucket
+
+        for index in best:
+            if index in self._contents and \
+                    matches(self._contents.get(index)[1], match):
+                return index
+        return None
+
+    def __get_match(self, client, blocking, val_index, match, remove):
+        """Handle a selective fetch or find request on this variable."""
+        if val_index >= 0:
+            raise WorkspaceFailure('ifetch* and ifind* cannot select values '
+                                   'by metadata')
+        index = self.__find_match(match)
+        if index is not None:
+            if remove:
+                value, var_metadata = self._contents.remove(index)
+                value.consumed()
+            else:
+                value, var_metadata = self._contents.get(index)
+            response = Response(var_metadata, value)
+            response.iterstate = (self.vid, index)
+            if remove:
+                self.admit_storers()
+            return response
+        if not blocking:
+            raise WorkspaceFailure('no value available')
+        if remove:
+            waiters = self._match_fetchers
+        else:
+            waiters = self._match_finders
+        waiters.append(client, match)
+        client.set_blocking_var(self.name, waiters)
+        if remove:
+            # a store blocked because the queue is full may have a value
+            # which this fetcher will take at once
+            storer = self.storers.pop_match(match)
+            if storer is not None:
+                storer_client, value, var_metadata = storer
+                self.store(storer_client, value, var_metadata)
+                storer_client.send_short_response()
+        return None
+
+    def fetch(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a fetch request on this variable.
+
+          Arguments:
+            client     - client for whom to perform fetch
+            blocking   - is this a blocking fetch?
+            val_index  - index of value to fetch (unused here)
+            metadata   - metadata for fetch, selecting the value, if any
+        """
+        match = get_match(metadata)
+        if match is not None:
+            return self.__get_match(client, blocking, val_index, match, True)
+
+        index = self._contents.first_index
+        if val_index + 1 > index:
+            raise WorkspaceFailure(
+                    'ifetch* only supported at beginning of FIFO')
+        try:
+            value, var_metadata = self._contents.popleft()
+            value.consumed()
+            response = Response(var_metadata, value)
+            response.iterstate = (self.vid, index)
+            self.admit_storers()
+            return response
+        except IndexError:
+            if blocking:
+                self.add_fetcher(client)
+                return None
+            else:
+                raise WorkspaceFailure('no value available')
+
+    def find(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a find request on this variable.
+
+          Arguments:
+            client      - client for whom to perform find
+            blocking    - is this a blocking find?
+            val_index   - index of value to find (for iterated find)
+            metadata    - metadata for find, selecting the value, if any
+        """
+        match = get_match(metadata)
+        if match is not None:
+            return self.__get_match(client, blocking, val_index, match, False)
+
+        try:
+            index = self._contents.next_index(
+                    max(val_index + 1, self._contents.first_index))
+            value, var_metadata = self._contents.get(index)
+            response = Response(var_metadata, value)
+            response.iterstate = self.vid, index
+            return response
+
+        except IndexError:
+            if blocking:
+                self.add_finder(client)
+                return None
+            else:
+                raise WorkspaceFailure('no value available')
+
+    def discard(self, value):
+        """Remove a long value whose data couldn't be written, if the queue
+        still holds it.
+
+          Arguments:
+            value -- the value to remove
+        """
+        index = self._contents.index_of(value)
+        if index is not None:
+            self._contents.remove(index)
+            value.close()
+            self.admit_storers()
+
+    def fail_waiters(self, reason):
+        """Cause all waiters to fail, typically because this variable has been
+        destroyed."""
+        self.fetchers.extend(self._match_fetchers.pop_all())
+        self.finders.extend(self._match_finders.pop_all())
+        BaseVar.fail_waiters(self, reason)
+
+    def detach(self):
+        """Detach the contents of this variable, causing any clients waiting
+        for a value to fail.
+        """
+        self.fail_waiters('Variable purged.')
+        contents = self._contents
+        self._contents = PackedQueue()
+        self._indexes = {}
+        self._index_entries = 0
+        return contents
+
+    def purge(self):
+        """Purge this variable from the workspace, causing any clients waiting
+        for a value to fail.
+        """
+        for val in self.detach():
+            if isinstance(val, Value):
+                val.close()
+
+class Ring(Fifo):
+    """Variable class for ring-type variables.  A ring is a FIFO which holds
+    a fixed number of values, given by the 'nwsCapacity' metadata when it is
+    declared.  Storing into a full ring discards its oldest value, rather
+    than blocking.
+    """
+
+    # number of values held by a ring declared without a capacity
+    DEFAULT_CAPACITY = 1000
+
+    def __init__(self, name):
+        """Constructor for ring-type variables.
+
+          Arguments:
+            name         - user-readable name for var
+        """
+        Fifo.__init__(self, name)
+        self._capacity = self.DEFAULT_CAPACITY
+
+    def configure(self, metadata):
+        """Apply the metadata passed when this variable is declared.  The
+        'nwsCapacity' metadata sets the number of values held.
+
+          Arguments:
+            metadata -- metadata for declare operation
+        """
+        Fifo.configure(self, metadata)
+        self._evict()
+
+    def is_full(self, metadata=None):
+        #pylint: disable-msg=W0613
+        """A store to a ring is never blocked."""
+        return False
+
+    def store(self, client, value, metadata):
+        """Handle a store request on this variable.
+
+        For a ring variable, this adds a value to the tail of the values
+        queue, discarding the value at the head if the ring was full.
+
+          Arguments:
+            client -- client for whom to perform store
+            value  -- value to store in ring
+        """
+        Fifo.store(self, client, value, metadata)
+        self._evict()
+
+    def _evict(self):
+        """Discard the oldest values until the ring is within its capacity.
+        Iterated finds skip over the indexes of discarded values."""
+        while len(self._contents) > self._capacity:
+            value, _ = self._contents.popleft()
+            value.close()
+
+class Log(BaseVar):
+    """Variable class for append-only log variables.  Each value stored is
+    given the next offset, and stays in the log until the retention policy
+    trims it from the head.  Readers find values without consuming them,
+    typically walking the log from their own offset with ifind; a reader
+    whose next offset has been trimmed resumes at the head.  A find waits for
+    the next value if the reader has caught up.  Fetching is not supported.
+
+    The retention policy is set by the metadata when the variable is
+    declared: 'nwsRetainCount' limits the number of values held,
+    'nwsRetainBytes' their total size, and 'nwsRetainSeconds' their age.
+    """
+
+    def __init__(self, name):
+        """Constructor for log variables.
+
+          Arguments:
+            name         - user-readable name for var
+        """
+        BaseVar.__init__(self, name)
+        self._contents = PackedQueue()
+        self._times = deque()       # time at which each value was stored
+        self._bytes = 0             # total length of the values held
+
+        # retention limits, or None if unlimited
+        self._retain_count = None
+        self._retain_bytes = None
+        self._retain_seconds = None
+        self._timer = None
+
+    def __len__(self):
+        return len(self._contents)
+
+    def __iter__(self):
+        return iter(self._contents)
+
+    def configure(self, metadata):
+        """Apply the metadata passed when this variable is declared, setting
+        the retention policy.
+
+          Arguments:
+            metadata -- metadata for declare operation
+        """
+        limits = {}
+        for key, convert in (('nwsRetainCount', int),
+                             ('nwsRetainBytes', int),
+                             ('nwsRetainSeconds', float)):
+            limit = metadata.get(key)
+            if limit is None:
+                continue
+            try:
+                limits[key] = convert(limit)
+            except ValueError:
+                limits[key] = 0
+            if not limits[key] > 0:
+                raise WorkspaceFailure('Invalid retention limit %s "%s".' %
+                                       (key, limit))
+        self._retain_count = limits.get('nwsRetainCount', self._retain_count)
+        self._retain_bytes = limits.get('nwsRetainBytes', self._retain_bytes)
+        self._retain_seconds = limits.get('nwsRetainSeconds',
+                                          self._retain_seconds)
+        self.__trim()
+
+    def waiters_adopted(self):
+        """Fail the clients which blocked in a fetch before the log was
+        declared, since a log can't be fetched from.  Finders wait for the
+        next value as usual."""
+        for client in self.fetchers:
+            client.send_error('fetch is not supported on a log; use ifind',
+                              long_reply=True)
+        del self.fetchers[:]
+
+    def __trim(self):
+        """Discard values from the head of the log until it is within the
+        retention policy, and arrange to trim it again when the value then
+        at its head becomes too old.  The newest value is kept even if it
+        alone exceeds the byte limit."""
+        contents = self._contents
+        expiry = None
+        if self._retain_seconds is not None:
+            expiry = time.time() - self._retain_seconds
+        while contents and (
+                (self._retain_count is not None and
+                 len(contents) > self._retain_count) or
+                (self._retain_bytes is not None and len(contents) > 1 and
+                 self._bytes > self._retain_bytes) or
+                (expiry is not None and self._times[0] <= expiry)):
+            value, _ = contents.popleft()
+            self._times.popleft()
+            self._bytes -= value.length()
+            value.close()
+
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        if expiry is not None and contents:
+            #pylint: disable-msg=E1101
+            self._timer = reactor.callLater(self._times[0] - expiry,
+                                            self.__trim)
+
+    def store(self, client, value, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a store request on this variable, appending the value to
+        the log.
+
+          Arguments:
+            client -- client for whom to perform store
+            value  -- value to append to the log
+        """
+        index = self._contents.end_index
+        self._contents.append(value, metadata)
+        self._times.append(time.time())
+        self._bytes += value.length()
+
+        # the value stays in the log, so it is only given to finders
+        if self.finders:
+            response = Response(metadata, value)
+            response.iterstate = (self.vid, index)
+            for waiter in self.finders:
+                waiter.send_long_response(response)
+            del self.finders[:]
+        self.__trim()
+
+    def fetch(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613,R0201
+        """Handle a fetch request on this variable, which is not supported.
+
+          Arguments:
+            client     - client for whom to perform fetch
+            blocking   - is this a blocking fetch?
+            val_index  - index of value to fetch (unused here)
+        """
+        raise WorkspaceFailure('fetch is not supported on a log; use ifind')
+
+    def find(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a find request on this variable.
+
+          Arguments:
+            client      - client for whom to perform find
+            blocking    - is this a blocking find?
+            val_index   - offset of the last value found (for iterated find)
+        """
+        try:
+            index = max(val_index + 1, self._contents.first_index)
+            value, var_metadata = self._contents.get(index)
+            response = Response(var_metadata, value)
+            response.iterstate = self.vid, index
+            return response
+        except IndexError:
+            if blocking:
+                self.add_finder(client)
+                return None
+            else:
+                raise WorkspaceFailure('no value available')
+
+    def detach(self):
+        """Detach the contents of this variable, causing any clients waiting
+        for a value to fail.
+        """
+        self.fail_waiters('Variable purged.')
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        contents = self._contents
+        self._contents = PackedQueue()
+        self._times = deque()
+        self._bytes = 0
+        return contents
+
+    def purge(self):
+        """Purge this variable from the workspace, causing any clients waiting
+        for a value to fail.
+        """
+        for val in self.detach():
+            if isinstance(val, Value):
+                val.close()
+
+class Lifo(BaseVar):
+    """Variable class for LIFO-type variables."""
+
+    def __init__(self, name):
+        """Constructor for FIFO-type variables.
+
+          Arguments:
+            name            - user-readable name for var
+        """
+        BaseVar.__init__(self, name)
+        self._contents = PackedQueue()
+
+    def __len__(self):
+        return len(self._contents)
+
+    def __iter__(self):
+        return iter(self._contents)
+
+    def store(self, client, value, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a store request on this variable.
+
+        For a LIFO variable, this adds a value to the tail of the values stack.
+
+          Arguments:
+            client -- client for whom to perform store
+            value  -- value to store in LIFO
+        """
+        if not self.new_value(0, value, metadata):
+            self._contents.append(value, metadata)
+
+    def fetch(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a fetch request on this variable.
+
+          Arguments:
+            client       - client for whom to perform fetch
+            blocking     - is this a blocking fetch?
+            val_index    - index of value to fetch (unused here)
+        """
+        if val_index >= 0:
+            raise WorkspaceFailure('ifetch* not supported on LIFO')
+        try:
+            value, var_metadata = self._contents.pop()
+            value.consumed()
+            return Response(var_metadata, value)
+        except IndexError:
+            if blocking:
+                self.add_fetcher(client)
+                return None
+            else:
+                raise WorkspaceFailure('no value available')
+
+    def find(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a find request on this variable.
+
+          Arguments:
+            client       - client for whom to perform find
+            blocking     - is this a blocking find?
+            val_index    - index of value to find (for iterated find)
+        """
+        if val_index >= 0:
+            raise WorkspaceFailure('ifind* not supported on LIFO')
+        try:
+            # ignore val_index since we don't allow iterators
+            value, var_metadata = self._contents.get(
+                    self._contents.prev_index(self._contents.end_index - 1))
+            return Response(var_metadata, value)
+        except IndexError:
+            if blocking:
+                self.add_finder(client)
+                return None
+            else:
+                raise WorkspaceFailure('no value available')
+
+    def discard(self, value):
+        """Remove a long value whose data couldn't be written, if the stack
+        still holds it.
+
+          Arguments:
+            value -- the value to remove
+        """
+        index = self._contents.index_of(value)
+        if index is not None:
+            self._contents.remove(index)
+            value.close()
+
+    def detach(self):
+        """Detach the contents of this variable, causing any clients waiting
+        for a value to fail.
+        """
+        self.fail_waiters('Variable purged.')
+        contents = self._contents
+        self._contents = PackedQueue()
+        return contents
+
+    def purge(self):
+        """Purge this variable from the workspace, causing any clients waiting
+        for a value to fail.
+        """
+        for val in self.detach():
+            val.close()
+
+class Multi(BaseVar):
+    """Variable class for multi-type variables.  A multi variable is an
+    unordered bag of values: a fetch or find may return any of the values
+    held, and no order is promised.  A fetch takes the value which has been
+    held longest, which is O(1) on the queue, and means that no value is
+    left behind while newer ones are taken.  Blocked fetchers are given new
+    values in the order in which they blocked.
+    """
+
+    def __init__(self, name):
+        """Constructor for multi-type variables.
+
+          Arguments:
+            name            - user-readable name for var
+        """
+        BaseVar.__init__(self, name)
+        self._contents = PackedQueue()
+
+    def __len__(self):
+        return len(self._contents)
+
+    def __iter__(self):
+        return iter(self._contents)
+
+    def store(self, client, value, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a store request on this variable.
+
+        For a multi variable, this gives the value to the first waiting
+        fetcher, or adds it to the bag.
+
+          Arguments:
+            client -- client for whom to perform store
+            value  -- value to store in the bag
+        """
+        if not self.new_value(0, value, metadata):
+            self._contents.append(value, metadata)
+
+    def fetch(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a fetch request on this variable.
+
+          Arguments:
+            client       - client for whom to perform fetch
+            blocking     - is this a blocking fetch?
+            val_index    - index of value to fetch (unused here)
+        """
+        if val_index >= 0:
+            raise WorkspaceFailure('ifetch* not supported on multi')
+        try:
+            value, var_metadata = self._contents.popleft()
+            value.consumed()
+            return Response(var_metadata, value)
+        except IndexError:
+            if blocking:
+                self.add_fetcher(client)
+                return None
+            else:
+                raise WorkspaceFailure('no value available')
+
+    def find(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a find request on this variable.
+
+          Arguments:
+            client       - client for whom to perform find
+            blocking     - is this a blocking find?
+            val_index    - index of value to find (unused here)
+        """
+        if val_index >= 0:
+            raise WorkspaceFailure('ifind* not supported on multi')
+        try:
+            # the value a fetch would take
+            value, var_metadata = self._contents.get(
+                    self._contents.first_index)
+            return Response(var_metadata, value)
+        except IndexError:
+            if blocking:
+                self.add_finder(client)
+                return None
+            else:
+                raise WorkspaceFailure('no value available')
+
+    def discard(self, value):
+        """Remove a long value whose data couldn't be written, if the bag
+        still holds it.
+
+          Arguments:
+            value -- the value to remove
+        """
+        index = self._contents.index_of(value)
+        if index is not None:
+            self._contents.remove(index)
+            value.close()
+
+    def detach(self):
+        """Detach the contents of this variable, causing any clients waiting
+        for a value to fail.
+        """
+        self.fail_waiters('Variable purged.')
+        contents = self._contents
+        self._contents = PackedQueue()
+        return contents
+
+    def purge(self):
+        """Purge this variable from the workspace, causing any clients waiting
+        for a value to fail.
+        """
+        for val in self.detach():
+            val.close()
+
+class Single(BaseVar):
+    """Variable class for Single-type variables.  The value is kept in an
+    IndexedQueue, which holds at most one entry, so that the index of the
+    entry is the version of the value, and is advanced by each new value."""
+
+    def __init__(self, name):
+        """Constructor for Single-type variables.
+
+          Arguments:
+            name            - user-readable name for var
+        """
+        BaseVar.__init__(self, name)
+        self._contents = IndexedQueue()
+
+    def __len__(self):
+        return len(self._contents)
+
+    def __iter__(self):
+        return iter(self._contents)
+
+    def store(self, client, value, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a store request on this variable.
+
+        For a Single variable, this sets the value or feeds it to the first
+        waiting fetcher.
+
+          Arguments:
+            client -- client for whom to perform store
+            value  -- value to store in Single
+        """
+        # compute the index of this incoming value in case we
+        # need to give it to any waiting clients.
+        # it isn't used for anything else
+        val_index = self._contents.end_index
+
+        if self.new_value(val_index, value, metadata):
+            # value was consumed, so use up its index
+            self._contents.skip()
+        else:
+            # value wasn't consumed, so save it in place of the old one
+            if self._contents:
+                self._contents.popleft()[0].close()
+            self._contents.append(value, metadata)
+
+    def check_condition(self, metadata):
+        """Check the condition of a conditional store, raising WorkspaceFailure
+        if it does not hold.  The 'nwsIfVersion' metadata requires the version
+        of the current value, which is the index returned when it is found, to
+        match; the 'nwsIfDigest' metadata requires the hex SHA-1 digest of the
+        current value to match.  Either way, the variable must have a value,
+        and so a successful conditional store always gives the new value the
+        next version.  The digest of a long value is only known once its
+        upload is complete; until then, the store fails with NOT_READY, and
+        may be retried.
+
+          Arguments:
+            metadata -- metadata for store operation
+        """
+        version = metadata.get('nwsIfVersion')
+        digest = metadata.get('nwsIfDigest')
+        if not self._contents:
+            raise WorkspaceFailure('Variable has no value.', CONDITION_FAILED)
+        index = self._contents.first_index
+        if version is not None and version.strip() != str(index):
+            raise WorkspaceFailure('Version %s does not match current '
+                                   'version %d.' % (version, index),
+                                   CONDITION_FAILED)
+        if digest is not None:
+            current = self._contents.get(index)[0].digest()
+            if current is None:
+                raise WorkspaceFailure('Digest of current value is not known '
+                                       'yet.', NOT_READY)
+            if digest.strip().lower() != current:
+                raise WorkspaceFailure('Digest does not match current value.',
+                                       CONDITION_FAILED)
+
+    def fetch(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a fetch request on this variable.
+
+          Arguments:
+            client   -- client for whom to perform fetch
+            blocking -- is this a blocking fetch?
+            val_index -- index of value to fetch (unused here)
+        """
+        try:
+            # only the current value can be fetched
+            index = max(val_index + 1, self._contents.first_index)
+            self._contents.get(index)
+            value, var_metadata = self._contents.popleft()
+            value.consumed()
+            response = Response(var_metadata, value)
+            response.iterstate = (self.vid, index)
+            return response
+        except IndexError:
+            if blocking:
+                self.add_fetcher(client)
+                return None
+            else:
+                raise WorkspaceFailure('no value available')
+
+    def find(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a find request on this variable.
+
+          Arguments:
+            client   -- client for whom to perform find
+            blocking -- is this a blocking find?
+            val_index -- index of value to find (for iterated find)
+        """
+        try:
+            index = max(val_index + 1, self._contents.first_index)
+            value, var_metadata = self._contents.get(index)
+            response = Response(var_metadata, value)
+            response.iterstate = (self.vid, index)
+            return response
+        except IndexError:
+            if blocking:
+                if _DEBUG:
+                    log.msg('queueing up blocking find request')
+                self.add_finder(client)
+                return None
+            else:
+                if _DEBUG:
+                    log.msg('returning unsuccessful reply')
+                raise WorkspaceFailure('no value available')
+
+    def discard(self, value):
+        """Remove a long value whose data couldn't be written, if it is still
+        the value of this variable.
+
+          Arguments:
+            value -- the value to remove
+        """
+        if self._contents and \
+                self._contents.get(self._contents.first_index)[0] is value:
+            self._contents.popleft()
+            value.close()
+
+    def detach(self):
+        """Detach the contents of this variable, causing any clients waiting
+        for a value to fail.  The versions of later values carry on from
+        those of the detached ones.
+        """
+        self.fail_waiters('Variable purged.')
+        contents = self._contents
+        self._contents = IndexedQueue(contents.end_index)
+        return contents
+
+    def purge(self):
+        """Purge this variable from the workspace, causing any clients waiting
+        for a value to fail.
+        """
+        for val in self.detach():
+            val.close()
+
+class Priority(BaseVar):
+    """Variable class for priority queue variables.  Each value is stored with
+    a numeric priority, given by the 'nwsPriority' metadata, and fetches
+    return the value with the highest priority.  Values of equal priority are
+    fetched in the order in which they were stored.
+    """
+
+    def __init__(self, name):
+        """Constructor for priority queue variables.
+
+          Arguments:
+            name            - user-readable name for var
+        """
+        BaseVar.__init__(self, name)
+        self._heap = []             # (-priority, sequence, value, metadata)
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        return iter([entry[2] for entry in sorted(self._heap)])
+
+    def __get_priority(self, metadata):
+        """Get the priority given by the metadata of a store."""
+        priority = metadata.get('nwsPriority', '0')
+        try:
+            priority = float(priority)
+        except ValueError:
+            priority = None
+        if priority is None or priority != priority:
+            raise WorkspaceFailure('Invalid priority "%s".' %
+                                   metadata['nwsPriority'])
+        return priority
+
+    def check_store(self, value, metadata):
+        #pylint: disable-msg=W0613
+        """Check that a store gives a valid priority.
+
+          Arguments:
+            value -- the value to store
+            metadata -- metadata of the store, holding the priority
+        """
+        self.__get_priority(metadata)
+
+    def store(self, client, value, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a store request on this variable.
+
+        For a priority queue variable, this gives the value to the first
+        waiting fetcher, or adds it to the heap.
+
+          Arguments:
+            client -- client for whom to perform store
+            value  -- value to store in the priority queue
+            metadata -- metadata for store, holding the priority
+        """
+        priority = self.__get_priority(metadata)
+        if not self.new_value(0, value, metadata):
+            heappush(self._heap, (-priority, self._sequence, value, metadata))
+            self._sequence += 1
+
+    def fetch(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a fetch request on this variable.
+
+          Arguments:
+            client       - client for whom to perform fetch
+            blocking     - is this a blocking fetch?
+            val_index    - index of value to fetch (unused here)
+        """
+        if val_index >= 0:
+            raise WorkspaceFailure('ifetch* not supported on priority queue')
+        try:
+            _, _, value, var_metadata = heappop(self._heap)
+            value.consumed()
+            return Response(var_metadata, value)
+        except IndexError:
+            if blocking:
+                self.add_fetcher(client)
+                return None
+            else:
+                raise WorkspaceFailure('no value available')
+
+    def find(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a find request on this variable.
+
+          Arguments:
+            client       - client for whom to perform find
+            blocking     - is this a blocking find?
+            val_index    - index of value to find (for iterated find)
+        """
+        if val_index >= 0:
+            raise WorkspaceFailure('ifind* not supported on priority queue')
+        try:
+            _, _, value, var_metadata = self._heap[0]
+            return Response(var_metadata, value)
+        except IndexError:
+            if blocking:
+                self.add_finder(client)
+                return None
+            else:
+                raise WorkspaceFailure('no value available')
+
+    def detach(self):
+        """Detach the contents of this variable, causing any clients waiting
+        for a value to fail.
+        """
+        self.fail_waiters('Variable purged.')
+        contents = [entry[2] for entry in self._heap]
+        self._heap = []
+        return contents
+
+    def purge(self):
+        """Purge this variable from the workspace, causing any clients waiting
+        for a value to fail.
+        """
+        for val in self.detach():
+            val.close()
+
+class Task(BaseVar):
+    """Variable class for task queue variables.  A task queue is a FIFO in
+    which a fetch hands a value to a worker under a lease, identified by the
+    'nwsLease' metadata of the reply.  The worker acknowledges completion of
+    the task with the 'ack' operation.  If the worker's connection is lost,
+    or the lease expires first, the value is requeued at the front of the
+    queue.  Leases expire after the number of seconds given by the
+    'nwsLeaseTime' metadata when the variable is declared, or never.
+
+    Fetches by connections which cannot hold leases, such as those of the web
+    interface, take the value outright.
+    """
+
+    def __init__(self, name):
+        """Constructor for task queue variables.
+
+          Arguments:
+            name            - user-readable name for var
+        """
+        BaseVar.__init__(self, name)
+        self._contents = deque()    # (value, metadata)
+        self._leases = {}           # lease -> (tracker, value, metadata, timer)
+        self._next_lease = 1
+        self._lease_time = None
+
+    def __len__(self):
+        return len(self._contents)
+
+    def __iter__(self):
+        return iter([entry[0] for entry in self._contents])
+
+    def __get_num_leases(self):
+        """Get the number of values which are out on lease."""
+        return len(self._leases)
+    num_leases = property(__get_num_leases)
+
+    def configure(self, metadata):
+        """Apply the metadata passed when this variable is declared.  The
+        'nwsLeaseTime' metadata sets the number of seconds after which a lease
+        expires.
+
+          Arguments:
+            metadata -- metadata for declare operation
+        """
+        lease_time = metadata.get('nwsLeaseTime')
+        if lease_time is None:
+            return
+        try:
+            lease_time = float(lease_time)
+        except ValueError:
+            lease_time = 0.0
+        if not lease_time > 0.0:
+            raise WorkspaceFailure('Invalid lease time "%s".' %
+                                   metadata['nwsLeaseTime'])
+        self._lease_time = lease_time
+
+    def __lease(self, client, value, metadata):
+        """Hand a value to a client under a new lease, returning the response
+        to send to the client."""
+        tracker = getattr(client, 'leases', None)
+        if tracker is None:
+            value.consumed()
+            return Response(metadata, value)
+
+        lease = str(self._next_lease)
+        self._next_lease += 1
+        timer = None
+        if self._lease_time is not None:
+            #pylint: disable-msg=E1101
+            timer = reactor.callLater(self._lease_time, self.__expire, lease)
+        self._leases[lease] = (tracker, value, metadata, timer)
+        tracker.add(self, lease)
+
+        metadata = dict(metadata)
+        metadata['nwsLease'] = lease
+        return Response(metadata, value)
+
+    def __end_lease(self, lease):
+        """Remove a lease, returning its value and metadata."""
+        tracker, value, metadata, timer = self._leases.pop(lease)
+        tracker.remove(self, lease)
+        if timer is not None and timer.active():
+            timer.cancel()
+        return value, metadata
+
+    def __requeue(self, value, metadata):
+        """Put a value whose lease has ended back at the front of the queue,
+        or give it to a waiting fetcher."""
+        if not self.new_value(0, value, metadata):
+            self._contents.appendleft((value, metadata))
+
+    def __expire(self, lease):
+        """Requeue the value of a lease which has expired."""
+        if lease in self._leases:
+            if _DEBUG:
+                log.msg('lease %s on %s expired' % (lease, self.name))
+            self.__requeue(*self.__end_lease(lease))
+
+    def release(self, lease):
+        """Requeue the value of a lease whose holder's connection has been
+        lost.
+
+          Arguments:
+            lease -- the lease to give up
+        """
+        if lease in self._leases:
+            self.__requeue(*self.__end_lease(lease))
+
+    def ack(self, client, lease, metadata):
+        #pylint: disable-msg=W0613
+        """Acknowledge the completion of the task leased to a client,
+        discarding its value.
+
+          Arguments:
+            client -- client which holds the lease
+            lease -- the lease to acknowledge
+            metadata -- metadata for ack operation
+        """
+        try:
+            tracker = self._leases[lease][0]
+        except KeyError:
+            raise WorkspaceFailure('No such lease "%s".' % lease)
+        if tracker is not getattr(client, 'leases', None):
+            raise WorkspaceFailure('Lease "%s" is not held by this client.' %
+                                   lease)
+        value, _ = self.__end_lease(lease)
+        value.close()
+
+    def new_value(self, val_index, val, metadata):
+        """Announce the appearance of a new value.  Finders are given the value
+        as usual, but the first waiting fetcher gets it under a lease.
+
+          Arguments:
+            val_index   - index of value being stored (unused here)
+            val         - newly stored value
+            metadata    - metadata stored with value
+        """
+        if self.finders:
+            resp = Response(metadata, val)
+            resp.iterstate = (self.vid, val_index)
+            for client in self.finders:
+                client.send_long_response(resp)
+            del self.finders[:]
+
+        if not self.fetchers:
+            return False
+        client = self.fetchers.pop(0)
+        resp = self.__lease(client, val, metadata)
+        resp.iterstate = (self.vid, val_index)
+        client.send_long_response(resp)
+        return True
+
+    def store(self, client, value, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a store request on this variable.
+
+        For a task queue variable, this leases the value to the first waiting
+        fetcher, or adds it to the tail of the queue.
+
+          Arguments:
+            client -- client for whom to perform store
+            value  -- value to store in the task queue
+        """
+        if not self.new_value(0, value, metadata):
+            self._contents.append((value, metadata))
+
+    def fetch(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a fetch request on this variable.
+
+          Arguments:
+            client       - client for whom to perform fetch
+            blocking     - is this a blocking fetch?
+            val_index    - index of value to fetch (unused here)
+        """
+        if val_index >= 0:
+            raise WorkspaceFailure('ifetch* not supported on task queue')
+        if self._contents:
+            value, var_metadata = self._contents.popleft()
+            return self.__lease(client, value, var_metadata)
+        if blocking:
+            self.add_fetcher(client)
+            return None
+        raise WorkspaceFailure('no value available')
+
+    def find(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a find request on this variable.
+
+          Arguments:
+            client       - client for whom to perform find
+            blocking     - is this a blocking find?
+            val_index    - index of value to find (unused here)
+        """
+        if val_index >= 0:
+            raise WorkspaceFailure('ifind* not supported on task queue')
+        if self._contents:
+            value, var_metadata = self._contents[0]
+            return Response(var_metadata, value)
+        if blocking:
+            self.add_finder(client)
+            return None
+        raise WorkspaceFailure('no value available')
+
+    def detach(self):
+        """Detach the contents of this variable, causing any clients waiting
+        for a value to fail.  Values out on lease are detached as well, and
+        acknowledging them fails.
+        """
+        self.fail_waiters('Variable purged.')
+        contents = [entry[0] for entry in self._contents]
+        for lease in self._leases.keys():
+            contents.append(self.__end_lease(lease)[0])
+        self._contents = deque()
+        return contents
+
+    def purge(self):
+        """Purge this variable from the workspace, causing any clients waiting
+        for a value to fail.
+        """
+        for val in self.detach():
+            val.close()
+
+class Semaphore(BaseVar):
+    """Variable class for counting semaphores.  A semaphore holds a number of
+    permits, given by the 'nwsPermits' metadata when it is declared, or 1,
+    making it a lock.  A fetch acquires a permit, blocking until one is free,
+    and a fetchTry fails if none is.  The reply names the permit as the
+    'nwsLease' metadata.  A store releases a permit held by the storing
+    client: the one named by 'nwsLease' metadata, or else the one it acquired
+    first.  The value stored is discarded.  A find gives the number of free
+    permits, blocking until there is at least one.
+
+    Permits are released when the connection holding them is lost.  Only
+    connections which can hold leases may acquire permits.
+    """
+
+    # a store releases a permit held by the storing client, so can't be delayed
+    delayable = False
+
+    def __init__(self, name):
+        """Constructor for semaphore variables.
+
+          Arguments:
+            name            - user-readable name for var
+        """
+        BaseVar.__init__(self, name)
+        self._permits = 1
+        self._free = 1
+        self._holders = {}          # lease -> tracker
+        self._next_lease = 1
+
+    def __len__(self):
+        # Keep this in sync with the __iter__ method.  Presently, always
+        # returns 3.  When iterating over this variable, it will yield, in
+        # order:
+        #
+        #  * number of permits
+        #  * number of free permits
+        #  * list of held permits
+        return 3
+
+    def __iter__(self):
+        # Keep __len__ in sync with this method.  Presently, always returns the
+        # following 3 items in order:
+        #
+        #    * number of permits
+        #    * number of free permits
+        #    * list of held permits
+        held = self._holders.keys()
+        held.sort(key=int)
+        held = ' '.join(held) or '<None>'
+
+        def gen():
+            """Helper generator function."""
+            yield 'Number of permits: %d' % self._permits
+            yield 'Free permits:      %d' % max(self._free, 0)
+            yield 'Held permits:      %s' % held
+
+        return gen()
+
+    def configure(self, metadata):
+        """Apply the metadata passed when this variable is declared.  The
+        'nwsPermits' metadata sets the number of permits.  If it is reduced
+        below the number held, no permit is free until enough are released.
+
+          Arguments:
+            metadata -- metadata for declare operation
+        """
+        permits = metadata.get('nwsPermits')
+        if permits is None:
+            return
+        try:
+            permits = int(permits)
+        except ValueError:
+            permits = 0
+        if permits <= 0:
+            raise WorkspaceFailure('Invalid permit count "%s".' %
+                                   metadata['nwsPermits'])
+        self._free += permits - self._permits
+        self._permits = permits
+        self.__grant_waiters()
+
+    def waiters_adopted(self):
+        """Give free permits to the clients which were waiting for this
+        variable to be declared."""
+        self.__grant_waiters()
+
+    def __free_response(self):
+        """Build a response giving the number of free permits."""
+        response = Response(value=Value(DIRECT_STRING, str(self._free)))
+        response.iterstate = (self.vid, 0)
+        return response
+
+    def __acquire(self, client):
+        """Give a free permit to a client, returning the response to send."""
+        tracker = getattr(client, 'leases', None)
+        if tracker is None:
+            raise WorkspaceFailure('This connection cannot hold permits.')
+        lease = str(self._next_lease)
+        self._next_lease += 1
+        self._free -= 1
+        self._holders[lease] = tracker
+        tracker.add(self, lease)
+        response = Response({'nwsLease': lease},
+                            Value(DIRECT_STRING, lease))
+        response.iterstate = (self.vid, 0)
+        return response
+
+    def __grant_waiters(self):
+        """Give free permits to waiting fetchers, and tell the finders how many
+        are left."""
+        while self._free > 0 and self.fetchers:
+            client = self.fetchers.pop(0)
+            try:
+                response = self.__acquire(client)
+            except WorkspaceFailure, fail:
+                client.send_error(fail.args[0], fail.status, long_reply=True)
+                continue
+            client.send_long_response(response)
+        if self._free > 0 and self.finders:
+            response = self.__free_response()
+            for client in self.finders:
+                client.send_long_response(response)
+            del self.finders[:]
+
+    def release(self, lease):
+        """Release a permit whose holder's connection has been lost.
+
+          Arguments:
+            lease -- the permit to release
+        """
+        tracker = self._holders.pop(lease, None)
+        if tracker is not None:
+            tracker.remove(self, lease)
+            self._free += 1
+            self.__grant_waiters()
+
+    def store(self, client, value, metadata):
+        """Handle a store request on this variable, releasing a permit held by
+        the client.
+
+          Arguments:
+            client -- client for whom to perform store
+            value  -- value to store (discarded)
+            metadata -- metadata for store, naming the permit, if any
+        """
+        tracker = getattr(client, 'leases', None)
+        lease = metadata.get('nwsLease')
+        if lease is None:
+            held = [int(held) for held, holder in self._holders.items()
+                    if holder is tracker]
+            if held:
+                lease = str(min(held))
+        if lease is None or tracker is None or \
+                self._holders.get(lease) is not tracker:
+            raise WorkspaceFailure('Permit is not held by this client.')
+        value.close()
+        self.release(lease)
+
+    def fetch(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a fetch request on this variable, acquiring a permit.
+
+          Arguments:
+            client       - client for whom to perform fetch
+            blocking     - is this a blocking fetch?
+            val_index    - index of value to fetch (unused here)
+        """
+        if self._free > 0:
+            return self.__acquire(client)
+        if not blocking:
+            raise WorkspaceFailure('no permit available')
+        if getattr(client, 'leases', None) is None:
+            raise WorkspaceFailure('This connection cannot hold permits.')
+        self.add_fetcher(client)
+        return None
+
+    def find(self, client, blocking, val_index, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a find request on this variable, giving the number of free
+        permits.
+
+          Arguments:
+            client       - client for whom to perform find
+            blocking     - is this a blocking find?
+            val_index    - index of value to find (unused here)
+        """
+        if self._free > 0 or not blocking:
+            return self.__free_response()
+        self.add_finder(client)
+        return None
+
+    def purge(self):
+        """Purge this variable from the workspace, causing any clients waiting
+        for a permit to fail.
+        """
+        self.fail_waiters('Variable purged.')
+        for lease, tracker in self._holders.items():
+            tracker.remove(self, lease)
+        self._holders = {}
+
+class Dictionary(BaseVar):
+    """Variable class for dictionary variables.  Each value is stored under a
+    key, given by the 'nwsKey' metadata, replacing any value already stored
+    under that key.  Fetches and finds which give a key return the value
+    stored under it, and block waiting only for that key.  Fetches and finds
+    which don't give a key return any value, but the same one for both, so
+    that a find followed by a fetch sees the same value.
+    """
+
+    def __init__(self, name):
+        """Constructor for dictionary variables.
+
+          Arguments:
+            name            - user-readable name for var
+        """
+        BaseVar.__init__(self, name)
+        self._values = {}           # key -> (value, metadata)
+        self._any_key = None        # key returned by operations without one
+
+        # Waiters for particular keys.  Waiters which didn't give a key are
+        # in the fetchers and finders lists inherited from BaseVar.
+        self._key_fetchers = {}     # key -> [client]
+        self._key_finders = {}      # key -> [client]
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter([entry[0] for entry in self._values.values()])
+
+    def __get_num_fetchers(self):
+        """Accessor for fetcher count property."""
+        return len(self.fetchers) + \
+                sum([len(waiters) for waiters in self._key_fetchers.values()])
+    num_fetchers = property(__get_num_fetchers)
+
+    def __get_num_finders(self):
+        """Accessor for finder count property."""
+        return len(self.finders) + \
+                sum([len(waiters) for waiters in self._key_finders.values()])
+    num_finders = property(__get_num_finders)
+
+    def __get_any_key(self):
+        """Get the key of the value returned by fetches and finds which don't
+        give a key, raising KeyError if the dictionary is empty.  The key is
+        kept until its value is removed.  A new one is chosen with popitem,
+        which is amortized O(1) as the dictionary is drained, and the entry
+        is put back."""
+        key = self._any_key
+        if key not in self._values:
+            key, entry = self._values.popitem()
+            self._values[key] = entry
+            self._any_key = key
+        return key
+
+    def __add_waiter(self, waiters, key, client):
+        """Add a client to the waiters for a key."""
+        waiter_list = waiters.setdefault(key, [])
+        waiter_list.append(client)
+        client.set_blocking_var(self.name, waiter_list)
+
+    def new_value(self, val_index, val, metadata):
+        """Announce the appearance of a new value.
+
+        The value is distributed to the finders of its key and to the finders
+        which didn't give a key, and to the first fetcher in line, preferring
+        the fetchers of its key.  If a fetcher takes the value, True is
+        returned.
+
+          Arguments:
+            val_index   - index of value being stored (unused here)
+            val         - newly stored value
+            metadata    - metadata stored with value, holding its key
+        """
+        key = metadata.get('nwsKey')
+        finders = self._key_finders.pop(key, [])
+        fetchers = self._key_fetchers.get(key)
+        if fetchers is not None and not fetchers:
+            # emptied by lost connections
+            del self._key_fetchers[key]
+        if not finders and not fetchers and \
+                not self.finders and not self.fetchers:
+            return False
+
+        # The same response is sent to every recipient, so that its encoding
+        # is shared between them.
+        resp = Response(metadata, val)
+        resp.iterstate = (self.vid, val_index)
+
+        for client in finders + self.finders:
+            client.send_long_response(resp)
+        del self.finders[:]
+
+        if fetchers:
+            client = fetchers.pop(0)
+            if not fetchers:
+                del self._key_fetchers[key]
+        elif self.fetchers:
+            client = self.fetchers.pop(0)
+        else:
+            return False
+
+        if isinstance(val, Value):
+            val.consumed()
+        client.send_long_response(resp)
+        return True
+
+    def check_store(self, value, metadata):
+        #pylint: disable-msg=W0613
+        """Check that a store gives a key.
+
+          Arguments:
+            value -- the value to store
+            metadata -- metadata of the store, holding the key
+        """
+        if metadata.get('nwsKey') is None:
+            raise WorkspaceFailure('Store to a dictionary requires a key.')
+
+    def store(self, client, value, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a store request on this variable.
+
+        For a dictionary variable, this gives the value to the first fetcher
+        waiting for its key, or stores it under its key.
+
+          Arguments:
+            client -- client for whom to perform store
+            value  -- value to store in the dictionary
+            metadata -- metadata for store, holding the key
+        """
+        self.check_store(value, metadata)
+        key = metadata['nwsKey']
+        if not self.new_value(0, value, metadata):
+            old = self._values.get(key)
+            if old is not None:
+                old[0].close()
+            self._values[key] = (value, metadata)
+
+    def fetch(self, client, blocking, val_index, metadata):
+        """Handle a fetch request on this variable.
+
+          Arguments:
+            client       - client for whom to perform fetch
+            blocking     - is this a blocking fetch?
+            val_index    - index of value to fetch (unused here)
+            metadata     - metadata for fetch, holding the key, if any
+        """
+        if val_index >= 0:
+            raise WorkspaceFailure('ifetch* not supported on dictionary')
+        key = metadata.get('nwsKey')
+        try:
+            if key is None:
+                key = self.__get_any_key()
+            value, var_metadata = self._values.pop(key)
+        except KeyError:
+            if not blocking:
+                raise WorkspaceFailure('no value available')
+            if key is None:
+                self.add_fetcher(client)
+            else:
+                self.__add_waiter(self._key_fetchers, key, client)
+            return None
+
+        value.consumed()
+        return Response(var_metadata, value)
+
+    def find(self, client, blocking, val_index, metadata):
+        """Handle a find request on this variable.
+
+          Arguments:
+            client       - client for whom to perform find
+            blocking     - is this a blocking find?
+            val_index    - index of value to find (unused here)
+            metadata     - metadata for find, holding the key, if any
+        """
+        if val_index >= 0:
+            raise WorkspaceFailure('ifind* not supported on dictionary')
+        key = metadata.get('nwsKey')
+        try:
+            if key is None:
+                key = self.__get_any_key()
+            value, var_metadata = self._values[key]
+        except KeyError:
+            if not blocking:
+                raise WorkspaceFailure('no value available')
+            if key is None:
+                self.add_finder(client)
+            else:
+                self.__add_waiter(self._key_finders, key, client)
+            return None
+
+        return Response(var_metadata, value)
+
+    def fail_waiters(self, reason):
+        """Cause all waiters to fail, typically because this variable has been
+        destroyed."""
+        for waiters in self._key_fetchers.values():
+            self.fetchers.extend(waiters)
+        for waiters in self._key_finders.values():
+            self.finders.extend(waiters)
+        self._key_fetchers = {}
+        self._key_finders = {}
+        BaseVar.fail_waiters(self, reason)
+
+    def detach(self):
+        """Detach the contents of this variable, causing any clients waiting
+        for a value to fail.
+        """
+        self.fail_waiters('Variable purged.')
+        contents = [entry[0] for entry in self._values.itervalues()]
+        self._values = {}
+        return contents
+
+    def purge(self):
+        """Purge this variable from the workspace, causing any clients waiting
+        for a value to fail.
+        """
+        for val in self.detach():
+            val.close()
+
+class Counter(BaseVar):
+    """Variable class for counter variables.  A counter holds an integer,
+    which starts at 0.  It is updated atomically with the 'add' operation,
+    which replies with the new count.  A store sets the count, a find reads
+    it, and a fetch reads it and resets it to 0.
+
+    A find with 'nwsMinimum' metadata waits until the count is at least the
+    given minimum.
+    """
+
+    def __init__(self, name):
+        """Constructor for counter variables.
+
+          Arguments:
+            name            - user-readable name for var
+        """
+        BaseVar.__init__(self, name)
+        self._count = 0
+
+        # Finders waiting for a minimum count, with the minimums in a heap
+        self._min_finders = {}      # minimum -> [client]
+        self._minimums = []
+
+    def __len__(self):
+        return 1
+
+    def __iter__(self):
+        return iter((str(self._count),))
+
+    def __get_num_finders(self):
+        """Accessor for finder count property."""
+        return len(self.finders) + \
+                sum([len(waiters) for waiters in self._min_finders.values()])
+    num_finders = property(__get_num_finders)
+
+    def __response(self):
+        """Build a response holding the current count."""
+        response = Response(value=Value(DIRECT_STRING, str(self._count)))
+        response.iterstate = (self.vid, 0)
+        return response
+
+    def waiters_adopted(self):
+        """Answer the clients which blocked on this variable before it was
+        declared, since a counter always has a count."""
+        self.__set_count(self._count)
+
+    def __set_count(self, count):
+        """Set the count, and reply to all waiters it satisfies.  Fetchers,
+        which are only left from before the variable was declared, then each
+        read the count and reset it to 0, in turn."""
+        self._count = count
+        satisfied = self.finders[:]
+        del self.finders[:]
+        while self._minimums and self._minimums[0] <= count:
+            satisfied.extend(self._min_finders.pop(heappop(self._minimums)))
+        if satisfied:
+            response = self.__response()
+            for client in satisfied:
+                client.send_long_response(response)
+        fetchers = self.fetchers[:]
+        del self.fetchers[:]
+        for client in fetchers:
+            client.send_long_response(self.__response())
+            self._count = 0
+
+    def add(self, client, delta, metadata):
+        #pylint: disable-msg=W0613
+        """Handle an add request on this variable, adding to the count.
+
+          Arguments:
+            client      - client for whom to perform add
+            delta       - amount to add to the count
+            metadata    - metadata for add operation
+        """
+        self.__set_count(self._count + delta)
+        return self.__response()
+
+    def __get_new_count(self, value):
+        """Get the count given by the value of a store."""
+        if not value.is_large():
+            try:
+                return int(value.val())
+            except ValueError:
+                pass
+        raise WorkspaceFailure('Store to a counter requires an integer.')
+
+    def check_store(self, value, metadata):
+        #pylint: disable-msg=W0613
+        """Check that a store gives an integer.
+
+          Arguments:
+            value -- the new count
+            metadata -- metadata of the store
+        """
+        self.__get_new_count(value)
+
+    def store(self, client, value, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a store request on this variable, setting the count.
+
+          Arguments:
+            client -- client for whom to perform store
+            value  -- the new count, as a string
+        """
+        count = self.__get_new_count(value)
+        value.close()
+        self.__set_count(count)
 
     def fetch(self, client, blocking, val_index, metadata):
         #pylint: disable-msg=W0613
-        """Handle a fetch request on this variable.
+        """Handle a fetch request on this variable, reading the count and
+        resetting it to 0.
 
           Arguments:
-            client     - client for whom to perform fetch
-            blocking   - is this a blocking fetch?
-            val_index  - index of value to fetch (unused here)
+            client       - client for whom to perform fetch
+            blocking     - is this a blocking fetch?
+            val_index    - index of value to fetch (unused here)
         """
-        fetch_location = max(val_index - self._index + 1, 0)
-        if fetch_location > 0:
-            raise WorkspaceFailure(
-                    'ifetch* only supported at beginning of FIFO')
-        try:
-            value = remove_first(self._contents)
-            var_metadata = remove_first(self._metadata)
-            value.consumed()
-            response = Response(var_metadata, value)
-            response.iterstate = (self.vid, self._index)
-            self._index += 1
-            return response
-        except IndexError:
-            if blocking:
-                self.add_fetcher(client)
-                return None
-            else:
-                raise WorkspaceFailure('no value available')
+        response = self.__response()
+        self.__set_count(0)
+        return response
 
     def find(self, client, blocking, val_index, metadata):
         #pylint: disable-msg=W0613
-        """Handle a find request on this variable.
+        """Handle a find request on this variable, reading the count.
 
           Arguments:
-            client      - client for whom to perform find
-            blocking    - is this a blocking find?
-            val_index   - index of value to find (for iterated find)
+            client       - client for whom to perform find
+            blocking     - is this a blocking find?
+            val_index    - index of value to find (unused here)
+            metadata     - metadata for find, holding the minimum, if any
         """
-        try:
-            find_location = max(val_index - self._index + 1, 0)
-            response = Response(self._metadata[find_location],
-                                self._contents[find_location])
-            response.iterstate = self.vid, self._index + find_location
-            return response
-
-        except IndexError:
-            if blocking:
-                self.add_finder(client)
+        minimum = metadata.get('nwsMinimum')
+        if minimum is not None:
+            try:
+                minimum = int(minimum)
+            except ValueError:
+                raise WorkspaceFailure('Invalid minimum "%s".' % minimum)
+            if self._count < minimum:
+                if not blocking:
+                    raise WorkspaceFailure('no value available')
+                waiters = self._min_finders.get(minimum)
+                if waiters is None:
+                    waiters = self._min_finders[minimum] = []
+                    heappush(self._minimums, minimum)
+                waiters.append(client)
+                client.set_blocking_var(self.name, waiters)
                 return None
-            else:
-                raise WorkspaceFailure('no value available')
+        return self.__response()
+
+    def fail_waiters(self, reason):
+        """Cause all waiters to fail, typically because this variable has been
+        destroyed."""
+        for waiters in self._min_finders.values():
+            self.finders.extend(waiters)
+        self._min_finders = {}
+        self._minimums = []
+        BaseVar.fail_waiters(self, reason)
 
     def purge(self):
         """Purge this variable from the workspace, causing any clients waiting
         for a value to fail.
         """
         self.fail_waiters('Variable purged.')
-        for val in self._contents:
-            if isinstance(val, Value):
-                val.close()
 
-        clear_list(self._contents)
-        clear_list(self._metadata)
-
-class Lifo(BaseVar):
-    """Variable class for LIFO-type variables."""
+class Aggregate(BaseVar):
+    """Variable class for aggregate variables.  Values stored into an
+    aggregate are folded into a running aggregate, and a find returns the
+    current aggregate.  A fetch returns it and starts a new one.
+
+    The aggregate is chosen when the variable is declared, by 'nwsAggregate'
+    metadata naming one of sum, min, max, mean, count or quantile (sum by
+    default).  For quantile, 'nwsQuantile' metadata gives the quantile to
+    estimate (0.5 by default).
+
+    Each value stored is either a number, as a decimal string, or a vector of
+    little-endian float64 values, with the PACKED_FLOAT64 descriptor bit set.
+    Vectors are aggregated elementwise, and must all have the same length.
+    The data of a long vector may still be being written when it is stored,
+    and until every stored vector has been folded in, a fetch or find waits
+    for them, or, if it may not block, fails with NOT_READY.
+    """
 
     def __init__(self, name):
-        """Constructor for FIFO-type variables.
+        """Constructor for aggregate variables.
 
           Arguments:
             name            - user-readable name for var
         """
         BaseVar.__init__(self, name)
-        self._contents = []
-        self._metadata = []
+        self._accumulator = Accumulator()
+        self._vectors = None        # are the values vectors or numbers?
+        self._pending = []          # vectors whose data is not folded in yet
 
     def __len__(self):
-        return len(self._contents)
+        return self._accumulator.count and 1 or 0
 
     def __iter__(self):
-        return iter(self._contents)
+        if not self._accumulator.count:
+            return iter(())
+        return iter((self.__result().val(),))
 
-    def store(self, client, value, metadata):
+    def configure(self, metadata):
+        """Apply the metadata passed when this variable is declared.
+
+          Arguments:
+            metadata -- metadata for declare operation
+        """
+        aggregate = metadata.get('nwsAggregate', self._accumulator.aggregate)
+        if aggregate not in AGGREGATES:
+            raise WorkspaceFailure('Invalid aggregate "%s".' % aggregate)
+        quantile = metadata.get('nwsQuantile', self._accumulator.quantile)
+        try:
+            quantile = float(quantile)
+        except ValueError:
+            quantile = -1.0
+        if not 0.0 <= quantile <= 1.0:
+            raise WorkspaceFailure('Invalid quantile "%s".' %
+                                   metadata['nwsQuantile'])
+        if aggregate == self._accumulator.aggregate and \
+                quantile == self._accumulator.quantile:
+            return
+        if self._accumulator.count or self._pending:
+            raise WorkspaceFailure('Cannot change the aggregate of a ' +
+                                   'variable which holds values.')
+        self._accumulator = Accumulator(aggregate, quantile)
+
+    def __result(self):
+        """Get the current aggregate as a value."""
+        result = self._accumulator.result()
+        if self._accumulator.aggregate == 'count':
+            return Value(DIRECT_STRING, str(result))
+        if self._vectors:
+            return Value(PACKED_FLOAT64, pack_vector(result))
+        return Value(DIRECT_STRING, repr(result[0]))
+
+    def __has_result(self):
+        """Check if there is an aggregate to return.  A count is always
+        available, but other aggregates need at least one value."""
+        return self._accumulator.count or \
+                self._accumulator.aggregate == 'count'
+
+    def __response(self):
+        """Build a response holding the current aggregate."""
+        response = Response(value=self.__result())
+        response.iterstate = (self.vid, 0)
+        return response
+
+    def __reset(self):
+        """Start a new aggregate."""
+        self._accumulator = Accumulator(self._accumulator.aggregate,
+                                        self._accumulator.quantile)
+        self._vectors = None
+
+    def __get_addend(self, value):
+        """Check that a value can be folded into the aggregate, raising
+        WorkspaceFailure if not.  Returns whether the value is a vector, and
+        the number it gives if not."""
+        vector = bool(value.type_descriptor & PACKED_FLOAT64)
+        if self._vectors is not None and vector != self._vectors:
+            raise WorkspaceFailure('Cannot mix numbers and vectors in an ' +
+                                   'aggregate.')
+        if vector:
+            try:
+                self._accumulator.check(value.length())
+            except ValueError, exc:
+                raise WorkspaceFailure('Invalid vector: %s.' % exc)
+            return True, None
+        if not value.is_large():
+            try:
+                return False, float(value.val())
+            except ValueError:
+                pass
+        raise WorkspaceFailure('Store to an aggregate requires a number ' +
+                               'or a vector.')
+
+    def check_store(self, value, metadata):
         #pylint: disable-msg=W0613
-        """Handle a store request on this variable.
+        """Check that a store gives a number or a vector which can be folded
+        into the aggregate.
 
-        For a LIFO variable, this adds a value to the tail of the values stack.
+          Arguments:
+            value -- number or vector to aggregate
+            metadata -- metadata of the store
+        """
+        self.__get_addend(value)
+
+    def store(self, client, value, metadata):
+        #pylint: disable-msg=W0613
+        """Handle a store request on this variable, folding the value into
+        the aggregate.
 
           Arguments:
             client -- client for whom to perform store
-            value  -- value to store in LIFO
+            value  -- number or vector to aggregate
         """
-        if not self.new_value(0, value, metadata):
-            self._contents.append(value)
-            self._metadata.append(metadata)
+        try:
+            vector, number = self.__get_addend(value)
+        except WorkspaceFailure:
+            value.close()
+            raise
+        if vector:
+            self._accumulator.reserve(value.length())
+        self._vectors = vector
+
+        if not vector:
+            value.close()
+            self._accumulator.add(pack_vector((number,)))
+            self.__answer_waiters()
+        else:
+            # The data of a long value may still be being written to disk
+            self._pending.append(value)
+            value.when_ready(lambda: self.__add_value(value))
+
+    def __add_value(self, value):
+        """Fold the data of a vector value into the aggregate, unless it was
+        dropped by a purge, and reply to waiters once no other vectors are
+        pending."""
+        if value not in self._pending:
+            return
+        self._pending.remove(value)
+        if value.is_failed():
+            log.msg('ignoring incomplete vector stored to %s' % self.name)
+            value.close()
+        else:
+            if value.is_large():
+                mapping = value.get_file()
+                try:
+                    data = mapping[:value.length()]
+                finally:
+                    value.release_file()
+            else:
+                data = value.val()
+            value.close()
+            self._accumulator.add(data)
+        if not self._pending and self.__has_result():
+            self.__answer_waiters()
+
+    def __answer_waiters(self):
+        """Reply to the clients waiting for the aggregate."""
+        if self.finders or self.fetchers:
+            response = self.__response()
+            for client in self.finders:
+                client.send_long_response(response)
+            del self.finders[:]
+            if self.fetchers:
+                self.fetchers.pop(0).send_long_response(response)
+                self.__reset()
 
     def fetch(self, client, blocking, val_index, metadata):
         #pylint: disable-msg=W0613
-        """Handle a fetch request on this variable.
+        """Handle a fetch request on this variable, returning the aggregate
+        and starting a new one.
 
           Arguments:
             client       - client for whom to perform fetch
             blocking     - is this a blocking fetch?
             val_index    - index of value to fetch (unused here)
         """
-        if val_index >= 0:
-            raise WorkspaceFailure('ifetch* not supported on LIFO')
-        try:
-            value        = self._contents.pop()
-            var_metadata = self._metadata.pop()
-            value.consumed()
-            return Response(var_metadata, value)
-        except IndexError:
-            if blocking:
-                self.add_fetcher(client)
-                return None
-            else:
-                raise WorkspaceFailure('no value available')
+        if self.__has_result() and not self._pending:
+            response = self.__response()
+            self.__reset()
+            return response
+        if blocking:
+            self.add_fetcher(client)
+            return None
+        self.__check_pending()
+        raise WorkspaceFailure('no value available')
 
     def find(self, client, blocking, val_index, metadata):
         #pylint: disable-msg=W0613
-        """Handle a find request on this variable.
+        """Handle a find request on this variable, returning the aggregate.
 
           Arguments:
             client       - client for whom to perform find
             blocking     - is this a blocking find?
-            val_index    - index of value to find (for iterated find)
+            val_index    - index of value to find (unused here)
         """
-        if val_index >= 0:
-            raise WorkspaceFailure('ifind* not supported on LIFO')
-        try:
-            # ignore val_index since we don't allow iterators
-            return Response(self._metadata[-1], self._contents[-1])
-        except IndexError:
-            if blocking:
-                self.add_finder(client)
-                return None
-            else:
-                raise WorkspaceFailure('no value available')
+        if self.__has_result() and not self._pending:
+            return self.__response()
+        if blocking:
+            self.add_finder(client)
+            return None
+        self.__check_pending()
+        raise WorkspaceFailure('no value available')
+
+    def __check_pending(self):
+        """Fail a request which may not block if stored vectors have yet to
+        be folded into the aggregate."""
+        if self._pending:
+            raise WorkspaceFailure('Stored vectors are not yet aggregated.',
+                                   NOT_READY)
 
     def purge(self):
         """Purge this variable from the workspace, causing any clients waiting
         for a value to fail.
         """
         self.fail_waiters('Variable purged.')
-        for val in self._contents:
-            val.close()
-        del self._contents[:]
-        del self._metadata[:]
-
-class Single(BaseVar):
-    """Variable class for Single-type variables."""
+        for value in self._pending:
+            value.close()
+        self._pending = []
+        self.__reset()
+
+class NumArray(BaseVar):
+    """Variable class for shared numeric arrays.  The array is allocated
+    when the variable is declared, with 'nwsLength' metadata giving its
+    number of elements, and 'nwsDtype' their type, float64 (the default) or
+    int64.  Elements are initially zero.
+
+    A find returns a slice of the array as a packed vector, from the element
+    given by 'nwsStart' metadata (0 by default), of 'nwsCount' elements (the
+    rest of the array by default).  A store of a packed vector overwrites the
+    elements from 'nwsStart', or, with 'nwsArrayOp' metadata of 'add', adds
+    to them elementwise.  Updates are applied in the order they are stored.
+    The data of a long update may still be being written when it is stored,
+    and until every stored update has been applied, a find waits for them,
+    or, if it may not block, fails with NOT_READY.  Fetching is not
+    supported.
+    """
 
     def __init__(self, name):
-        """Constructor for Single-type variables.
+        """Constructor for array variables.
 
           Arguments:
             name            - user-readable name for var
         """
         BaseVar.__init__(self, name)
-        self._contents = []
-        self._metadata = None
-        self._index = 0
+        self._array = None
+        self._updates = deque()     # (value, start, operation) to apply
+
+        # Finders waiting for the pending updates, and their slices
+        self._update_finders = []
+        self._finder_slices = {}    # client -> (start, count)
 
     def __len__(self):
-        return self._contents and 1 or 0
+        return self._array is not None and 1 or 0
+
+    def __get_num_finders(self):
+        """Accessor for finder count property."""
+        return len(self.finders) + len(self._update_finders)
+    num_finders = property(__get_num_finders)
 
     def __iter__(self):
-        return iter(self._contents)
+        if self._array is None:
+            return iter(())
+        return iter((self._array.read(0, len(self._array)),))
+
+    def configure(self, metadata):
+        """Apply the metadata passed when this variable is declared,
+        allocating the array.
+
+          Arguments:
+            metadata -- metadata for declare operation
+        """
+        dtype = metadata.get('nwsDtype', 'float64')
+        if dtype not in DTYPES:
+            raise WorkspaceFailure('Invalid array type "%s".' % dtype)
+        length = metadata.get('nwsLength')
+        if length is None:
+            if self._array is None:
+                raise WorkspaceFailure('Array variables must be declared '
+                                       'with nwsLength.')
+            length = len(self._array)
+        try:
+            length = int(length)
+        except ValueError:
+            length = 0
+        if not length > 0:
+            raise WorkspaceFailure('Invalid array length "%s".' %
+                                   metadata['nwsLength'])
+        if self._array is not None:
+            if length != len(self._array) or dtype != self._array.dtype:
+                raise WorkspaceFailure('Cannot change the length or type of '
+                                       'an array.')
+            return
+        try:
+            self._array = SharedArray(dtype, length)
+        except EnvironmentError, exc:
+            raise WorkspaceFailure('Cannot allocate array: %s.' % exc)
+        self.waiters_adopted()
+
+    def waiters_adopted(self):
+        """Answer the clients which were waiting for the array to be
+        allocated.  Finders are given the whole array, and fetchers fail."""
+        if self._array is None:
+            return
+        if self.finders:
+            response = self.__response(0, len(self._array))
+            for client in self.finders:
+                client.send_long_response(response)
+            del self.finders[:]
+        for client in self.fetchers:
+            client.send_error('fetch is not supported on an array; use find',
+                              long_reply=True)
+        del self.fetchers[:]
+
+    def __get_slice(self, metadata):
+        """Get the offset of the first element and the number of elements of
+        the slice selected by the metadata of an operation."""
+        try:
+            start = int(metadata.get('nwsStart', 0))
+            count = metadata.get('nwsCount')
+            if count is None:
+                count = len(self._array) - start
+            else:
+                count = int(count)
+        except ValueError:
+            raise WorkspaceFailure('Invalid array slice.')
+        return start, count
+
+    def __response(self, start, count):
+        """Build a response holding a slice of the array."""
+        if self._array.dtype == 'int64':
+            desc = PACKED_INT64
+        else:
+            desc = PACKED_FLOAT64
+        response = Response(value=Value(desc, self._array.read(start, count)))
+        response.iterstate = (self.vid, 0)
+        return response
+
+    def __get_update(self, value, metadata):
+        """Check that a store gives a valid update of the array, raising
+        WorkspaceFailure if not.  Returns the start of the slice to update,
+        and the operation."""
+        if self._array is None:
+            raise WorkspaceFailure('Array variables must be declared with '
+                                   'nwsLength.')
+        operation = metadata.get('nwsArrayOp', 'set')
+        if operation not in ('set', 'add'):
+            raise WorkspaceFailure('Invalid array operation "%s".' % operation)
+        if self._array.dtype == 'int64':
+            packed, desc = 'int64', PACKED_INT64
+        else:
+            packed, desc = 'float64', PACKED_FLOAT64
+        if not value.type_descriptor & desc:
+            raise WorkspaceFailure('Store to a %s array requires a packed '
+                                   '%s vector.' % (packed, packed))
+        start, _ = self.__get_slice(metadata)
+        if value.length() % 8 != 0:
+            raise WorkspaceFailure('Invalid vector: %d bytes is not a whole '
+                                   'number of elements.' % value.length())
+        try:
+            self._array.check(start, value.length() / 8)
+        except ValueError, exc:
+            raise WorkspaceFailure('Invalid array slice: %s.' % exc)
+        return start, operation
+
+    def check_store(self, value, metadata):
+        """Check that a store gives a valid update of the array.
+
+          Arguments:
+            value -- packed vector of elements
+            metadata -- metadata of the store, giving the slice and operation
+        """
+        self.__get_update(value, metadata)
 
     def store(self, client, value, metadata):
         #pylint: disable-msg=W0613
-        """Handle a store request on this variable.
-
-        For a Single variable, this sets the value or feeds it to the first
-        waiting fetcher.
+        """Handle a store request on this variable, overwriting or adding to
+        a slice of the array.
 
           Arguments:
             client -- client for whom to perform store
-            value  -- value to store in Single
+            value  -- packed vector of elements
         """
-        # compute the index of this incoming value in case we
-        # need to give it to any waiting clients.
-        # it isn't used for anything else
-        val_index = self._index + len(self)
+        start, operation = self.__get_update(value, metadata)
 
-        if self.new_value(val_index, value, metadata):
-            # value was consumed, so increment index
-            self._index += 1
+        # The data of a long value may still be being written to disk, so
+        # updates are queued to apply them in order
+        self._updates.append((value, start, operation))
+        if len(self._updates) == 1:
+            self.__wait_for_update()
+
+    def __wait_for_update(self):
+        """Apply the update at the head of the queue once its data is ready.
+        The update is named in the callback, so a callback left over from
+        before a purge does nothing."""
+        value = self._updates[0][0]
+        value.when_ready(lambda: self.__apply_update(value))
+
+    def __apply_update(self, ready):
+        """Apply the update at the head of the queue, and wait for the data
+        of the next one.
+
+          Arguments:
+            ready -- the value of the update whose data is ready
+        """
+        if not self._updates or self._updates[0][0] is not ready:
+            # the update was detached by a purge
+            return
+        value, start, operation = self._updates.popleft()
+        if value.is_failed():
+            log.msg('ignoring incomplete update stored to %s' % self.name)
+            data = None
+        elif value.is_large():
+            mapping = value.get_file()
+            try:
+                data = mapping[:value.length()]
+            finally:
+                value.release_file()
         else:
-            # value wasn't consumed, so save it
-            if self._contents:
-                self._contents[0].close()
-                self._contents[0] = value
-                self._index += 1
+            data = value.val()
+        value.close()
+        if self._array is not None and data is not None:
+            if operation == 'add':
+                self._array.add(start, data)
             else:
-                self._contents.append(value)
-            self._metadata = metadata
+                self._array.write(start, data)
+        if self._updates:
+            self.__wait_for_update()
+        else:
+            self.__answer_update_finders()
+
+    def __answer_update_finders(self):
+        """Reply to the finders which were waiting for the updates, once
+        they have all been applied."""
+        finders = self._update_finders
+        slices = self._finder_slices
+        self._update_finders = []
+        self._finder_slices = {}
+        for client in finders:
+            start, count = slices[client]
+            client.send_long_response(self.__response(start, count))
 
     def fetch(self, client, blocking, val_index, metadata):
-        #pylint: disable-msg=W0613
-        """Handle a fetch request on this variable.
+        #pylint: disable-msg=W0613,R0201
+        """Handle a fetch request on this variable, which is not supported.
 
           Arguments:
-            client   -- client for whom to perform fetch
-            blocking -- is this a blocking fetch?
-            val_index -- index of value to fetch (unused here)
+            client     - client for whom to perform fetch
+            blocking   - is this a blocking fetch?
+            val_index  - index of value to fetch (unused here)
         """
-        try:
-            fetch_location = max(val_index - self._index + 1, 0)
-            value = self._contents.pop(fetch_location)
-            value.consumed()
-            response = Response(self._metadata, value)
-            response.iterstate = (self.vid, self._index)
-            self._metadata = None
-            self._index += 1
-            return response
-        except IndexError:
-            if blocking:
-                self.add_fetcher(client)
-                return None
-            else:
-                raise WorkspaceFailure('no value available')
+        raise WorkspaceFailure('fetch is not supported on an array; use find')
 
     def find(self, client, blocking, val_index, metadata):
         #pylint: disable-msg=W0613
-        """Handle a find request on this variable.
+        """Handle a find request on this variable, returning a slice of the
+        array.
 
           Arguments:
-            client   -- client for whom to perform find
-            blocking -- is this a blocking find?
-            val_index -- index of value to find (for iterated find)
+            client       - client for whom to perform find
+            blocking     - is this a blocking find?
+            val_index    - index of value to find (unused here)
         """
-        try:
-            find_location = max(val_index - self._index + 1, 0)
-            response = Response(self._metadata, self._contents[find_location])
-            response.iterstate = (self.vid, self._index + find_location)
-            return response
-        except IndexError:
+        if self._array is None:
             if blocking:
-                if _DEBUG:
-                    log.msg('queueing up blocking find request')
                 self.add_finder(client)
                 return None
-            else:
-                if _DEBUG:
-                    log.msg('returning unsuccessful reply')
-                raise WorkspaceFailure('no value available')
+            raise WorkspaceFailure('no value available')
+        start, count = self.__get_slice(metadata)
+        try:
+            self._array.check(start, count)
+        except ValueError, exc:
+            raise WorkspaceFailure('Invalid array slice: %s.' % exc)
+        if self._updates:
+            if not blocking:
+                raise WorkspaceFailure('Stored updates are not yet applied.',
+                                       NOT_READY)
+            self._update_finders.append(client)
+            self._finder_slices[client] = (start, count)
+            client.set_blocking_var(self.name, self._update_finders)
+            return None
+        return self.__response(start, count)
+
+    def fail_waiters(self, reason):
+        """Cause all waiters to fail, typically because this variable has been
+        destroyed."""
+        self.finders.extend(self._update_finders)
+        self._update_finders = []
+        self._finder_slices = {}
+        BaseVar.fail_waiters(self, reason)
+
+    def detach(self):
+        """Detach the contents of this variable, causing any clients waiting
+        for a value to fail.  The array itself is released at once.
+        """
+        self.fail_waiters('Variable purged.')
+        if self._array is not None:
+            self._array.close()
+            self._array = None
+        updates = self._updates
+        self._updates = deque()
+        return [value for value, _, _ in updates]
 
     def purge(self):
         """Purge this variable from the workspace, causing any clients waiting
         for a value to fail.
         """
-        self.fail_waiters('Variable purged.')
-        if self._contents:
-            self._contents[0].close()
-            del self._contents[:]
-        self._metadata = None
+        for val in self.detach():
+            val.close()
 
 class SimpleAttribute(BaseVar):
     """Container type to hold a constant value, ignoring store requests and
@@ -492,6 +2949,18 @@ class SimpleAttribute(BaseVar):
         """
         raise WorkspaceFailure('Store is not supported for this variable.')
 
+    def check_store(self, value, metadata):
+        #pylint: disable-msg=W0613,R0201
+        """Check that a value could be stored into this variable.
+
+        For a constant, a store request is always an error.
+
+          Arguments:
+            value       - value to store
+            metadata    - metadata for store operation
+        """
+        raise WorkspaceFailure('Store is not supported for this variable.')
+
     def fetch(self, client, blocking, val_index, metadata):
         #pylint: disable-msg=W0613
         """Handle a fetch request on this variable.
@@ -523,15 +2992,19 @@ class Barrier(BaseVar):
     """
     Variable type encapsulating the concept of group membership.  A client
     joins the group by storing any value into the variable.  It uses fetch to
-    leave the group.
-
-    XXX: If a client loses its connection without leaving the group, it
-    corrupts the group.  Therefore, I need to add a mechanism that lets clients
-    automatically leave the group when it loses its connection.  This might be
-    implemented via the __client_disconnected method of the NwsService class,
-    or perhaps only via the NwsProtocol class.
+    leave the group.  A blocking find waits at the barrier until every member
+    of the group is waiting there, at which point all of them are released
+    together, and the barrier moves on to its next generation.  The reply
+    gives the number of members, and the generation released as the
+    'nwsGeneration' metadata.
+
+    A client whose connection is lost leaves the group, which may release the
+    members waiting at the barrier.
     """
 
+    # a store joins the storing client to the group, so can't be delayed
+    delayable = False
+
     def __init__(self, name):
         """Create a new barrier variable.
 
@@ -539,26 +3012,32 @@ class Barrier(BaseVar):
             name            - user-readable name for var
         """
         BaseVar.__init__(self, name)
-        self._members = {}
+        self._members = {}          # client -> True
+        self._arrived = {}          # client -> True, for those at the barrier
+        self._generation = 0
 
     def __len__(self):
         # Keep this in sync with the __iter__ method.  Presently, always
-        # returns 3.  When iterating over this variable, it will yield, in
+        # returns 4.  When iterating over this variable, it will yield, in
         # order:
         #
         #  * number of members
         #  * list of members
         #  * number of members at barrier
-        return 3
+        #  * generation
+        return 4
 
     def __iter__(self):
         # Keep __len__ in sync with this method.  Presently, always returns the
-        # following 3 items in order:
+        # following 4 items in order:
         #
         #    * number of members
         #    * list of members
         #    * number of members at barrier
-        members = ' '.join([str(m) for m in self._members])
+        #    * generation
+        members = [m.transport.sessionno for m in self._members]
+        members.sort()
+        members = ' '.join([str(m) for m in members])
         if not members:
             members = '<None>'
 
@@ -566,10 +3045,46 @@ class Barrier(BaseVar):
             """Helper generator function."""
             yield 'Number of members: %d' % len(self._members)
             yield 'List of members:   %s' % members
-            yield 'Number at barrier: %d' % self.num_finders
+            yield 'Number at barrier: %d' % len(self._arrived)
+            yield 'Generation:        %d' % self._generation
 
         return gen()
 
+    def __release_if_complete(self):
+        """If every member is waiting at the barrier, release them all,
+        returning the response sent to them.  Otherwise, return None."""
+        if not self._arrived or len(self._arrived) < len(self._members):
+            return None
+        response = Response({'nwsGeneration': str(self._generation)},
+                            Value(DIRECT_STRING, str(len(self._members))))
+        response.iterstate = (self.vid, self._generation)
+        self._generation += 1
+        self._arrived = {}
+        finders = self.finders[:]
+        del self.finders[:]
+        for client in finders:
+            client.send_long_response(response)
+        return response
+
+    def __leave(self, client):
+        """Remove a client from the group, releasing the others if they are
+        now all at the barrier."""
+        del self._members[client]
+        self._arrived.pop(client, None)
+        tracker = getattr(client, 'leases', None)
+        if tracker is not None:
+            tracker.remove(self, client)
+        self.__release_if_complete()
+
+    def release(self, client):
+        """Remove a client whose connection has been lost from the group.
+
+          Arguments:
+            client -- the departed member
+        """
+        if client in self._members:
+            self.__leave(client)
+
     def store(self, client, value, metadata):
         #pylint: disable-msg=W0613
         """Handle a store request for a Barrier variable.
@@ -581,14 +3096,15 @@ class Barrier(BaseVar):
             client -- client performing the store
             value  -- value to store (unused)
         """
-        num_members = len(self._members)
-        assert self.num_finders == 0 or self.num_finders < num_members
-
-        if client.transport.sessionno in self._members:
+        if client in self._members:
             # Client is trying to join the group a second time
             raise WorkspaceFailure('Client attempting to join barrier ' +
                                    'group, but is already a member')
-        self._members[client.transport.sessionno] = 1
+        self._members[client] = True
+        tracker = getattr(client, 'leases', None)
+        if tracker is not None:
+            tracker.add(self, client)
+        value.close()
 
     def fetch(self, client, blocking, val_index, metadata):
         #pylint: disable-msg=W0613
@@ -601,55 +3117,52 @@ class Barrier(BaseVar):
             blocking -- is this a blocking fetch?
             val_index -- index of value to fetch
         """
-        num_members = len(self._members)
-        assert self.num_finders == 0 or self.num_finders < num_members
-
-        try:
-            del self._members[client.transport.sessionno]
-        except (KeyError, AttributeError):
+        if client not in self._members:
             raise WorkspaceFailure('Client has not joined this barrier group.')
-
-        if self.num_finders >= len(self._members):
-            consumed = self.new_value(0, str(num_members), {})
-            assert not consumed
-
+        self.__leave(client)
         return Response(value='')
 
     def find(self, client, blocking, val_index, metadata):
         #pylint: disable-msg=W0613
-        """Execute a find on this variable.  The effect of this
-        is to check if the fetching client is in the group represented
-        by this Barrier.
+        """Execute a find on this variable.  A blocking find waits at the
+        barrier; a findTry reports how many members are waiting there.
 
           Arguments:
             client   -- client which is performing the find
             blocking -- is this a blocking find?
             val_index -- index of value to find
         """
-        num_members = len(self._members)
-        assert self.num_finders == 0 or self.num_finders < num_members
+        if not blocking:
+            response = Response({'nwsGeneration': str(self._generation)},
+                                '%d out of %d at barrier' %
+                                (len(self._arrived), len(self._members)))
+            response.iterstate = (self.vid, self._generation)
+            return response
 
-        if blocking:
-            if client.transport.sessionno in self._members:
-                if self.num_finders == num_members - 1:
-                    response = Response(value=str(num_members))
-                    consumed = self.new_value(0, response.value, {})
-                    assert not consumed
-                    return response
-                else:
-                    self.add_finder(client)
-                    return None
-            else:
-                # return an error because they're not a member
-                raise WorkspaceFailure('Client has not joined this barrier ' +
-                                       'group.')
-        else:
-            return Response(value='%d out of %d at barrier' % 
-                            (self.num_finders, num_members))
+        if client not in self._members:
+            # return an error because they're not a member
+            raise WorkspaceFailure('Client has not joined this barrier ' +
+                                   'group.')
+        self._arrived[client] = True
+        response = self.__release_if_complete()
+        if response is None:
+            self.add_finder(client)
+        return response
+
+    def fail_waiters(self, reason):
+        """Cause all waiters to fail, typically because this variable has been
+        destroyed."""
+        self._arrived = {}
+        BaseVar.fail_waiters(self, reason)
 
     def purge(self):
         """Handle a purge request on this variable."""
         self.fail_waiters('Variable purged.')
+        for client in self._members:
+            tracker = getattr(client, 'leases', None)
+            if tracker is not None:
+                tracker.remove(self, client)
+        self._members = {}
 
 class Unknown(BaseVar):
     """Placeholder variable class for variables which have not been stored to
@@ -740,9 +3253,18 @@ class Unknown(BaseVar):
         self.fail_waiters('Variable purged.')
 
 CONTAINER_TYPES = {'fifo':      Fifo,
+                   'ring':      Ring,
                    'lifo':      Lifo,
+                   'log':       Log,
                    'single':    Single,
-                   'multi':     Lifo,  # XXX: fix multi
+                   'priority':  Priority,
+                   'task':      Task,
+                   'semaphore': Semaphore,
+                   'dict':      Dictionary,
+                   'counter':   Counter,
+                   'aggregate': Aggregate,
+                   'array':     NumArray,
+                   'multi':     Multi,
                    '__time':    Time,
                    '__barrier': Barrier}
 
@@ -808,17 +3330,35 @@ class Variable(object):
         return self.__container.num_finders
     num_finders = property(__get_num_finders)
 
+    def num_takers(self, metadata):
+        """Get the number of blocked fetchers which would take a value stored
+        into this variable with the given metadata."""
+        return self.__container.num_takers(metadata)
+
+    def __get_num_storers(self):
+        """Get the count of blocked storers in this variable."""
+        return getattr(self.__container, 'num_storers', 0)
+    num_storers = property(__get_num_storers)
+
     def __get_num_values(self):
         """Get the count of values in this variable."""
         return len(self.__container)
     num_values = property(__get_num_values)
 
-    def set_mode(self, mode):
+    def __get_capacity(self):
+        """Get the maximum number of values held by this variable, or None if
+        it is unbounded."""
+        return getattr(self.__container, 'capacity', None)
+    capacity = property(__get_capacity)
+
+    def set_mode(self, mode, metadata=None):
         """Set the mode of this variable.  This is called when a variable is
-        declared.  It sets the type of container used for the variable.
+        declared.  It sets the type of container used for the variable, and
+        passes the metadata of the declaration on to the container.
 
           Parameters:
             mode -- the variable mode (for instance, 'single', 'lifo', 'fifo')
+            metadata -- metadata for declare operation, if any
         """
         if _DEBUG:
             log.msg('set_mode(%s, %s)' % (str(self), mode))
@@ -827,18 +3367,28 @@ class Variable(object):
             fetchers = self.__container.fetchers
             try:
                 cont_type = CONTAINER_TYPES[mode]
-                self.__container = cont_type(self.__name)
-                self.__container.vid = self.vid
-                self.__container.finders = finders
-                self.__container.fetchers = fetchers
-                self.__mode = mode
-                if _DEBUG:
-                    log.msg('set_mode(%s, %s): new container type = %s' %
-                            (str(self), mode, str(type(self.__container))))
             except KeyError:
                 raise BadModeException("illegal mode specified")
+            container = cont_type(self.__name)
+            if metadata:
+                container.configure(metadata)
+            self.__container = container
+            self.__container.vid = self.vid
+            self.__container.finders = finders
+            self.__container.fetchers = fetchers
+            self.__mode = mode
+            adopted = getattr(self.__container, 'waiters_adopted', None)
+            if adopted is not None:
+                adopted()
+            if _DEBUG:
+                log.msg('set_mode(%s, %s): new container type = %s' %
+                        (str(self), mode, str(type(self.__container))))
         elif self.__mode != mode:
             raise BadModeException("mode is already set to incompatible value")
+        elif metadata:
+            configure = getattr(self.__container, 'configure', None)
+            if configure is not None:
+                configure(metadata)
 
     def set_container(self, cont):
         """Specialized version of set_mode to be used from plugins to create
@@ -853,6 +3403,29 @@ class Variable(object):
     def purge(self):
         """Purge this variable from the workspace."""
         self.__container.purge()
+        for value in self.__detach_delayed():
+            value.close()
+
+    def detach(self):
+        """Detach this variable's values from it so that they can be closed
+        incrementally, causing all waiters to fail at once.  Returns an
+        iterable of the values to close."""
+        detach = getattr(self.__container, 'detach', None)
+        if detach is None:
+            # custom container which doesn't derive from BaseVar
+            self.__container.purge()
+            return ()
+        delayed = self.__detach_delayed()
+        if delayed:
+            return list(detach()) + delayed
+        return detach()
+
+    def __detach_delayed(self):
+        """Detach the delayed values of the container, if it has any."""
+        detach_delayed = getattr(self.__container, 'detach_delayed', None)
+        if detach_delayed is None:
+            return []
+        return detach_delayed()
 
     def format(self):
         """Format this variable for the 'list vars' command."""
@@ -861,17 +3434,118 @@ class Variable(object):
                 self.__container.num_finders,
                 self.__mode)
 
-    def store(self, client, val, metadata):
+    def store(self, client, val, metadata, is_blocking=True):
         """Set the value of this variable, converting it to FIFO type if it is
-        Unknown.
+        Unknown.  Returns True if the store is blocked because the variable is
+        full, in which case the reply is sent once the store completes.  If
+        the metadata holds 'nwsIfVersion' or 'nwsIfDigest', the store is
+        conditional, and fails unless the container's check_condition allows
+        it.  If the metadata holds 'nwsDelay' (in seconds) or 'nwsVisibleAt'
+        (in seconds since the epoch), the value is only stored once that time
+        has come, and until then, a fetch or find can't see it.
+
+          Arguments:
+            client          - client for whom to store
+            val             - value to store
+            metadata        - metadata, if any
+            is_blocking     - may the store block if the variable is full?
+        """
+        when = get_visible_time(metadata)
+        if when is not None:
+            metadata = metadata.copy()
+            metadata.pop('nwsDelay', None)
+            metadata.pop('nwsVisibleAt', None)
+            if 'nwsIfVersion' in metadata or 'nwsIfDigest' in metadata:
+                raise WorkspaceFailure('Conditional stores may not be '
+                                       'delayed.')
+        if 'nwsIfVersion' in metadata or 'nwsIfDigest' in metadata:
+            check_condition = getattr(self.__container, 'check_condition',
+                                      None)
+            if check_condition is None:
+                raise WorkspaceFailure('Conditional stores are not supported '
+                                       'for mode "%s".' % self.__mode)
+            check_condition(metadata)
+            metadata = metadata.copy()
+            metadata.pop('nwsIfVersion', None)
+            metadata.pop('nwsIfDigest', None)
+        if self.__mode == 'unknown':
+            self.set_mode('fifo')
+        if when is not None and when > time.time():
+            store_later = getattr(self.__container, 'store_later', None)
+            if store_later is None or not self.__container.delayable:
+                raise WorkspaceFailure('Delayed stores are not supported for '
+                                       'mode "%s".' % self.__mode)
+            check_store = getattr(self.__container, 'check_store', None)
+            if check_store is not None:
+                check_store(val, metadata)
+            store_later(when, val, metadata)
+            return False
+        if not is_blocking:
+            is_full = getattr(self.__container, 'is_full', None)
+            if is_full is not None and is_full(metadata):
+                raise WorkspaceFailure('Variable is full.', VARIABLE_FULL)
+        blocked = self.__container.store(client, val, metadata)
+        if val.is_large():
+            val.when_ready(lambda: self.__drop_failed(val))
+        return blocked
+
+    def __drop_failed(self, val):
+        """Remove a long value from the container if its data couldn't be
+        written.  Containers which can't remove it leave it to fail when it
+        is read.
+
+          Arguments:
+            val             - value which has been stored
+        """
+        if not val.is_failed():
+            return
+        log.msg('dropping incomplete value of variable %s' % self.__name)
+        discard = getattr(self.__container, 'discard', None)
+        if discard is not None:
+            discard(val)
+
+    def add(self, client, delta, metadata):
+        """Add to the count of this variable, converting it to counter type if
+        it is Unknown.
+
+          Arguments:
+            client          - client for whom to add
+            delta           - amount to add
+            metadata        - metadata, if any
+        """
+        if self.__mode == 'unknown':
+            self.set_mode('counter')
+        add = getattr(self.__container, 'add', None)
+        if add is None:
+            raise WorkspaceFailure('add is not supported for mode "%s".' %
+                                   self.__mode)
+        return add(client, delta, metadata)
+
+    def ack(self, client, lease, metadata):
+        """Acknowledge the completion of a task leased from this variable.
 
           Arguments:
-            client -- client for whom to store
-            val    -- value to store
+            client          - client which holds the lease
+            lease           - the lease to acknowledge
+            metadata        - metadata, if any
         """
+        ack = getattr(self.__container, 'ack', None)
+        if ack is None:
+            raise WorkspaceFailure('ack is not supported for mode "%s".' %
+                                   self.__mode)
+        ack(client, lease, metadata)
+
+    def __check_selective(self, metadata):
+        """Check that a fetch or find which selects its value by metadata is
+        supported by this variable, converting it to FIFO type if it is
+        Unknown, so that the fetch or find can wait for a matching value."""
+        if get_match(metadata) is None:
+            return
         if self.__mode == 'unknown':
             self.set_mode('fifo')
-        self.__container.store(client, val, metadata)
+        if not getattr(self.__container, 'selective', False):
+            raise WorkspaceFailure('Selecting values by metadata is not '
+                                   'supported for mode "%s".' % self.__mode)
 
     def fetch(self, client, is_blocking, val_index, metadata):
         """Do a fetch operation on this variable.
@@ -882,6 +3556,7 @@ class Variable(object):
             val_index       - value index, if this is an iterated operation
             metadata        - metadata, if any
         """
+        self.__check_selective(metadata)
         return self.__container.fetch(client, is_blocking, val_index, metadata)
 
     def find(self, client, is_blocking, val_index, metadata):
@@ -893,5 +3568,6 @@ class Variable(object):
             val_index       - value index, if this is an iterated operation
             metadata        - metadata, if any
         """
+        self.__check_selective(metadata)
         return self.__container.find(client, is_blocking, val_index, metadata)
 
@@ -750,6 +750,7 @@ class NwsWebDynamic(resource.Resource):
             fields['numvalues']   = var.num_values
             fields['numfetchers'] = var.num_fetchers
             fields['numfinders']  = var.num_finders
+            fields['numstorers']  = var.num_storers
             content += VAR_LIST_ENTRY % fields
             oddness = 1 - oddness
 
@@ -794,14 +795,18 @@ class NwsWebDynamic(resource.Resource):
         return infopage_var_fetched(ws_name, var_name)
 
     def __show_server_info(self, request):
-        #pylint: disable-msg=W0613,R0201
+        #pylint: disable-msg=W0613
         """Handler for ``showServerInfo`` page."""
+        reaper = self.nws_server.reaper
         fields = {
                 'nwsversion':       escape(nwss.__version__),
                 'nwsport':          nwss.config.nwsServerPort,
                 'webport':          nwss.config.nwsWebPort,
                 'tmpdir':           escape(nwss.config.nwsTmpDir),
                 'longvaluesize':    nwss.config.nwsLongValueSize,
+                'wssreclaiming':    reaper.workspaces_pending,
+                'wssreclaimed':     reaper.workspaces_reclaimed,
+                'valsreclaimed':    reaper.values_reclaimed,
         }
         return make_page('Server Info', SERVER_INFO_TEMPLATE % fields)
 
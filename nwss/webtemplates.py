@@ -261,6 +261,7 @@ VAR_LIST_HEADER = '''<p>
   <th># Values</th>
   <th># Fetchers</th>
   <th># Finders</th>
+  <th># Storers</th>
   <th>Mode</th>
   <th>Delete?</th>
 </tr>
@@ -271,6 +272,7 @@ VAR_LIST_ENTRY = '''<tr class="%(class)s">
   <td align="right">%(numvalues)d</td>
   <td align="right">%(numfetchers)d</td>
   <td align="right">%(numfinders)d</td>
+  <td align="right">%(numstorers)d</td>
   <td>%(mode)s</td>
   <td>
     <form action="doit" method="post">
@@ -313,6 +315,18 @@ SERVER_INFO_TEMPLATE = '''<p>
   <td>Long Value Size</td>
   <td>%(longvaluesize)d</td>
 </tr>
+<tr class="odd">
+  <td>Workspaces Being Reclaimed</td>
+  <td>%(wssreclaiming)d</td>
+</tr>
+<tr class="even">
+  <td>Workspaces Reclaimed</td>
+  <td>%(wssreclaimed)d</td>
+</tr>
+<tr class="odd">
+  <td>Values Reclaimed</td>
+  <td>%(valsreclaimed)d</td>
+</tr>
 </table>
 '''
 
@@ -27,9 +27,9 @@ from twisted.internet import reactor, defer, task
 from twisted.python import log
 
 from nwss.base import ServerException, NoSuchVariableException
-from nwss.base import WorkspaceFailure
-from nwss.base import Response
-from nwss.stdvars import Variable, BaseVar
+from nwss.base import WorkspaceFailure, VARIABLE_FULL
+from nwss.base import Response, Value
+from nwss.stdvars import Variable, BaseVar, get_match
 import nwss
 
 _DEBUG = nwss.config.is_debug_enabled('NWS:workspace')
@@ -101,9 +101,10 @@ class WorkSpace(object):
         self.__hook('destroyed_ws')
 
     def _declare_var(self, name, mode, metadata):
-        #pylint: disable-msg=W0613
         """Declare a variable to be of a particular mode.  Currently defined
-        modes are 'lifo', 'fifo', 'single', '__time', and '__barrier'.
+        modes are 'lifo', 'fifo', 'ring', 'log', 'multi', 'single',
+        'priority', 'task', 'semaphore', 'dict', 'counter', 'aggregate',
+        'array', '__time', and '__barrier'.
 
         Parameters:
             name            - name of the variable
@@ -111,7 +112,7 @@ class WorkSpace(object):
             metadata        - metadata passed in from the client
         """
         var = self.__get_var_object(name)
-        var.set_mode(mode)
+        var.set_mode(mode, metadata)
 
     def _fetch_var(self, name, client, is_blocking, iterstate, metadata):
         #pylint: disable-msg=R0913
@@ -177,19 +178,132 @@ class WorkSpace(object):
             response.iterstate = var.vid, max(0, iterstate[1])
         return response
 
-    def _set_var(self, name, client, val, metadata):
-        """Store a value into a variable.
+    def _set_var(self, name, client, val, metadata, is_blocking=True):
+        #pylint: disable-msg=R0913
+        """Store a value into a variable.  Returns True if the store is blocked
+        because the variable is full, in which case the reply will be sent
+        once the store completes.  Once stored, the value is owned by the
+        variable; if WorkspaceFailure is raised before then, it is closed.
 
           Parameters:
             name            - name of the variable
             client          - protocol object from whom request originated
             val             - value to store
             metadata        - metadata passed in from the client
+            is_blocking     - False for storeTry, which fails if the variable
+                              is full
         """
         var = self.__get_var_object(name)
-        self.__hook('store_pre', var, val, metadata)
-        var.store(client, val, metadata)
+        try:
+            self.__hook('store_pre', var, val, metadata)
+            blocked = var.store(client, val, metadata, is_blocking)
+        except WorkspaceFailure:
+            val.close()
+            raise
         self.__hook('store_post', var, val, metadata)
+        return blocked
+
+    def _add_var(self, name, client, delta, metadata):
+        """Add to the count of a counter variable.
+
+          Parameters:
+            name            - name of the variable
+            client          - protocol object from whom request originated
+            delta           - amount to add
+            metadata        - metadata passed in from the client
+        """
+        var = self.__get_var_object(name)
+        response = var.add(client, delta, metadata)
+        if response.iterstate is None:
+            response.iterstate = var.vid, 0
+        return response
+
+    def _ack_var(self, name, client, lease, metadata):
+        """Acknowledge the completion of a task leased from a task queue
+        variable.
+
+          Parameters:
+            name            - name of the variable
+            client          - protocol object from whom request originated
+            lease           - the lease to acknowledge
+            metadata        - metadata passed in from the client
+        """
+        var = self.__get_var_object(name, False)
+        if var is None:
+            raise WorkspaceFailure('Variable "%s" does not exist.' % name)
+        var.ack(client, lease, metadata)
+
+    # modes whose iterated find walks every value, so that all of them can be
+    # copied
+    COPY_ALL_MODES = ('unknown', 'fifo', 'ring', 'log', 'single')
+
+    # modes whose fetch doesn't remove a value, so that they can't be moved
+    NO_MOVE_MODES = ('log', 'semaphore', '__barrier', 'array')
+
+    def _copy_var(self, name, client, target, target_name, remove, copy_all,
+                  metadata):
+        #pylint: disable-msg=R0913
+        """Copy or move values from a variable into another variable, which
+        may be in another workspace, without blocking.  The values stored
+        share their data with the originals, so long values aren't copied.
+        A value is only removed once it has been stored, and a task moved
+        from a task queue is acknowledged.  Returns the number of values
+        copied or moved.  Copying or moving all values stops early if the
+        target variable becomes full.
+
+          Parameters:
+            name            - name of the variable to copy from
+            client          - protocol object from whom request originated
+            target          - workspace holding the variable to copy to
+            target_name     - name of the variable to copy to
+            remove          - True to move the values rather than copy them
+            copy_all        - True for all values, False for the head value
+            metadata        - metadata passed in from the client, which may
+                              select the values by their metadata
+        """
+        var = self.__get_var_object(name)
+        if remove and var.mode() in self.NO_MOVE_MODES:
+            raise WorkspaceFailure('Moving values is not supported for mode '
+                                   '"%s".' % var.mode())
+        if copy_all and not remove and var.mode() not in self.COPY_ALL_MODES:
+            raise WorkspaceFailure('Copying all values is not supported for '
+                                   'mode "%s".' % var.mode())
+
+        # Bound the number of values, since stores into the same variable
+        # add values to it
+        limit = copy_all and var.num_values or 1
+        count = 0
+        iterstate = ('', -1)
+        while count < limit:
+            try:
+                response = self._find_var(name, client, False, iterstate,
+                                          metadata)
+            except WorkspaceFailure:
+                if copy_all:
+                    break
+                raise
+            if not remove:
+                if response.iterstate[1] <= iterstate[1]:
+                    break
+                iterstate = response.iterstate
+
+            try:
+                target._set_var(target_name, client, response.value.share(),
+                                response.metadata, False)
+            except WorkspaceFailure, fail:
+                if copy_all and fail.status == VARIABLE_FULL:
+                    break
+                raise
+            count += 1
+
+            if remove:
+                removed = self._fetch_var(name, client, False, ('', -1),
+                                          metadata)
+                lease = removed.metadata.get('nwsLease')
+                if lease is not None:
+                    self._ack_var(name, client, lease, {})
+                removed.value.access_complete()
+        return count
 
     def _delete_var(self, name, metadata):
         """Delete a variable.
@@ -203,6 +317,68 @@ class WorkSpace(object):
         self.__hook('delete_post', name, metadata)
         return 0
 
+    def _transact(self, client, operations, metadata):
+        """Perform a list of operations on the variables of this workspace as
+        a single atomic step.  The preconditions of all of the operations are
+        checked before any of them is performed, so that if any of them would
+        fail, WorkspaceFailure is raised, none of them takes effect, and the
+        values to be stored are closed.
+        Returns a list holding the response of each 'fetchTry' and 'findTry',
+        and None for each other operation.  The values of the responses are
+        shares, owned by the caller, so later operations can't close them.
+
+          Parameters:
+            client          - protocol object from whom request originated
+            operations      - list of (op_name, var_name, value) tuples, where
+                              op_name is 'store', 'fetchTry', 'findTry' or
+                              'delete var', and value is the value to store,
+                              or None
+            metadata        - metadata passed in from the client
+        """
+        plans = {}
+        if 'nwsIfVersion' in metadata or 'nwsIfDigest' in metadata or \
+                'nwsDelay' in metadata or 'nwsVisibleAt' in metadata or \
+                get_match(metadata) is not None:
+            for _, _, value in operations:
+                if value is not None:
+                    value.close()
+            raise WorkspaceFailure('Conditional or delayed stores and '
+                                   'selective fetches are not supported in '
+                                   'transactions.')
+        for op_num, (op_name, var_name, _) in enumerate(operations):
+            plan = plans.get(var_name)
+            if plan is None:
+                plan = plans[var_name] = \
+                        _TransactionPlan(self.get_variable(var_name),
+                                         metadata)
+            try:
+                plan.apply(op_name)
+            except WorkspaceFailure, fail:
+                for _, _, value in operations:
+                    if value is not None:
+                        value.close()
+                raise WorkspaceFailure('Transaction operation %d (%s "%s") '
+                                       'failed: %s' % (op_num + 1, op_name,
+                                       var_name, fail.args[0]), fail.status)
+
+        results = []
+        for op_name, var_name, value in operations:
+            if op_name == 'store':
+                self._set_var(var_name, client, value, metadata, False)
+                results.append(None)
+            elif op_name == 'fetchTry':
+                results.append(_share_response(
+                        self._fetch_var(var_name, client, False, ('', -1),
+                                        metadata)))
+            elif op_name == 'findTry':
+                results.append(_share_response(
+                        self._find_var(var_name, client, False, ('', -1),
+                                       metadata)))
+            else:
+                self._delete_var(var_name, metadata)
+                results.append(None)
+        return results
+
     def _get_bindings(self, hide=False):
         """Get the set of all variable bindings in this workspace.
 
@@ -433,15 +609,113 @@ class WorkSpace(object):
           Parameters:
             metadata        - metadata passed in from the client
         """
+        for _ in self._detach(metadata):
+            pass
+
+    def _detach(self, metadata=None):
+        """Remove all variables from this workspace, causing any clients
+        waiting on them to fail at once, but leaving their values to be
+        closed later.  Returns an iterator which closes one value each time it
+        is advanced.
+
+          Parameters:
+            metadata        - metadata passed in from the client
+        """
         if metadata is None:
             metadata = {}
         self.__hook('purge_pre', metadata)
-        names = self.__bindings.keys()
-        for name in names:
-            var = self.__bindings.pop(name)
-            var.purge()
-        self.__vars_by_id.clear()
+        variables = self.__bindings.values()
+        self.__bindings = {}
+        self.__vars_by_id = {}
+        detached = [var.detach() for var in variables]
         self.__hook('purge_post', metadata)
+        return close_values(detached)
+
+def _share_response(response):
+    """Copy the response to an operation of a transaction, holding a share of
+    its value, so that the value can't be closed by a later operation before
+    the reply is sent.  A fetched value is released, as it would be once
+    sent."""
+    shared = Response(response.metadata, response.value.share())
+    response.value.access_complete()
+    return shared
+
+class _TransactionPlan(object):
+    """Simulation of the effect of the operations of a transaction on one
+    variable, used to check their preconditions before any of them is
+    performed.  Only modes whose behavior depends on nothing more than their
+    count of values and waiters are supported.
+    """
+
+    MODES = ('unknown', 'fifo', 'ring', 'lifo', 'multi', 'single')
+
+    def __init__(self, var, metadata):
+        """Start from the current state of a variable.
+
+          Parameters:
+            var             - the variable, or None if it does not exist
+            metadata        - metadata of the transaction, which is stored
+                              with its values
+        """
+        if var is None:
+            self.__forget()
+        else:
+            self.exists = True
+            self.mode = var.mode()
+            self.values = var.num_values
+            # only the fetchers which would take the values stored count
+            self.fetchers = var.num_takers(metadata)
+            self.storers = var.num_storers
+            self.capacity = var.capacity
+
+    def __forget(self):
+        """Reset to the state of a variable which does not exist."""
+        self.exists = False
+        self.mode = 'unknown'
+        self.values = self.fetchers = self.storers = 0
+        self.capacity = None
+
+    def apply(self, op_name):
+        """Simulate an operation, raising WorkspaceFailure if it would fail."""
+        if op_name == 'delete var':
+            if not self.exists:
+                raise WorkspaceFailure('Variable does not exist.')
+            self.__forget()
+            return
+
+        if self.mode not in self.MODES:
+            raise WorkspaceFailure('Transactions are not supported for mode '
+                                   '"%s".' % self.mode)
+        if op_name == 'store':
+            self.exists = True
+            if self.mode == 'unknown':
+                self.mode = 'fifo'
+            if self.fetchers:
+                self.fetchers -= 1
+            elif self.mode == 'single':
+                self.values = 1
+            elif self.mode == 'ring':
+                self.values = min(self.values + 1, self.capacity)
+            elif self.capacity is not None and self.values >= self.capacity:
+                raise WorkspaceFailure('Variable is full.', VARIABLE_FULL)
+            else:
+                self.values += 1
+        elif not self.values:
+            raise WorkspaceFailure('no value available')
+        elif op_name == 'fetchTry':
+            self.values -= 1
+            if self.storers:
+                self.storers -= 1
+                self.values += 1
+
+def close_values(detached):
+    """Generator which closes the values in a list of detached variable
+    contents, one value per step."""
+    for values in detached:
+        for value in values:
+            if isinstance(value, Value):
+                value.close()
+            yield None
 
 class GetRequest(object):
     #pylint: disable-msg=R0903
@@ -0,0 +1,61 @@
+#
+# Copyright (c) 2005-2009, REvolution Computing, Inc.
+#
+# NetWorkSpaces is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307
+# USA
+#
+
+"""
+Regression tests for the value classes.  Run with
+'python -m unittest discover -s test' from the top of the source tree.
+"""
+
+import os
+import unittest
+from tempfile import mkstemp
+
+from nwss.base import Value, CompositeValue, DIRECT_STRING
+
+class CompositeValueTest(unittest.TestCase):
+    """A composite value reads across short and long parts."""
+
+    def setUp(self):
+        filedesc, self.filename = mkstemp()
+        os.write(filedesc, 'long data')
+        os.close(filedesc)
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def test_slices_span_parts(self):
+        long_value = Value(DIRECT_STRING, (self.filename, 9))
+        short_value = Value(DIRECT_STRING, 'xy')
+        value = CompositeValue(DIRECT_STRING,
+                               ['head:', long_value, short_value, ':tail'])
+        self.assertEqual(value.length(), 21)
+        self.assert_(value.is_large())
+        data = value.get_file()
+        try:
+            self.assertEqual(data[0:21], 'head:long dataxy:tail')
+            self.assertEqual(data[3:8], 'd:lon')
+            self.assertEqual(data[13:17], 'axy:')
+            self.assertEqual(data[16:64], ':tail')
+            self.assertEqual(data[21:30], '')
+        finally:
+            value.release_file()
+
+if __name__ == '__main__':
+    unittest.main()
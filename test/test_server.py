@@ -0,0 +1,151 @@
+#
+# Copyright (c) 2005-2009, REvolution Computing, Inc.
+#
+# NetWorkSpaces is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307
+# USA
+#
+
+"""
+Regression tests for the server's command handlers and reply helpers.  Run with
+'python -m unittest discover -s test' from the top of the source tree.
+"""
+
+import os
+import unittest
+from tempfile import mkstemp
+
+from nwss.base import Value, LongData, Response, DIRECT_STRING
+from nwss.mock import MockConnection, MockTransport
+from nwss.protoutils import FileProducer, LeaseTracker
+from nwss.server import NwsService, send_transaction_reply
+
+class ProducerTransport(MockTransport):
+    """Mock transport which runs a registered producer to completion."""
+
+    def __init__(self):
+        MockTransport.__init__(self)
+        self.data = []
+        self.producer = None
+
+    def write(self, data):
+        self.data.append(data)
+
+    def registerProducer(self, producer, streaming):
+        #pylint: disable-msg=C0103,W0613
+        """Run the producer until it unregisters."""
+        self.producer = producer
+        while self.producer is not None:
+            producer.resumeProducing()
+
+    def unregisterProducer(self):
+        #pylint: disable-msg=C0103
+        """Stop running the producer."""
+        self.producer = None
+
+class StreamingConnection(MockConnection):
+    """Mock connection which streams long values as the protocol does."""
+
+    transport_factory = ProducerTransport
+
+    def send_long_response(self, response):
+        FileProducer(response.value, self.transport).start()
+
+class RecordingConnection(MockConnection):
+    """Mock connection which keeps the replies sent to it."""
+
+    def __init__(self):
+        MockConnection.__init__(self)
+        self.replies = []
+        self.leases = LeaseTracker()
+
+    def send_short_response(self, response=None):
+        self.replies.append('ok')
+
+    def send_long_response(self, response):
+        self.replies.append(response.value.val())
+
+    def send_error(self, reason, status=1, long_reply=False):
+        self.replies.append(('error', reason))
+
+def _value(data):
+    """Build a short value."""
+    return Value(DIRECT_STRING, data)
+
+class FetchAnyTest(unittest.TestCase):
+    """Fetches from whichever of several variables first has a value."""
+
+    def setUp(self):
+        self.service = NwsService()
+        self.workspace = self.service.spaces['__default', 0]
+        self.client = RecordingConnection()
+        self.client.workspace_names.set('__default', ('__default', 0))
+
+    def __fetch_any(self, op_name, *var_names):
+        """Fetch from the named variables of the default workspace."""
+        names = []
+        for var_name in var_names:
+            names.extend(['__default', var_name])
+        self.service.cmd_fetch_any(self.client, op_name, *names,
+                                   **{'metadata': {'nwsMatch:host': 'A'}})
+
+    def __fill(self):
+        """Fill variable q, with a storer blocked on it, and store into r."""
+        storer = RecordingConnection()
+        self.workspace._declare_var('q', 'fifo', {'nwsCapacity': '1'})
+        self.workspace._set_var('q', storer, _value('b'), {'host': 'B'})
+        self.workspace._set_var('q', storer, _value('a'), {'host': 'A'})
+        self.workspace._set_var('r', storer, _value('c'), {'host': 'A'})
+
+    def test_stops_after_handoff_from_blocked_storer(self):
+        self.__fill()
+        self.__fetch_any('fetchAny', 'q', 'r')
+        self.assertEqual(self.client.replies, ['a'])
+        self.__fetch_any('fetchAny', 'r')
+        self.assertEqual(self.client.replies, ['a', 'c'])
+
+    def test_try_sends_one_reply(self):
+        self.__fill()
+        self.__fetch_any('fetchAnyTry', 'q', 'r')
+        self.assertEqual(len(self.client.replies), 1)
+        self.__fetch_any('fetchAnyTry', 'q', 'r')
+        self.assertEqual(len(self.client.replies), 2)
+        self.__fetch_any('fetchAnyTry', 'q', 'r')
+        self.assertEqual(self.client.replies[2:],
+                         [('error', 'no value available')])
+
+class TransactionReplyTest(unittest.TestCase):
+    """Replies to transactions which found long values."""
+
+    def setUp(self):
+        filedesc, filename = mkstemp()
+        os.write(filedesc, 'long data')
+        os.close(filedesc)
+        self.data = LongData(filename, 9)
+
+    def tearDown(self):
+        if os.path.exists(self.data.filename):
+            os.remove(self.data.filename)
+
+    def test_long_results_freed_after_reply(self):
+        value = Value(DIRECT_STRING, self.data)
+        client = StreamingConnection()
+        send_transaction_reply(client, [None, Response(value=value.share())])
+        self.assert_(''.join(client.transport.data).endswith('long data'))
+        self.assertEqual(self.data.refs, 1)
+        value.close()
+        self.assert_(self.data.removed)
+
+if __name__ == '__main__':
+    unittest.main()
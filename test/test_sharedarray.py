@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2005-2009, REvolution Computing, Inc.
+#
+# NetWorkSpaces is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307
+# USA
+#
+
+"""
+Tests for shared numeric arrays, with and without NumPy.  Run with
+'python -m unittest discover -s test' from the top of the source tree.
+"""
+
+import struct
+import unittest
+
+from nwss import sharedarray
+from nwss.sharedarray import SharedArray
+
+_NUMPY = sharedarray.numpy
+
+class SharedArrayAddTest(unittest.TestCase):
+    """Elementwise adds to a slice of an array."""
+
+    def tearDown(self):
+        sharedarray.numpy = _NUMPY
+
+    def check_adds(self):
+        """Add to slices of float64 and int64 arrays."""
+        floats = SharedArray('float64', 4)
+        try:
+            floats.write(0, struct.pack('<4d', 1.0, 2.0, 3.0, 4.0))
+            floats.add(1, struct.pack('<2d', 0.5, -3.0))
+            self.assertEqual(struct.unpack('<4d', floats.read(0, 4)),
+                             (1.0, 2.5, 0.0, 4.0))
+        finally:
+            floats.close()
+
+        ints = SharedArray('int64', 3)
+        try:
+            ints.write(0, struct.pack('<3q', 2 ** 63 - 1, 5, -7))
+            ints.add(0, struct.pack('<3q', 1, 5, 7))
+            self.assertEqual(struct.unpack('<3q', ints.read(0, 3)),
+                             (-2 ** 63, 10, 0))
+        finally:
+            ints.close()
+
+    def test_add_without_numpy(self):
+        sharedarray.numpy = None
+        self.check_adds()
+
+    @unittest.skipIf(_NUMPY is None, 'NumPy is not installed')
+    def test_add_with_numpy(self):
+        self.check_adds()
+
+if __name__ == '__main__':
+    unittest.main()
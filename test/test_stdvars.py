@@ -0,0 +1,466 @@
+#
+# Copyright (c) 2005-2009, REvolution Computing, Inc.
+#
+# NetWorkSpaces is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307
+# USA
+#
+
+"""
+Regression tests for the standard variable containers.  Run with
+'python -m unittest discover -s test' from the top of the source tree.
+"""
+
+import os
+import random
+import unittest
+from tempfile import mkstemp
+
+from nwss.base import Value, LongData, DIRECT_STRING, PACKED_FLOAT64
+from nwss.base import WorkspaceFailure, CONDITION_FAILED, NOT_READY
+from nwss.aggregate import pack_vector
+from nwss.mock import MockConnection
+from nwss.protoutils import LeaseTracker
+from nwss.stdvars import Aggregate, Counter, Dictionary, Fifo, Multi, NumArray
+from nwss.stdvars import Lifo, Single, Variable
+
+class RecordingConnection(MockConnection):
+    """Mock connection which keeps the replies sent to it."""
+
+    def __init__(self):
+        MockConnection.__init__(self)
+        self.replies = []
+        self.leases = LeaseTracker()
+
+    def send_short_response(self, response=None):
+        self.replies.append('ok')
+
+    def send_long_response(self, response):
+        self.replies.append((response.value.val(), dict(response.metadata)))
+
+    def send_error(self, reason, status=1, long_reply=False):
+        self.replies.append(('error', reason))
+
+def _value(data):
+    """Build a short value."""
+    return Value(DIRECT_STRING, data)
+
+class DeferredValue(Value):
+    """Value whose data isn't ready until its ready method is called."""
+
+    def when_ready(self, callback):
+        self.callback = callback    #pylint: disable-msg=W0201
+
+    def ready(self):
+        """Run the callback waiting for the data."""
+        self.callback()
+
+class SelectiveFifoTest(unittest.TestCase):
+    """Selective fetches on a FIFO which holds values they don't match."""
+
+    def test_fetcher_takes_new_value_from_nonempty_queue(self):
+        fifo = Fifo('q')
+        storer, fetcher = RecordingConnection(), RecordingConnection()
+        fifo.store(storer, _value('b'), {'host': 'B'})
+        self.assertEqual(fifo.fetch(fetcher, True, -1,
+                                    {'nwsMatch:host': 'A'}), None)
+        fifo.store(storer, _value('a'), {'host': 'A'})
+        self.assertEqual(fetcher.replies, [('a', {'host': 'A'})])
+        self.assertEqual(len(fifo), 1)
+
+        response = fifo.fetch(storer, False, -1, {})
+        self.assertEqual(response.value.val(), 'b')
+        self.assertEqual(response.metadata, {'host': 'B'})
+        self.assertRaises(WorkspaceFailure, fifo.fetch, storer, False, -1, {})
+
+        # indexes stay in step after the tombstone is freed
+        fifo.store(storer, _value('c'), {})
+        self.assertEqual(fifo.find(storer, False, -1, {}).value.val(), 'c')
+
+    def test_full_queue_admits_value_for_selective_fetcher(self):
+        fifo = Fifo('q')
+        fifo.configure({'nwsCapacity': '1'})
+        storer, fetcher = RecordingConnection(), RecordingConnection()
+        fifo.store(storer, _value('b'), {'host': 'B'})
+        fifo.fetch(fetcher, True, -1, {'nwsMatch:host': 'A'})
+        self.assertEqual(fifo.store(storer, _value('a'), {'host': 'A'}), None)
+        self.assertEqual(fetcher.replies, [('a', {'host': 'A'})])
+        self.assertEqual(fifo.num_storers, 0)
+
+    def test_selective_fetcher_takes_blocked_store(self):
+        fifo = Fifo('q')
+        fifo.configure({'nwsCapacity': '1'})
+        storer, fetcher = RecordingConnection(), RecordingConnection()
+        fifo.store(storer, _value('b'), {'host': 'B'})
+        self.assertEqual(fifo.store(storer, _value('a'), {'host': 'A'}), True)
+        self.assertEqual(fifo.fetch(fetcher, True, -1,
+                                    {'nwsMatch:host': 'A'}), None)
+        self.assertEqual(fetcher.replies, [('a', {'host': 'A'})])
+        self.assertEqual(storer.replies, ['ok'])
+        self.assertEqual(len(fifo), 1)
+
+class SingleTest(unittest.TestCase):
+    """Versions of the value of a single variable."""
+
+    def setUp(self):
+        self.single = Single('s')
+        self.client = RecordingConnection()
+
+    def __find(self, val_index=-1):
+        """Find the value, returning its data and version."""
+        response = self.single.find(self.client, False, val_index, {})
+        return response.value.val(), response.iterstate[1]
+
+    def test_each_value_gets_next_version(self):
+        self.single.store(self.client, _value('a'), {})
+        self.assertEqual(self.__find(), ('a', 0))
+        self.single.store(self.client, _value('b'), {'k': 'v'})
+        self.assertEqual(self.__find(), ('b', 1))
+        self.assertEqual(self.single.find(self.client, False, -1,
+                                          {}).metadata, {'k': 'v'})
+        self.assertRaises(WorkspaceFailure, self.__find, 1)
+        self.assertEqual(len(self.single), 1)
+
+        response = self.single.fetch(self.client, False, -1, {})
+        self.assertEqual(response.iterstate[1], 1)
+        self.assertRaises(WorkspaceFailure, self.__find)
+        self.single.store(self.client, _value('c'), {})
+        self.assertEqual(self.__find(), ('c', 2))
+
+    def test_versions_continue_after_purge(self):
+        self.single.store(self.client, _value('a'), {})
+        self.single.purge()
+        self.single.store(self.client, _value('b'), {})
+        self.assertEqual(self.__find(), ('b', 1))
+
+    def test_waiting_fetcher_uses_up_version(self):
+        self.single.fetch(self.client, True, -1, {})
+        self.single.store(self.client, _value('a'), {})
+        self.single.store(self.client, _value('b'), {})
+        self.assertEqual(self.__find(), ('b', 1))
+
+class DictionaryTest(unittest.TestCase):
+    """Fetches and finds on a dictionary which don't give a key."""
+
+    def test_find_and_fetch_agree(self):
+        dictionary = Dictionary('d')
+        client = RecordingConnection()
+        rand = random.Random(1)
+        for _ in xrange(400):
+            dictionary.store(client, _value('v'),
+                             {'nwsKey': str(rand.randrange(300))})
+        for _ in xrange(400):
+            dictionary.store(client, _value('v'),
+                             {'nwsKey': str(rand.randrange(300))})
+            found = dictionary.find(client, False, -1, {})
+            fetched = dictionary.fetch(client, False, -1, {})
+            self.assertEqual(found.metadata, fetched.metadata)
+
+class LifoTest(unittest.TestCase):
+    """Finds on a LIFO whose newest value has been removed."""
+
+    def test_find_skips_removed_tail(self):
+        filedesc, filename = mkstemp()
+        os.close(filedesc)
+        try:
+            lifo = Lifo('l')
+            client = RecordingConnection()
+            value = Value(DIRECT_STRING, LongData(filename, 0))
+            lifo.store(client, _value('a'), {})
+            lifo.store(client, value, {})
+            lifo.discard(value)
+            self.assertEqual(len(lifo), 1)
+            self.assertEqual(lifo.find(client, False, -1, {}).value.val(),
+                             'a')
+            self.assertEqual(lifo.fetch(client, False, -1, {}).value.val(),
+                             'a')
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+class MultiTest(unittest.TestCase):
+    """Fetches from a multi variable."""
+
+    def test_no_value_is_starved(self):
+        bag = Multi('m')
+        client = RecordingConnection()
+        bag.store(client, _value('a'), {})
+        bag.store(client, _value('b'), {})
+        fetched = []
+        for data in 'cde':
+            fetched.append(bag.fetch(client, False, -1, {}).value.val())
+            bag.store(client, _value(data), {})
+        self.assertEqual(fetched, ['a', 'b', 'c'])
+        self.assertEqual(bag.find(client, False, -1, {}).value.val(), 'd')
+
+class CounterTest(unittest.TestCase):
+    """Stores to a counter."""
+
+    def setUp(self):
+        self.counter = Counter('c')
+        self.client = RecordingConnection()
+
+    def test_fetcher_resets_count(self):
+        fetcher = RecordingConnection()
+        self.counter.add_fetcher(fetcher)
+        self.counter.store(self.client, _value('5'), {})
+        self.assertEqual(fetcher.replies, [('5', {})])
+        self.assertEqual(self.counter.find(self.client, False, -1,
+                                           {}).value.val(), '0')
+
+    def test_long_value_rejected(self):
+        filedesc, filename = mkstemp()
+        os.close(filedesc)
+        try:
+            value = Value(DIRECT_STRING, LongData(filename, 0))
+            self.assertRaises(WorkspaceFailure, self.counter.store,
+                              self.client, value, {})
+        finally:
+            os.remove(filename)
+
+class DeclareWithWaitersTest(unittest.TestCase):
+    """Clients blocked on a variable before it is declared."""
+
+    def test_semaphore_grants_waiting_fetchers(self):
+        var = Variable('s', False)
+        first, second = RecordingConnection(), RecordingConnection()
+        self.assertEqual(var.fetch(first, True, -1, {}), None)
+        self.assertEqual(var.fetch(second, True, -1, {}), None)
+        var.set_mode('semaphore', {'nwsPermits': '2'})
+        self.assertEqual(first.replies, [('1', {'nwsLease': '1'})])
+        self.assertEqual(second.replies, [('2', {'nwsLease': '2'})])
+        self.assertEqual(var.num_fetchers, 0)
+
+    def test_semaphore_declared_without_permits(self):
+        var = Variable('s', False)
+        client = RecordingConnection()
+        var.fetch(client, True, -1, {})
+        var.set_mode('semaphore')
+        self.assertEqual(client.replies, [('1', {'nwsLease': '1'})])
+
+    def test_counter_answers_waiters(self):
+        var = Variable('c', False)
+        fetcher, finder = RecordingConnection(), RecordingConnection()
+        var.fetch(fetcher, True, -1, {})
+        var.find(finder, True, -1, {})
+        var.set_mode('counter')
+        self.assertEqual(fetcher.replies, [('0', {})])
+        self.assertEqual(finder.replies, [('0', {})])
+        self.assertEqual(var.num_fetchers + var.num_finders, 0)
+
+    def test_log_fails_waiting_fetchers(self):
+        var = Variable('l', False)
+        fetcher, finder = RecordingConnection(), RecordingConnection()
+        var.fetch(fetcher, True, -1, {})
+        var.find(finder, True, -1, {})
+        var.set_mode('log')
+        self.assertEqual(fetcher.replies[0][0], 'error')
+        var.store(fetcher, _value('a'), {})
+        self.assertEqual(finder.replies, [('a', {})])
+        self.assertEqual(var.num_values, 1)
+        self.assertEqual(var.num_fetchers, 0)
+
+    def test_array_answers_waiting_finder(self):
+        var = Variable('a', False)
+        client = RecordingConnection()
+        self.assertEqual(var.find(client, True, -1, {}), None)
+        var.set_mode('array', {'nwsLength': '2'})
+        self.assertEqual(client.replies, [(pack_vector([0.0, 0.0]), {})])
+        self.assertEqual(var.num_finders, 0)
+
+class ConditionalStoreTest(unittest.TestCase):
+    """Compare-and-set stores to a single variable holding a long value."""
+
+    def setUp(self):
+        filedesc, filename = mkstemp()
+        os.write(filedesc, 'long data')
+        os.close(filedesc)
+        self.data = LongData(filename, 9)
+        self.var = Variable('s', False)
+        self.var.set_mode('single')
+        self.client = RecordingConnection()
+        self.var.store(self.client, Value(DIRECT_STRING, self.data), {})
+
+    def tearDown(self):
+        self.var.purge()
+
+    def __store_if_digest(self, digest):
+        """Store a new value on condition of the current digest."""
+        self.var.store(self.client, _value('new'), {'nwsIfDigest': digest})
+
+    def test_digest_unknown_until_uploaded(self):
+        try:
+            self.__store_if_digest('0' * 40)
+        except WorkspaceFailure, exc:
+            self.assertEqual(exc.status, NOT_READY)
+        else:
+            self.fail('store with an unknown digest succeeded')
+        self.data.digest = 'a' * 40
+        try:
+            self.__store_if_digest('0' * 40)
+        except WorkspaceFailure, exc:
+            self.assertEqual(exc.status, CONDITION_FAILED)
+        else:
+            self.fail('store with the wrong digest succeeded')
+        self.__store_if_digest('A' * 40)
+        self.assertEqual(self.var.find(self.client, False, -1, {}).value.val(),
+                         'new')
+
+class AggregateTest(unittest.TestCase):
+    """Vectors stored into an aggregate before their data is ready."""
+
+    def setUp(self):
+        self.aggregate = Aggregate('a')
+        self.client = RecordingConnection()
+
+    def __store(self, data):
+        """Store a vector whose data isn't ready yet."""
+        value = DeferredValue(PACKED_FLOAT64, pack_vector(data))
+        self.aggregate.store(self.client, value, {})
+        return value
+
+    def test_width_fixed_at_store(self):
+        self.__store([1.0, 2.0])
+        self.assertRaises(WorkspaceFailure, self.__store, [1.0])
+
+    def test_requests_wait_for_pending_vectors(self):
+        first = self.__store([1.0, 2.0])
+        second = self.__store([3.0, 4.0])
+        try:
+            self.aggregate.find(self.client, False, -1, {})
+        except WorkspaceFailure, exc:
+            self.assertEqual(exc.status, NOT_READY)
+        else:
+            self.fail('find returned an aggregate with vectors pending')
+        self.assertEqual(self.aggregate.fetch(self.client, True, -1, {}),
+                         None)
+        second.ready()
+        self.assertEqual(self.client.replies, [])
+        first.ready()
+        self.assertEqual(self.client.replies, [(pack_vector([4.0, 6.0]), {})])
+        self.assertRaises(WorkspaceFailure, self.aggregate.find, self.client,
+                          False, -1, {})
+
+    def test_long_number_rejected(self):
+        filedesc, filename = mkstemp()
+        os.close(filedesc)
+        try:
+            data = LongData(filename, 0)
+            self.assertRaises(WorkspaceFailure, self.aggregate.store,
+                              self.client, Value(DIRECT_STRING, data), {})
+            self.assert_(data.removed)
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+class NumArrayTest(unittest.TestCase):
+    """Updates to array variables."""
+
+    def setUp(self):
+        self.array = NumArray('a')
+        self.array.configure({'nwsLength': '3'})
+        self.client = RecordingConnection()
+
+    def tearDown(self):
+        self.array.purge()
+
+    def test_store_requires_matching_descriptor(self):
+        self.assertRaises(WorkspaceFailure, self.array.store, self.client,
+                          _value(pack_vector([1.0])), {})
+        self.array.store(self.client,
+                         Value(PACKED_FLOAT64, pack_vector([1.0])),
+                         {'nwsStart': '1', 'nwsArrayOp': 'add'})
+        response = self.array.find(self.client, False, -1, {})
+        self.assertEqual(response.value.val(), pack_vector([0.0, 1.0, 0.0]))
+
+    def test_find_waits_for_pending_update(self):
+        value = DeferredValue(PACKED_FLOAT64, pack_vector([1.0, 2.0]))
+        self.array.store(self.client, value, {'nwsStart': '1'})
+        try:
+            self.array.find(self.client, False, -1, {})
+        except WorkspaceFailure, exc:
+            self.assertEqual(exc.status, NOT_READY)
+        else:
+            self.fail('find returned the array with an update pending')
+        self.assertEqual(self.array.find(self.client, True, -1,
+                                         {'nwsCount': '2'}), None)
+        self.assertEqual(self.array.num_finders, 1)
+        value.ready()
+        self.assertEqual(self.client.replies, [(pack_vector([0.0, 1.0]), {})])
+        self.assertEqual(self.array.num_finders, 0)
+
+    def test_pending_update_after_purge(self):
+        value = DeferredValue(PACKED_FLOAT64, pack_vector([1.0]))
+        self.array.store(self.client, value, {})
+        self.array.purge()
+        value.ready()
+
+class DelayedStoreTest(unittest.TestCase):
+    """Stores which become visible after a delay."""
+
+    def setUp(self):
+        self.client = RecordingConnection()
+
+    def test_invalid_store_rejected_at_once(self):
+        var = Variable('d', False)
+        var.set_mode('dict')
+        self.assertRaises(WorkspaceFailure, var.store, self.client,
+                          _value('a'), {'nwsDelay': '60'})
+        var.store(self.client, _value('a'), {'nwsDelay': '60', 'nwsKey': 'k'})
+        var.purge()
+
+    def test_invalid_priority_rejected_at_once(self):
+        var = Variable('p', False)
+        var.set_mode('priority')
+        self.assertRaises(WorkspaceFailure, var.store, self.client,
+                          _value('a'), {'nwsDelay': '60', 'nwsPriority': 'x'})
+        var.purge()
+
+class FailedLongValueTest(unittest.TestCase):
+    """Long values whose data couldn't be written."""
+
+    def setUp(self):
+        filedesc, filename = mkstemp()
+        os.write(filedesc, 'trunc')
+        os.close(filedesc)
+        self.data = LongData(filename, 10)
+        self.data.failed = True
+        self.client = RecordingConnection()
+
+    def tearDown(self):
+        if os.path.exists(self.data.filename):
+            os.remove(self.data.filename)
+
+    def test_dropped_from_fifo(self):
+        var = Variable('q', False)
+        var.store(self.client, _value('a'), {})
+        var.store(self.client, Value(DIRECT_STRING, self.data), {})
+        var.store(self.client, _value('b'), {})
+        self.assertEqual(var.fetch(self.client, False, -1, {}).value.val(),
+                         'a')
+        self.assertEqual(var.fetch(self.client, False, -1, {}).value.val(),
+                         'b')
+        self.assertRaises(WorkspaceFailure, var.fetch, self.client, False, -1,
+                          {})
+        self.assert_(self.data.removed)
+
+    def test_dropped_from_single(self):
+        var = Variable('s', False)
+        var.set_mode('single')
+        var.store(self.client, Value(DIRECT_STRING, self.data), {})
+        self.assertRaises(WorkspaceFailure, var.find, self.client, False, -1,
+                          {})
+
+if __name__ == '__main__':
+    unittest.main()
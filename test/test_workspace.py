@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2005-2009, REvolution Computing, Inc.
+#
+# NetWorkSpaces is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307
+# USA
+#
+
+"""
+Regression tests for workspaces.  Run with
+'python -m unittest discover -s test' from the top of the source tree.
+"""
+
+import os
+import unittest
+from tempfile import mkstemp
+
+from nwss.base import Value, LongData, DIRECT_STRING, WorkspaceFailure
+from nwss.base import VARIABLE_FULL
+from nwss.mock import MockConnection
+from nwss.workspace import WorkSpace
+
+class HookedWorkSpace(WorkSpace):
+    """Workspace whose store_post hook fails."""
+
+    def hook_store_post(self, var, val, metadata):
+        #pylint: disable-msg=R0201,W0613
+        """Reject every store, after it has been done."""
+        raise WorkspaceFailure('store_post hook failed')
+
+class StoreOwnershipTest(unittest.TestCase):
+    """Values are closed when a store fails, and only then."""
+
+    def setUp(self):
+        filedesc, filename = mkstemp()
+        os.write(filedesc, 'long data')
+        os.close(filedesc)
+        self.data = LongData(filename, 9)
+        self.client = MockConnection()
+
+    def tearDown(self):
+        if os.path.exists(self.data.filename):
+            os.remove(self.data.filename)
+
+    def test_rejected_value_is_closed(self):
+        workspace = WorkSpace('ws')
+        workspace._add_var('n', self.client, 1, {})
+        self.assertRaises(WorkspaceFailure, workspace._set_var, 'n',
+                          self.client, Value(DIRECT_STRING, self.data), {})
+        self.assert_(self.data.removed)
+
+    def test_stored_value_survives_hook_failure(self):
+        workspace = HookedWorkSpace('ws')
+        self.assertRaises(WorkspaceFailure, workspace._set_var, 'q',
+                          self.client, Value(DIRECT_STRING, self.data), {})
+        self.failIf(self.data.removed)
+        response = workspace._find_var('q', self.client, False, ('', -1), {})
+        self.assertEqual(response.value.length(), 9)
+
+class TransactionTest(unittest.TestCase):
+    """Transactions whose preconditions depend on waiting fetchers."""
+
+    def test_selective_fetcher_does_not_take_store(self):
+        workspace = WorkSpace('ws')
+        client, fetcher = MockConnection(), MockConnection()
+        workspace._declare_var('q', 'fifo', {'nwsCapacity': '1'})
+        workspace._set_var('q', client, Value(DIRECT_STRING, 'b'), {})
+        workspace._fetch_var('q', fetcher, True, ('', -1),
+                             {'nwsMatch:host': 'A'})
+        operations = [('store', 'other', Value(DIRECT_STRING, 'x')),
+                      ('store', 'q', Value(DIRECT_STRING, 'y'))]
+        try:
+            workspace._transact(client, operations, {})
+        except WorkspaceFailure, exc:
+            self.assertEqual(exc.status, VARIABLE_FULL)
+        else:
+            self.fail('store to a full variable succeeded')
+        self.assertEqual(workspace.get_variable('other'), None)
+
+if __name__ == '__main__':
+    unittest.main()